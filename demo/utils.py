@@ -1,183 +1,366 @@
 import torch
 import numpy as np
-from collections import defaultdict
+from collections import deque
 
-from mmdet.models.task_modules.assigners import BboxOverlaps2D
-from mmengine.structures import InstanceData
-def average_score_filter(instances_list):
-    # Extract instance IDs and their scores
-    instance_id_to_frames = defaultdict(list)
-    instance_id_to_scores = defaultdict(list)
-    for frame_idx, instances in enumerate(instances_list):
-        for i, instance_id in enumerate(instances[0].pred_track_instances.instances_id):
-            instance_id_to_frames[instance_id.item()].append(frame_idx)
-            instance_id_to_scores[instance_id.item()].append(instances[0].pred_track_instances.scores[i].cpu().numpy())
-
-    # Compute average scores for each segment of each instance ID
-    for instance_id, frames in instance_id_to_frames.items():
-        scores = np.array(instance_id_to_scores[instance_id])
-
-        # Identify segments
-        segments = []
-        segment = [frames[0]]
-        for idx in range(1, len(frames)):
-            if frames[idx] == frames[idx - 1] + 1:
-                segment.append(frames[idx])
-            else:
-                segments.append(segment)
-                segment = [frames[idx]]
-        segments.append(segment)
-
-        # Compute average score for each segment
-        avg_scores = np.copy(scores)
-        for segment in segments:
-            segment_scores = scores[frames.index(segment[0]):frames.index(segment[-1]) + 1]
-            avg_score = np.mean(segment_scores)
-            avg_scores[frames.index(segment[0]):frames.index(segment[-1]) + 1] = avg_score
-
-        # Update instances_list with average scores
-        for frame_idx, avg_score in zip(frames, avg_scores):
-            instances_list[frame_idx][0].pred_track_instances.scores[
-                instances_list[frame_idx][0].pred_track_instances.instances_id == instance_id] = torch.tensor(avg_score, dtype=instances_list[frame_idx][0].pred_track_instances.scores.dtype)
 
-    return instances_list
 
+def build_track_table(instances_list):
+    """Flatten the tracking results of a video into a columnar track table.
 
-def moving_average_filter(instances_list, window_size=5):
-    # Helper function to compute the moving average
-    def smooth_bbox(bboxes, window_size):
-        smoothed_bboxes = np.copy(bboxes)
-        half_window = window_size // 2
-        for i in range(4):
-            padded_bboxes = np.pad(bboxes[:, i], (half_window, half_window), mode='edge')
-            smoothed_bboxes[:, i] = np.convolve(padded_bboxes, np.ones(window_size) / window_size, mode='valid')
-        return smoothed_bboxes
-
-    # Extract bounding boxes and instance IDs
-    instance_id_to_frames = defaultdict(list)
-    instance_id_to_bboxes = defaultdict(list)
+    Returns:
+        dict: Arrays with one entry per tracked instance, sorted by frame:
+        ``frame_id``, ``row`` (index of the instance in its frame),
+        ``track_id``, ``bbox`` (N, 4), ``score`` and ``label``.
+    """
+    frame_ids, rows, track_ids, bboxes, scores, labels = [], [], [], [], [], []
     for frame_idx, instances in enumerate(instances_list):
-        for i, instance_id in enumerate(instances[0].pred_track_instances.instances_id):
-            instance_id_to_frames[instance_id.item()].append(frame_idx)
-            instance_id_to_bboxes[instance_id.item()].append(instances[0].pred_track_instances.bboxes[i].cpu().numpy())
-
-    # Apply moving average filter to each segment
-    for instance_id, frames in instance_id_to_frames.items():
-        bboxes = np.array(instance_id_to_bboxes[instance_id])
-
-        # Identify segments
-        segments = []
-        segment = [frames[0]]
-        for idx in range(1, len(frames)):
-            if frames[idx] == frames[idx - 1] + 1:
-                segment.append(frames[idx])
-            else:
-                segments.append(segment)
-                segment = [frames[idx]]
-        segments.append(segment)
-
-        # Smooth bounding boxes for each segment
-        smoothed_bboxes = np.copy(bboxes)
-        for segment in segments:
-            if len(segment) >= window_size:
-                segment_bboxes = bboxes[frames.index(segment[0]):frames.index(segment[-1]) + 1]
-                smoothed_segment_bboxes = smooth_bbox(segment_bboxes, window_size)
-                smoothed_bboxes[frames.index(segment[0]):frames.index(segment[-1]) + 1] = smoothed_segment_bboxes
-
-        # Update instances_list with smoothed bounding boxes
-        for frame_idx, smoothed_bbox in zip(frames, smoothed_bboxes):
-            instances_list[frame_idx][0].pred_track_instances.bboxes[
-                instances_list[frame_idx][0].pred_track_instances.instances_id == instance_id] = torch.tensor(smoothed_bbox, dtype=instances_list[frame_idx][0].pred_track_instances.bboxes.dtype).to(instances_list[frame_idx][0].pred_track_instances.bboxes.device)
-
+        pred_track_instances = instances[0].pred_track_instances
+        num = len(pred_track_instances.instances_id)
+        if num == 0:
+            continue
+        frame_ids.append(np.full(num, frame_idx, dtype=np.int64))
+        rows.append(np.arange(num, dtype=np.int64))
+        track_ids.append(pred_track_instances.instances_id.cpu().numpy().astype(np.int64))
+        bboxes.append(pred_track_instances.bboxes.cpu().numpy())
+        scores.append(pred_track_instances.scores.cpu().numpy())
+        labels.append(pred_track_instances.labels.cpu().numpy())
+
+    if len(frame_ids) == 0:
+        return dict(frame_id=np.zeros(0, dtype=np.int64), row=np.zeros(0, dtype=np.int64),
+                    track_id=np.zeros(0, dtype=np.int64), bbox=np.zeros((0, 4), dtype=np.float32),
+                    score=np.zeros(0, dtype=np.float32), label=np.zeros(0, dtype=np.int64))
+    return dict(frame_id=np.concatenate(frame_ids), row=np.concatenate(rows),
+                track_id=np.concatenate(track_ids), bbox=np.concatenate(bboxes),
+                score=np.concatenate(scores), label=np.concatenate(labels))
+
+
+def select_track_table(table, mask):
+    """Keep the entries of a track table where ``mask`` is True."""
+    return {k: v[mask] for k, v in table.items()}
+
+
+def apply_track_table(instances_list, table):
+    """Write the bboxes and scores of a track table back to the results.
+
+    Instances missing from the table are removed from their frame.
+    """
+    num_frames = len(instances_list)
+    starts = np.searchsorted(table['frame_id'], np.arange(num_frames), side='left')
+    ends = np.searchsorted(table['frame_id'], np.arange(num_frames), side='right')
+    for frame_idx, instances in enumerate(instances_list):
+        pred_track_instances = instances[0].pred_track_instances
+        num = len(pred_track_instances.instances_id)
+        if num == 0:
+            continue
+        start, end = starts[frame_idx], ends[frame_idx]
+        if end - start != num:
+            keep = torch.from_numpy(table['row'][start:end])
+            pred_track_instances = pred_track_instances[keep]
+        if end > start:
+            pred_track_instances.bboxes = torch.from_numpy(table['bbox'][start:end]).to(
+                dtype=pred_track_instances.bboxes.dtype, device=pred_track_instances.bboxes.device)
+            pred_track_instances.scores = torch.from_numpy(table['score'][start:end]).to(
+                dtype=pred_track_instances.scores.dtype, device=pred_track_instances.scores.device)
+        instances[0].pred_track_instances = pred_track_instances
     return instances_list
 
 
-def identify_and_remove_giant_bounding_boxes(instances_list, image_size, size_threshold, confidence_threshold,
-                                             coverage_threshold, object_num_thr=4, max_objects_in_box=6):
-    # Initialize BboxOverlaps2D with 'iof' mode
-    bbox_overlaps_calculator = BboxOverlaps2D()
-
-    # Initialize data structures
-    invalid_instance_ids = set()
-
+def track_segments(table):
+    """Split the tracks of a table into segments of consecutive frames.
+
+    Returns:
+        tuple: ``order`` sorting the table by (track_id, frame_id), then for
+        the sorted entries the segment index, the position inside the segment,
+        the first sorted index of the segment and the segment length.
+    """
+    order = np.lexsort((table['frame_id'], table['track_id']))
+    track_ids = table['track_id'][order]
+    frame_ids = table['frame_id'][order]
+    new_segment = np.ones(len(order), dtype=bool)
+    new_segment[1:] = (track_ids[1:] != track_ids[:-1]) | (frame_ids[1:] != frame_ids[:-1] + 1)
+    segment = np.cumsum(new_segment) - 1
+    segment_starts = np.flatnonzero(new_segment)
+    segment_lengths = np.diff(np.append(segment_starts, len(order)))
+    start = segment_starts[segment]
+    position = np.arange(len(order)) - start
+    length = segment_lengths[segment]
+    return order, segment, position, start, length
+
+
+def average_score_table(table):
+    """Replace each score by the average score of its track segment."""
+    if len(table['score']) == 0:
+        return table
+    order, segment, _, _, length = track_segments(table)
+    segment_sums = np.bincount(segment, weights=table['score'][order])
+    avg_scores = np.empty_like(table['score'])
+    avg_scores[order] = (segment_sums[segment] / length).astype(table['score'].dtype)
+    table['score'] = avg_scores
+    return table
+
+
+def moving_average_table(table, window_size=5):
+    """Smooth the bboxes of every track segment at least ``window_size`` long
+    with an edge padded moving average."""
+    if len(table['bbox']) == 0:
+        return table
+    order, _, position, start, length = track_segments(table)
+    bboxes = table['bbox'][order]
+    half_window = window_size // 2
+    smoothed = np.zeros(bboxes.shape, dtype=np.float64)
+    for offset in range(-half_window, window_size - half_window):
+        neighbour = start + np.clip(position + offset, 0, length - 1)
+        smoothed += bboxes[neighbour]
+    smoothed /= window_size
+    long_segment = length >= window_size
+    smoothed_bboxes = np.copy(bboxes)
+    smoothed_bboxes[long_segment] = smoothed[long_segment]
+    table['bbox'][order] = smoothed_bboxes
+    return table
+
+
+def find_giant_instance_ids(bboxes, scores, instance_ids, two_thirds_image_area,
+                            size_threshold, confidence_threshold, coverage_threshold,
+                            object_num_thr=4, max_objects_in_box=6):
+    """Return the instance ids of the giant bounding boxes found in one frame.
+
+    Args:
+        bboxes (np.ndarray): of shape (N, 4) in (x1, y1, x2, y2).
+        scores (np.ndarray): of shape (N, ).
+        instance_ids (np.ndarray): of shape (N, ).
+    """
+    box_sizes = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    candidates = np.flatnonzero(box_sizes >= size_threshold)
+    if len(bboxes) < 2 or len(candidates) == 0:
+        return set()
+
+    # iofs[j, i]: fraction of box j covered by the candidate box i
+    lt = np.maximum(bboxes[:, None, :2], bboxes[None, candidates, :2])
+    rb = np.minimum(bboxes[:, None, 2:], bboxes[None, candidates, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    overlap = wh[..., 0] * wh[..., 1]
+    iofs = overlap / np.maximum(box_sizes, 1e-6)[:, None]
+
+    # the candidate box itself is not one of the other boxes
+    others = np.ones(iofs.shape, dtype=bool)
+    others[candidates, np.arange(len(candidates))] = False
+    high_conf = (scores > confidence_threshold)[:, None] & others
+
+    has_high_conf = high_conf.any(axis=0)
+    covered_count = (high_conf & (iofs > coverage_threshold)).sum(axis=0)
+    lower_than_all = np.where(high_conf, scores[candidates][None, :] < scores[:, None], True).all(axis=0)
+
+    invalid = (covered_count >= object_num_thr) & lower_than_all
+    invalid |= box_sizes[candidates] > two_thirds_image_area
+    invalid |= covered_count > max_objects_in_box
+    invalid &= has_high_conf
+    return set(instance_ids[candidates[invalid]].tolist())
+
+
+def remove_giant_table(table, image_size, size_threshold, confidence_threshold,
+                       coverage_threshold, object_num_thr=4, max_objects_in_box=6):
+    """Remove from a track table every track that is a giant bounding box in
+    at least one frame."""
+    if len(table['bbox']) == 0:
+        return table
     image_width, image_height = image_size
     two_thirds_image_area = (2 / 3) * (image_width * image_height)
 
-    # Step 1: Identify giant bounding boxes and record their instance_ids
-    for frame_idx, instances in enumerate(instances_list):
-        bounding_boxes = instances[0].pred_track_instances.bboxes
-        confidence_scores = instances[0].pred_track_instances.scores
-        instance_ids = instances[0].pred_track_instances.instances_id
-
-        N = bounding_boxes.size(0)
-
-        for i in range(N):
-            current_box = bounding_boxes[i]
-            box_size = (current_box[2] - current_box[0]) * (current_box[3] - current_box[1])
-
-            if box_size < size_threshold:
-                continue
-
-            other_boxes = torch.cat([bounding_boxes[:i], bounding_boxes[i + 1:]])
-            other_confidences = torch.cat([confidence_scores[:i], confidence_scores[i + 1:]])
-            iofs = bbox_overlaps_calculator(other_boxes, current_box.unsqueeze(0), mode='iof', is_aligned=False)
-
-            if iofs.numel() == 0:
-                continue
-
-            high_conf_mask = other_confidences > confidence_threshold
+    bboxes = table['bbox']
+    box_sizes = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    # only the frames with a large box need the pairwise check
+    candidate_frames = np.unique(table['frame_id'][box_sizes >= size_threshold])
+    starts = np.searchsorted(table['frame_id'], candidate_frames, side='left')
+    ends = np.searchsorted(table['frame_id'], candidate_frames, side='right')
 
-            if high_conf_mask.numel() == 0 or torch.sum(high_conf_mask) == 0:
-                continue
+    invalid_instance_ids = set()
+    for start, end in zip(starts, ends):
+        invalid_instance_ids |= find_giant_instance_ids(
+            bboxes[start:end], table['score'][start:end], table['track_id'][start:end],
+            two_thirds_image_area, size_threshold, confidence_threshold, coverage_threshold,
+            object_num_thr, max_objects_in_box)
 
-            high_conf_masked_iofs = iofs[high_conf_mask]
+    if len(invalid_instance_ids) == 0:
+        return table
+    valid = ~np.isin(table['track_id'], np.array(sorted(invalid_instance_ids), dtype=np.int64))
+    return select_track_table(table, valid)
 
-            covered_high_conf_boxes_count = torch.sum(high_conf_masked_iofs > coverage_threshold)
 
-            if covered_high_conf_boxes_count >= object_num_thr and torch.all(
-                    confidence_scores[i] < other_confidences[high_conf_mask]):
-                invalid_instance_ids.add(instance_ids[i].item())
-                continue
+def average_score_filter(instances_list):
+    table = average_score_table(build_track_table(instances_list))
+    return apply_track_table(instances_list, table)
 
-            if box_size > two_thirds_image_area:
-                invalid_instance_ids.add(instance_ids[i].item())
-                continue
 
-            # New condition: if the bounding box contains more than 6 objects
-            if covered_high_conf_boxes_count > max_objects_in_box:
-                invalid_instance_ids.add(instance_ids[i].item())
-                continue
+def moving_average_filter(instances_list, window_size=5):
+    table = moving_average_table(build_track_table(instances_list), window_size=window_size)
+    return apply_track_table(instances_list, table)
 
-    # Remove invalid tracks
-    for frame_idx, instances in enumerate(instances_list):
-        valid_mask = torch.tensor(
-            [instance_id.item() not in invalid_instance_ids for instance_id in
-             instances[0].pred_track_instances.instances_id])
-        if len(valid_mask) == 0:
-            continue
-        new_instance_data = InstanceData()
-        new_instance_data.bboxes = instances[0].pred_track_instances.bboxes[valid_mask]
-        new_instance_data.scores = instances[0].pred_track_instances.scores[valid_mask]
-        new_instance_data.instances_id = instances[0].pred_track_instances.instances_id[valid_mask]
-        new_instance_data.labels = instances[0].pred_track_instances.labels[valid_mask]
-        if 'masks' in instances[0].pred_track_instances:
-            new_instance_data.masks = instances[0].pred_track_instances.masks[valid_mask]
-        instances[0].pred_track_instances = new_instance_data
 
-    return instances_list
+def identify_and_remove_giant_bounding_boxes(instances_list, image_size, size_threshold, confidence_threshold,
+                                             coverage_threshold, object_num_thr=4, max_objects_in_box=6):
+    table = remove_giant_table(build_track_table(instances_list), image_size, size_threshold,
+                               confidence_threshold, coverage_threshold, object_num_thr, max_objects_in_box)
+    return apply_track_table(instances_list, table)
 
 
 def filter_and_update_tracks(instances_list, image_size, size_threshold=10000, coverage_threshold=0.75,
                              confidence_threshold=0.2, smoothing_window_size=5):
 
+    table = build_track_table(instances_list)
+
     # Step 1: Identify and remove giant bounding boxes
-    instances_list = identify_and_remove_giant_bounding_boxes(instances_list, image_size, size_threshold, confidence_threshold, coverage_threshold)
+    table = remove_giant_table(table, image_size, size_threshold, confidence_threshold, coverage_threshold)
 
      # Step 2: Smooth interpolated bounding boxes
-    instances_list = moving_average_filter(instances_list, window_size=smoothing_window_size)
+    table = moving_average_table(table, window_size=smoothing_window_size)
 
     # Step 3: compute the track average score
-    instances_list = average_score_filter(instances_list)
-
-
-    return instances_list
\ No newline at end of file
+    table = average_score_table(table)
+
+    return apply_track_table(instances_list, table)
+
+
+class OnlineTrackFilter:
+    """Incremental version of :func:`filter_and_update_tracks`.
+
+    Frames are pushed one by one and come out ``delay`` frames later with the
+    giant boxes removed, the boxes smoothed and the scores averaged per track
+    segment. The filter only keeps the ``delay`` buffered frames plus a small
+    state for the tracks alive in the last emitted frame, so its memory
+    depends on ``delay`` instead of the video length.
+
+    When ``delay`` covers a whole track the output is the same as the offline
+    version. Otherwise a giant box seen more than ``delay`` frames after the
+    track started only removes the frames that are still buffered, and a
+    segment score is averaged over the part of the segment seen so far.
+    Smoothing is exact as long as ``delay >= smoothing_window_size - 1``.
+    A giant track id is forgotten once no buffered frame holds it, so a track
+    lost for more than ``delay`` frames is not removed when it comes back.
+
+    Args:
+        image_size (tuple): (width, height) of the video frames.
+        delay (int): Number of frames a result is held back. Defaults to 30.
+    """
+
+    def __init__(self, image_size, delay=30, size_threshold=10000, coverage_threshold=0.75,
+                 confidence_threshold=0.2, smoothing_window_size=5, object_num_thr=4,
+                 max_objects_in_box=6):
+        assert delay >= 0
+        self.delay = delay
+        self.size_threshold = size_threshold
+        self.coverage_threshold = coverage_threshold
+        self.confidence_threshold = confidence_threshold
+        self.window_size = smoothing_window_size
+        self.half_window = smoothing_window_size // 2
+        self.object_num_thr = object_num_thr
+        self.max_objects_in_box = max_objects_in_box
+
+        image_width, image_height = image_size
+        self.two_thirds_image_area = (2 / 3) * (image_width * image_height)
+
+        # buffered frames: (instances, payload, {instance_id: row}, bboxes, scores),
+        # the bboxes and scores as numpy arrays
+        self.buffer = deque()
+        self.invalid_instance_ids = set()
+        # per-track state of the segments alive in the last emitted frame
+        self.tracks = dict()
+
+    def push(self, instances, payload=None):
+        """Add the next frame and return the frames that are ready.
+
+        Args:
+            instances: The tracking result of the frame, as appended to
+                ``instances_list`` in the offline demo.
+            payload: Anything to hand back together with the frame, e.g. the
+                decoded image.
+
+        Returns:
+            list[tuple]: (instances, payload) of the emitted frames in order.
+        """
+        pred_track_instances = instances[0].pred_track_instances
+        instance_ids = pred_track_instances.instances_id.cpu().numpy()
+        bboxes = pred_track_instances.bboxes.cpu().numpy()
+        scores = pred_track_instances.scores.cpu().numpy()
+        self.invalid_instance_ids |= find_giant_instance_ids(
+            bboxes, scores, instance_ids, self.two_thirds_image_area, self.size_threshold,
+            self.confidence_threshold, self.coverage_threshold,
+            self.object_num_thr, self.max_objects_in_box)
+        rows = {instance_id: row for row, instance_id in enumerate(instance_ids.tolist())}
+        self.buffer.append((instances, payload, rows, bboxes, scores))
+
+        ready = []
+        while len(self.buffer) > self.delay:
+            ready.append(self._emit())
+        return ready
+
+    def flush(self):
+        """Emit all the buffered frames, at the end of the video."""
+        ready = []
+        while len(self.buffer) > 0:
+            ready.append(self._emit())
+        return ready
+
+    def _future_run(self, instance_id):
+        """Collect the raw bboxes and scores of the consecutive buffered
+        frames containing ``instance_id``, starting from the oldest one."""
+        bboxes, scores = [], []
+        for _, _, rows, frame_bboxes, frame_scores in self.buffer:
+            row = rows.get(instance_id)
+            if row is None:
+                return bboxes, scores, True
+            bboxes.append(frame_bboxes[row])
+            scores.append(float(frame_scores[row]))
+        return bboxes, scores, False
+
+    def _emit(self):
+        instances, payload, rows, bboxes, scores = self.buffer[0]
+        pred_track_instances = instances[0].pred_track_instances
+
+        alive_tracks = dict()
+        smoothed_bboxes = bboxes.copy()
+        avg_scores = scores.copy()
+        for instance_id, row in rows.items():
+            if instance_id in self.invalid_instance_ids:
+                continue
+            future_bboxes, future_scores, ended = self._future_run(instance_id)
+            state = self.tracks.get(instance_id)
+            if state is None:
+                # a new segment starts in this frame
+                state = dict(length=0, first_bbox=future_bboxes[0],
+                             history=deque(maxlen=self.half_window),
+                             score_sum=0.0)
+            alive_tracks[instance_id] = state
+
+            # segment length seen so far, exact if the segment ended in the buffer
+            length = state['length'] + len(future_bboxes)
+            if length >= self.window_size:
+                past = list(state['history'])
+                past = [state['first_bbox']] * (self.half_window - len(past)) + past
+                future = future_bboxes[:self.window_size - self.half_window]
+                future = future + [future[-1]] * (self.window_size - self.half_window - len(future))
+                smoothed = np.mean(np.stack(past + future), axis=0)
+                smoothed_bboxes[row] = smoothed
+
+            avg_score = (state['score_sum'] + sum(future_scores)) / length
+            avg_scores[row] = avg_score
+
+            state['length'] += 1
+            state['history'].append(future_bboxes[0])
+            state['score_sum'] += future_scores[0]
+
+        self.buffer.popleft()
+        # segments that are not in this frame are finished
+        self.tracks = alive_tracks
+
+        pred_track_instances.bboxes = torch.from_numpy(smoothed_bboxes).to(pred_track_instances.bboxes)
+        pred_track_instances.scores = torch.from_numpy(avg_scores).to(pred_track_instances.scores)
+        valid_mask = torch.tensor(
+            [instance_id not in self.invalid_instance_ids for instance_id in rows])
+        # forget the giant ids no buffered frame holds any more
+        for instance_id in rows:
+            if instance_id in self.invalid_instance_ids and not any(
+                    instance_id in buffered[2] for buffered in self.buffer):
+                self.invalid_instance_ids.discard(instance_id)
+        if len(valid_mask) > 0:
+            instances[0].pred_track_instances = pred_track_instances[valid_mask]
+        return instances, payload
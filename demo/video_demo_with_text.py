@@ -5,15 +5,17 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
 import gc
+import json
 #import resource
 import argparse
+import queue
+import threading
 import cv2
 import tqdm
 
 import torch
 from torch.multiprocessing import Pool, set_start_method
 
-import mmcv
 from mmcv.transforms import Compose
 from mmengine.utils import track_iter_progress
 from mmdet.apis import init_detector
@@ -21,9 +23,11 @@ from mmdet.registry import VISUALIZERS
 from mmcv.ops.nms import batched_nms
 
 import masa
-from masa.apis import inference_masa, init_masa, inference_detector, build_test_pipeline
+from masa.apis import inference_masa, init_masa, inference_detector, build_test_pipeline, VideoSource
 from masa.models.sam import SamPredictor, sam_model_registry
-from utils import filter_and_update_tracks
+from masa.models.mot import FeatureStore
+from masa.models.tracker import KeyframeScheduler
+from utils import OnlineTrackFilter, filter_and_update_tracks
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -72,12 +76,24 @@ def parse_args():
     parser.add_argument('--unified', action='store_true', help='Use unified model, which means the masa adapter is built upon the detector model.')
     parser.add_argument('--detector_type', type=str, default='mmdet', help='Choose detector type')
     parser.add_argument('--fp16', action='store_true', help='Activation fp16 mode')
+    parser.add_argument('--tensor_preprocess', action='store_true', help='Resize and normalize the uint8 frames on the device of the model instead of the mmcv test pipeline')
+    parser.add_argument('--video_backend', default='auto', choices=['auto', 'pyav', 'opencv'], help='Video decoding backend, auto uses PyAV when it is installed')
+    parser.add_argument('--decode_threads', type=int, default=0, help='Video decoding threads, 0 lets the backend choose')
     parser.add_argument('--no-post', action='store_true', help='Do not post-process the results ')
     parser.add_argument('--show_fps', action='store_true', help='Visualize the fps')
     parser.add_argument('--sam_mask', action='store_true', help='Use SAM to generate mask for segmentation tracking')
     parser.add_argument('--sam_path',  type=str, default='saved_models/pretrain_weights/sam_vit_h_4b8939.pth', help='Default path for SAM models')
     parser.add_argument('--sam_type', type=str, default='vit_h', help='Default type for SAM models')
     parser.add_argument('--json_out', type=str, help='Output JSON file for tracking results')
+    parser.add_argument('--streaming', action='store_true', help='Decode, infer and render in a bounded pipeline instead of keeping the whole video in memory, '
+                        'the JSON records are written to --json_out as the frames finish')
+    parser.add_argument('--queue_size', type=int, default=32, help='Maximum number of frames buffered between the streaming stages')
+    parser.add_argument('--post_delay', type=int, default=30, help='Number of frames the streaming post-processing holds back, tracks shorter than this are filtered as in the offline mode')
+    parser.add_argument('--keyframe_stride', type=int, default=1, help='Run the detector every this many frames, the tracks are propagated with their velocity in between')
+    parser.add_argument('--adaptive_stride', action='store_true', help='Go back to detecting every frame when the tracks move fast or get lost, up to --keyframe_stride otherwise')
+    parser.add_argument('--feature_store', type=str, help='Directory keeping the backbone features of the video (unified models), '
+                        'a rerun with another prompt or thresholds reads them instead of running the backbone')
+    parser.add_argument('--feature_store_gb', type=float, default=20, help='Size limit of --feature_store in GB')
     parser.add_argument(
         '--wait-time',
         type=float,
@@ -86,22 +102,17 @@ def parse_args():
     args = parser.parse_args()
     return args
 
-def convert_instances_to_json(instances_list, video_path, model=None, custom_texts=None):
-    """Convert tracking instances to JSON format"""
-    import os
-    
-    def xyxy2xywh(bbox):
-        """Convert xyxy to xywh format"""
-        return [
-            bbox[0],  # x
-            bbox[1],  # y
-            bbox[2] - bbox[0],  # width
-            bbox[3] - bbox[1]   # height
-        ]
-
-    all_results = []
-    video_name = os.path.basename(video_path)
-    
+def xyxy2xywh(bbox):
+    """Convert xyxy to xywh format"""
+    return [
+        bbox[0],  # x
+        bbox[1],  # y
+        bbox[2] - bbox[0],  # width
+        bbox[3] - bbox[1]   # height
+    ]
+
+def get_label_mapping(model=None, custom_texts=None):
+    """Build the label id to label name mapping used in the JSON output"""
     # カスタムテキストが指定されている場合はそれを優先
     if custom_texts:
         if isinstance(custom_texts, str):
@@ -122,37 +133,56 @@ def convert_instances_to_json(instances_list, video_path, model=None, custom_tex
     if class_names:
         for i, name in enumerate(class_names):
             label_mapping[i] = name
-    
+
+    return label_mapping
+
+def convert_frame_to_json(instances, frame_idx, label_mapping):
+    """Convert the tracking instances of one frame to JSON records"""
+    results = []
+    if len(instances) == 0:
+        return results
+
+    pred_instances = instances[0].pred_track_instances
+
+    for i in range(len(pred_instances.instances_id)):
+        bbox_xyxy = pred_instances.bboxes[i].cpu().numpy().tolist()
+        bbox_xywh = xyxy2xywh(bbox_xyxy)
+
+        label_id = int(pred_instances.labels[i])
+        label_name = label_mapping.get(label_id, f"class_{label_id}")
+
+        data_dict = {
+            "frame_id": frame_idx,
+            "track_id": int(pred_instances.instances_id[i]),
+            "bbox": bbox_xywh,
+            "score": float(pred_instances.scores[i]),
+            "label": label_id,
+            "label_name": label_name
+        }
+
+        # マスクがある場合は追加
+        if hasattr(pred_instances, 'masks') and pred_instances.masks is not None:
+            if i < len(pred_instances.masks):
+                # マスクデータの処理（必要に応じて）
+                data_dict["has_mask"] = True
+
+        results.append(data_dict)
+
+    return results
+
+def convert_instances_to_json(instances_list, video_path, model=None, custom_texts=None):
+    """Convert tracking instances to JSON format"""
+    label_mapping = get_label_mapping(model, custom_texts)
+
+    all_results = []
     for frame_idx, instances in enumerate(instances_list):
-        if len(instances) == 0:
-            continue
-            
-        pred_instances = instances[0].pred_track_instances
-        
-        for i in range(len(pred_instances.instances_id)):
-            bbox_xyxy = pred_instances.bboxes[i].cpu().numpy().tolist()
-            bbox_xywh = xyxy2xywh(bbox_xyxy)
-
-            label_id = int(pred_instances.labels[i])
-            label_name = label_mapping.get(label_id, f"class_{label_id}")
-            
-            data_dict = {
-                "frame_id": frame_idx,
-                "track_id": int(pred_instances.instances_id[i]),
-                "bbox": bbox_xywh,
-                "score": float(pred_instances.scores[i]),
-                "label": label_id,
-                "label_name": label_name
-            }
-            
-            # マスクがある場合は追加
-            if hasattr(pred_instances, 'masks') and pred_instances.masks is not None:
-                if i < len(pred_instances.masks):
-                    # マスクデータの処理（必要に応じて）
-                    data_dict["has_mask"] = True
-            
-            all_results.append(data_dict)
-    
+        all_results.extend(convert_frame_to_json(instances, frame_idx, label_mapping))
+
+    return wrap_json_results(all_results, video_path, label_mapping)
+
+def wrap_json_results(all_results, video_path, label_mapping):
+    """Attach the video meta data to the JSON records"""
+    video_name = os.path.basename(video_path)
     result_with_meta = {
         "video_name": video_name,
         "label_mapping": label_mapping,
@@ -161,6 +191,251 @@ def convert_instances_to_json(instances_list, video_path, model=None, custom_tex
     
     return result_with_meta
 
+class JsonResultsWriter:
+    """Write the JSON of :func:`wrap_json_results` record by record as the frames finish,
+    instead of keeping the records of the whole video in memory.
+    The file is written to ``path`` when closed, ``resume`` goes on after the records
+    of a :meth:`state_dict` of an interrupted writer"""
+
+    def __init__(self, path, video_path, label_mapping, resume=None):
+        self.path = path
+        self.tmp_path = path + '.tmp.json'
+        if resume is not None:
+            # drop the records written after the state
+            self._file = open(self.tmp_path, 'r+')
+            self._file.truncate(resume['offset'])
+            self._file.seek(resume['offset'])
+            self._empty = resume['empty']
+            return
+        self._file = open(self.tmp_path, 'w')
+        # the annotations are last, open their list and leave it open
+        head = json.dumps(wrap_json_results([], video_path, label_mapping))
+        assert head.endswith('[]}')
+        self._file.write(head[:-2])
+        self._empty = True
+
+    def write(self, records):
+        for record in records:
+            if not self._empty:
+                self._file.write(', ')
+            self._file.write(json.dumps(record))
+            self._empty = False
+
+    def state_dict(self):
+        """Position after the records written so far, flushed to the file"""
+        self._file.flush()
+        return dict(offset=self._file.tell(), empty=self._empty)
+
+    def close(self):
+        self._file.write(']}')
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self._file.close()
+        os.remove(self.tmp_path)
+
+def track_frame(args, frame, frame_idx, video_len, masa_model, masa_test_pipeline, texts,
+                det_model=None, test_pipeline=None, ori_shape=None):
+    """Run detection and tracking on one frame, return the cpu result and its fps.
+    ``ori_shape`` is the (h, w) of the video when the frame was decoded at a smaller size"""
+    fps = None
+    # unified models mean that masa build upon and reuse the foundation model's backbone features for tracking,
+    # the frames between the keyframes only propagate the tracks and need no detection
+    if args.unified or not masa_model.is_keyframe(frame_idx):
+        track_result = inference_masa(masa_model, frame,
+                                      frame_id=frame_idx,
+                                      video_len=video_len,
+                                      test_pipeline=masa_test_pipeline,
+                                      text_prompt=texts,
+                                      fp16=args.fp16,
+                                      detector_type=args.detector_type,
+                                      show_fps=args.show_fps,
+                                      ori_shape=ori_shape)
+        if args.show_fps:
+            track_result, fps = track_result
+    else:
+
+        if args.detector_type == 'mmdet':
+            result = inference_detector(det_model, frame,
+                                        text_prompt=texts,
+                                        test_pipeline=test_pipeline,
+                                        fp16=args.fp16)
+
+        # Perfom inter-class NMS to remove nosiy detections
+        det_bboxes, keep_idx = batched_nms(boxes=result.pred_instances.bboxes,
+                                           scores=result.pred_instances.scores,
+                                           idxs=result.pred_instances.labels,
+                                           class_agnostic=True,
+                                           nms_cfg=dict(type='nms',
+                                                         iou_threshold=0.5,
+                                                         class_agnostic=True,
+                                                         split_thr=100000))
+
+        det_bboxes = torch.cat([det_bboxes,
+                                        result.pred_instances.scores[keep_idx].unsqueeze(1)],
+                                           dim=1)
+        det_labels = result.pred_instances.labels[keep_idx]
+
+        track_result = inference_masa(masa_model, frame, frame_id=frame_idx,
+                                      video_len=video_len,
+                                      test_pipeline=masa_test_pipeline,
+                                      det_bboxes=det_bboxes,
+                                      det_labels=det_labels,
+                                      fp16=args.fp16,
+                                      show_fps=args.show_fps)
+        if args.show_fps:
+            track_result, fps = track_result
+
+    if 'masks' in track_result[0].pred_track_instances:
+        if len(track_result[0].pred_track_instances.masks) >0:
+            track_result[0].pred_track_instances.masks = torch.stack(track_result[0].pred_track_instances.masks, dim=0)
+            track_result[0].pred_track_instances.masks = track_result[0].pred_track_instances.masks.cpu().numpy()
+
+    track_result[0].pred_track_instances.bboxes = track_result[0].pred_track_instances.bboxes.to(torch.float32)
+    return track_result.to('cpu'), fps
+
+def predict_sam_masks(args, sam_predictor, frame, track_result):
+    """Generate SAM masks for the tracked boxes of one frame, None if there is no box"""
+    device = args.device
+    track_result = track_result.to(device)
+    track_result[0].pred_track_instances.instances_id = track_result[0].pred_track_instances.instances_id.to(device)
+    track_result[0].pred_track_instances = track_result[0].pred_track_instances[(track_result[0].pred_track_instances.scores.float() > args.score_thr).to(device)]
+    input_boxes = track_result[0].pred_track_instances.bboxes
+    if len(input_boxes) == 0:
+        return None
+    sam_predictor.set_image(frame)
+    transformed_boxes = sam_predictor.transform.apply_boxes_torch(input_boxes, frame.shape[:2])
+    masks, _, _ = sam_predictor.predict_torch(
+        point_coords=None,
+        point_labels=None,
+        boxes=transformed_boxes,
+        multimask_output=False,
+    )
+    track_result[0].pred_track_instances.masks = masks.squeeze(1).cpu().numpy()
+    return track_result
+
+def run_streaming(args, video_reader, video_writer, visualizer, masa_model, masa_test_pipeline, texts,
+                  det_model=None, test_pipeline=None, sam_predictor=None):
+    """Decode, infer and render the video in three stages connected by bounded queues.
+
+    A decoder thread reads frames ahead of the inference loop, and a render thread
+    draws and encodes the results as soon as they are ready, so at most
+    ``args.queue_size`` frames are held in each queue whatever the video length.
+    Unless ``--no-post`` is set, the results go through an :class:`OnlineTrackFilter`
+    which holds back ``args.post_delay`` more frames.
+    """
+    video_len = len(video_reader)
+    frame_queue = queue.Queue(maxsize=args.queue_size)
+    render_queue = queue.Queue(maxsize=args.queue_size)
+    stop_event = threading.Event()
+    errors = []
+
+    def put(q, item):
+        # give up when another stage has failed, so no thread blocks forever
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def decode():
+        try:
+            for frame_idx, frame in enumerate(video_reader):
+                if not put(frame_queue, (frame_idx, frame)):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            put(frame_queue, None)
+
+    def render():
+        try:
+            while True:
+                item = get(render_queue)
+                if item is None:
+                    break
+                frame_idx, frame, track_result, fps = item
+                if video_writer is not None:
+                    vis_frame = visualize_frame(args, visualizer, frame, track_result, frame_idx, fps)
+                    video_writer.write(vis_frame[:, :, ::-1])
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+
+    decoder = threading.Thread(target=decode, daemon=True)
+    renderer = threading.Thread(target=render, daemon=True)
+    decoder.start()
+    renderer.start()
+
+    label_mapping = get_label_mapping(masa_model, texts)
+    # the records are written as the frames finish, the memory does not grow with the video
+    json_writer = JsonResultsWriter(args.json_out, args.video, label_mapping) if args.json_out else None
+    post_filter = None
+
+    def finish(track_result, payload):
+        frame_idx, frame, fps = payload
+        if sam_predictor is not None:
+            sam_result = predict_sam_masks(args, sam_predictor, frame, track_result)
+            if sam_result is not None:
+                track_result = sam_result
+        if json_writer is not None:
+            json_writer.write(convert_frame_to_json(track_result, frame_idx, label_mapping))
+        put(render_queue, (frame_idx, frame, track_result, fps))
+
+    progress = tqdm.tqdm(total=video_len)
+    try:
+        while True:
+            item = get(frame_queue)
+            if item is None:
+                break
+            frame_idx, frame = item
+            track_result, fps = track_frame(args, frame, frame_idx, video_len,
+                                            masa_model, masa_test_pipeline, texts,
+                                            det_model=det_model, test_pipeline=test_pipeline)
+            if args.no_post:
+                finish(track_result, (frame_idx, frame, fps))
+            else:
+                if post_filter is None:
+                    post_filter = OnlineTrackFilter((frame.shape[1], frame.shape[0]), delay=args.post_delay)
+                for ready in post_filter.push(track_result, (frame_idx, frame, fps)):
+                    finish(*ready)
+            progress.update(1)
+        if post_filter is not None and not stop_event.is_set():
+            for ready in post_filter.flush():
+                finish(*ready)
+    except Exception:
+        stop_event.set()
+        if json_writer is not None:
+            json_writer.discard()
+        raise
+    finally:
+        progress.close()
+        put(render_queue, None)
+        renderer.join()
+        stop_event.set()
+        decoder.join()
+
+    if errors:
+        if json_writer is not None:
+            json_writer.discard()
+        raise errors[0]
+
+    if json_writer is not None:
+        json_writer.close()
+        print(f'Results saved to {args.json_out}')
+
 def main():
     args = parse_args()
     assert args.out, \
@@ -178,21 +453,33 @@ def main():
             0].type = 'mmdet.LoadImageFromNDArray'
         test_pipeline = Compose(det_model.cfg.test_dataloader.dataset.pipeline)
 
+    if args.feature_store:
+        assert args.unified, '--feature_store needs a unified model (--unified)'
+        masa_model.feature_store = FeatureStore(args.feature_store, masa_model.feature_store_id,
+                                                FeatureStore.video_identity(args.video),
+                                                max_gb=args.feature_store_gb)
+
+    if args.keyframe_stride > 1:
+        masa_model.keyframe_scheduler = KeyframeScheduler(stride=args.keyframe_stride,
+                                                          adaptive=args.adaptive_stride)
+
     if args.sam_mask:
         print('Loading SAM model...')
         device = args.device
         sam_model = sam_model_registry[args.sam_type](args.sam_path)
         sam_predictor = SamPredictor(sam_model.to(device))
 
-    video_reader = mmcv.VideoReader(args.video)
+    # the frames are rendered, they are decoded at the size of the video
+    video_reader = VideoSource(args.video, backend=args.video_backend, threads=args.decode_threads)
     video_writer = None
 
     #### parsing the text input
     texts = args.texts
     if texts is not None:
-        masa_test_pipeline = build_test_pipeline(masa_model.cfg, with_text=True)
+        masa_test_pipeline = build_test_pipeline(masa_model.cfg, with_text=True,
+                                                 tensor_native=args.tensor_preprocess)
     else:
-        masa_test_pipeline = build_test_pipeline(masa_model.cfg)
+        masa_test_pipeline = build_test_pipeline(masa_model.cfg, tensor_native=args.tensor_preprocess)
 
     if texts is not None:
         masa_model.cfg.visualizer['texts'] = texts
@@ -212,65 +499,29 @@ def main():
             args.out, fourcc, video_reader.fps,
             (video_reader.width, video_reader.height))
 
+    if args.streaming:
+        run_streaming(args, video_reader, video_writer, visualizer, masa_model,
+                      masa_test_pipeline, texts,
+                      det_model=None if args.unified else det_model,
+                      test_pipeline=None if args.unified else test_pipeline,
+                      sam_predictor=sam_predictor if args.sam_mask else None)
+        if video_writer:
+            video_writer.release()
+        print('Done')
+        return
+
     frame_idx = 0
     instances_list = []
     frames = []
     fps_list = []
     for frame in track_iter_progress((video_reader, len(video_reader))):
 
-        # unified models mean that masa build upon and reuse the foundation model's backbone features for tracking
-        if args.unified:
-            track_result = inference_masa(masa_model, frame,
-                                          frame_id=frame_idx,
-                                          video_len=len(video_reader),
-                                          test_pipeline=masa_test_pipeline,
-                                          text_prompt=texts,
-                                          fp16=args.fp16,
-                                          detector_type=args.detector_type,
-                                          show_fps=args.show_fps)
-            if args.show_fps:
-                track_result, fps = track_result
-        else:
-
-            if args.detector_type == 'mmdet':
-                result = inference_detector(det_model, frame,
-                                            text_prompt=texts,
-                                            test_pipeline=test_pipeline,
-                                            fp16=args.fp16)
-
-            # Perfom inter-class NMS to remove nosiy detections
-            det_bboxes, keep_idx = batched_nms(boxes=result.pred_instances.bboxes,
-                                               scores=result.pred_instances.scores,
-                                               idxs=result.pred_instances.labels,
-                                               class_agnostic=True,
-                                               nms_cfg=dict(type='nms',
-                                                             iou_threshold=0.5,
-                                                             class_agnostic=True,
-                                                             split_thr=100000))
-
-            det_bboxes = torch.cat([det_bboxes,
-                                            result.pred_instances.scores[keep_idx].unsqueeze(1)],
-                                               dim=1)
-            det_labels = result.pred_instances.labels[keep_idx]
-
-            track_result = inference_masa(masa_model, frame, frame_id=frame_idx,
-                                          video_len=len(video_reader),
-                                          test_pipeline=masa_test_pipeline,
-                                          det_bboxes=det_bboxes,
-                                          det_labels=det_labels,
-                                          fp16=args.fp16,
-                                          show_fps=args.show_fps)
-            if args.show_fps:
-                track_result, fps = track_result
-
+        track_result, fps = track_frame(args, frame, frame_idx, len(video_reader),
+                                        masa_model, masa_test_pipeline, texts,
+                                        det_model=None if args.unified else det_model,
+                                        test_pipeline=None if args.unified else test_pipeline)
         frame_idx += 1
-        if 'masks' in track_result[0].pred_track_instances:
-            if len(track_result[0].pred_track_instances.masks) >0:
-                track_result[0].pred_track_instances.masks = torch.stack(track_result[0].pred_track_instances.masks, dim=0)
-                track_result[0].pred_track_instances.masks = track_result[0].pred_track_instances.masks.cpu().numpy()
-
-        track_result[0].pred_track_instances.bboxes = track_result[0].pred_track_instances.bboxes.to(torch.float32)
-        instances_list.append(track_result.to('cpu'))
+        instances_list.append(track_result)
         frames.append(frame)
         if args.show_fps:
             fps_list.append(fps)
@@ -281,22 +532,9 @@ def main():
     if args.sam_mask:
         print('Start to generate mask using SAM!')
         for idx, (frame, track_result) in tqdm.tqdm(enumerate(zip(frames, instances_list))):
-            track_result = track_result.to(device)
-            track_result[0].pred_track_instances.instances_id = track_result[0].pred_track_instances.instances_id.to(device)
-            track_result[0].pred_track_instances = track_result[0].pred_track_instances[(track_result[0].pred_track_instances.scores.float() > args.score_thr).to(device)]
-            input_boxes = track_result[0].pred_track_instances.bboxes
-            if len(input_boxes) == 0:
-                continue
-            sam_predictor.set_image(frame)
-            transformed_boxes = sam_predictor.transform.apply_boxes_torch(input_boxes, frame.shape[:2])
-            masks, _, _ = sam_predictor.predict_torch(
-                point_coords=None,
-                point_labels=None,
-                boxes=transformed_boxes,
-                multimask_output=False,
-            )
-            track_result[0].pred_track_instances.masks = masks.squeeze(1).cpu().numpy()
-            instances_list[idx] = track_result
+            track_result = predict_sam_masks(args, sam_predictor, frame, track_result)
+            if track_result is not None:
+                instances_list[idx] = track_result
 
 
 
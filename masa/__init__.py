@@ -1,3 +1,17 @@
-from .datasets import *  # noqa
-from .models import *  # noqa
-from .visualization import *  # noqa
+import os
+
+from .registry import (import_lazy_modules, lazy_getattr, lazy_names,
+                       register_lazy_modules)
+
+# The datasets, models and visualization modules are imported on first use,
+# see masa/registry.py. Set MASA_LAZY_IMPORT=0 to import them all up front.
+if os.environ.get("MASA_LAZY_IMPORT", "1") == "0":
+    import_lazy_modules()
+else:
+    register_lazy_modules()
+
+__all__ = lazy_names(__name__)
+
+
+def __getattr__(name):
+    return lazy_getattr(__name__, name)
@@ -1,10 +1,20 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+from .chunk_stitching import split_chunks, stitch_chunks
 from .masa_inference import (build_test_pipeline, inference_detector,
-                             inference_masa, init_masa)
+                             inference_masa, inference_masa_batch, init_masa)
+from .multi_stream import MultiStreamEngine
+from .tensor_preprocessor import TensorPreprocessor
+from .video_source import VideoSource
 
 __all__ = [
     "inference_masa",
+    "inference_masa_batch",
     "init_masa",
     "inference_detector",
     "build_test_pipeline",
+    "MultiStreamEngine",
+    "split_chunks",
+    "stitch_chunks",
+    "TensorPreprocessor",
+    "VideoSource",
 ]
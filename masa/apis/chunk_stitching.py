@@ -0,0 +1,190 @@
+from typing import Dict, List, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+from mmdet.structures.bbox import bbox_overlaps
+
+from ..models.tracker.assignment import assign
+
+
+def split_chunks(num_frames: int, chunk_size: int, overlap: int) -> List[Tuple[int, int]]:
+    """Split ``num_frames`` frames into chunks of ``chunk_size`` frames,
+    each extended by the ``overlap`` first frames of the next one.
+
+    Returns:
+        list[tuple[int, int]]: Start and end (exclusive) frame of every chunk.
+    """
+    assert chunk_size > 0 and overlap >= 0
+    chunks = []
+    for start in range(0, num_frames, chunk_size):
+        chunks.append((start, min(start + chunk_size + overlap, num_frames)))
+    # a last chunk within the overlap of the previous one is not needed
+    if len(chunks) > 1 and chunks[-1][0] < chunks[-2][1] and chunks[-2][1] == num_frames:
+        chunks.pop()
+    return chunks
+
+
+def _xywh_to_xyxy(bboxes: torch.Tensor) -> torch.Tensor:
+    return torch.cat([bboxes[:, :2], bboxes[:, :2] + bboxes[:, 2:]], dim=1)
+
+
+def _track_boxes(records: Sequence[dict], start: int, end: int) -> Dict[int, Dict[int, list]]:
+    """``{frame_id: {track_id: bbox}}`` of the records in ``[start, end)``."""
+    boxes = {}
+    for record in records:
+        if start <= record["frame_id"] < end:
+            boxes.setdefault(record["frame_id"], {})[record["track_id"]] = record["bbox"]
+    return boxes
+
+
+def match_overlap(
+    prev_records: Sequence[dict],
+    next_records: Sequence[dict],
+    prev_embeds: Dict[int, torch.Tensor],
+    next_embeds: Dict[int, torch.Tensor],
+    start: int,
+    end: int,
+    embed_weight: float = 0.5,
+    match_thr: float = 0.5,
+) -> Dict[int, int]:
+    """Match the tracks of two consecutive chunks over their common frames.
+
+    The score of a pair of tracks is ``(1 - embed_weight)`` times their mean
+    box IoU over the frames where either of them is present, plus
+    ``embed_weight`` times the cosine similarity of their mean embeddings in
+    the overlap (the IoU alone without the embeddings). The tracks which
+    never overlap can not match. The tracks of
+    the next chunk are matched greedily, the ones with the best scores
+    first.
+
+    Args:
+        prev_records (Sequence[dict]): JSON records of the previous chunk.
+        next_records (Sequence[dict]): JSON records of the next chunk.
+        prev_embeds (dict[int, Tensor]): Mean embedding of the tracks of the
+            previous chunk in the overlap.
+        next_embeds (dict[int, Tensor]): Same for the next chunk.
+        start (int): First frame of the overlap.
+        end (int): End (exclusive) frame of the overlap.
+        embed_weight (float): Weight of the embedding similarity.
+            Defaults to 0.5.
+        match_thr (float): Minimum score of a match. Defaults to 0.5.
+
+    Returns:
+        dict[int, int]: Track id of the previous chunk of every matched track
+        id of the next chunk.
+    """
+    prev_boxes = _track_boxes(prev_records, start, end)
+    next_boxes = _track_boxes(next_records, start, end)
+    prev_ids = sorted({i for boxes in prev_boxes.values() for i in boxes})
+    next_ids = sorted({i for boxes in next_boxes.values() for i in boxes})
+    if len(prev_ids) == 0 or len(next_ids) == 0:
+        return {}
+    prev_index = {track_id: i for i, track_id in enumerate(prev_ids)}
+    next_index = {track_id: i for i, track_id in enumerate(next_ids)}
+
+    iou_sums = torch.zeros((len(next_ids), len(prev_ids)))
+    # frames where both tracks are present, and where each of them is
+    both_counts = torch.zeros((len(next_ids), len(prev_ids)))
+    next_counts = torch.zeros((len(next_ids),))
+    prev_counts = torch.zeros((len(prev_ids),))
+    for frame_id in range(start, end):
+        prev_frame = prev_boxes.get(frame_id, {})
+        next_frame = next_boxes.get(frame_id, {})
+        prev_rows = torch.tensor([prev_index[i] for i in prev_frame], dtype=torch.long)
+        next_rows = torch.tensor([next_index[i] for i in next_frame], dtype=torch.long)
+        prev_counts[prev_rows] += 1
+        next_counts[next_rows] += 1
+        if len(prev_frame) == 0 or len(next_frame) == 0:
+            continue
+        ious = bbox_overlaps(
+            _xywh_to_xyxy(torch.tensor(list(next_frame.values()), dtype=torch.float32)),
+            _xywh_to_xyxy(torch.tensor(list(prev_frame.values()), dtype=torch.float32)),
+        )
+        iou_sums[next_rows[:, None], prev_rows[None, :]] += ious
+        both_counts[next_rows[:, None], prev_rows[None, :]] += 1
+    # mean IoU over the frames where either track is present
+    union = next_counts[:, None] + prev_counts[None, :] - both_counts
+    scores = iou_sums / union.clamp(min=1)
+
+    embeds_next = [next_embeds.get(i) for i in next_ids]
+    embeds_prev = [prev_embeds.get(i) for i in prev_ids]
+    if embed_weight > 0 and all(e is not None for e in embeds_next + embeds_prev):
+        similarity = torch.mm(
+            F.normalize(torch.stack(embeds_next).float(), p=2, dim=1),
+            F.normalize(torch.stack(embeds_prev).float(), p=2, dim=1).t(),
+        )
+        scores = (1 - embed_weight) * scores + embed_weight * similarity.clamp(min=0)
+
+    # the tracks sharing no frame in the overlap can not match
+    scores = scores.masked_fill(iou_sums == 0, float("-inf"))
+    # most overlapping next tracks first
+    order = torch.argsort(scores.max(dim=1)[0], descending=True)
+    assigned = assign(scores[order], match_thr)
+    matches = {}
+    for row, col in zip(order.tolist(), assigned.tolist()):
+        if col > -1:
+            matches[next_ids[row]] = prev_ids[col]
+    return matches
+
+
+def stitch_chunks(
+    chunk_results: Sequence[dict],
+    chunks: Sequence[Tuple[int, int]],
+    embed_weight: float = 0.5,
+    match_thr: float = 0.5,
+) -> List[dict]:
+    """Merge the tracking results of overlapping chunks into one track id
+    space.
+
+    The frames of an overlap are taken from the previous chunk up to its
+    middle and from the next chunk after it.
+
+    Args:
+        chunk_results (Sequence[dict]): For every chunk, ``records``, its
+            JSON records with the frame ids of the video, ``head_embeds``
+            and ``tail_embeds``, the mean embeddings of its tracks in the
+            overlaps with the previous and the next chunk.
+        chunks (Sequence[tuple[int, int]]): Frame range of every chunk, as
+            returned by :func:`split_chunks`.
+        embed_weight (float): See :func:`match_overlap`. Defaults to 0.5.
+        match_thr (float): See :func:`match_overlap`. Defaults to 0.5.
+
+    Returns:
+        list[dict]: The JSON records of the video, sorted by frame.
+    """
+    records = []
+    num_global_ids = 0
+    prev_map = {}
+    for k, (result, (start, end)) in enumerate(zip(chunk_results, chunks)):
+        matches = {}
+        first = start
+        if k > 0:
+            overlap_end = chunks[k - 1][1]
+            matches = match_overlap(
+                chunk_results[k - 1]["records"],
+                result["records"],
+                chunk_results[k - 1]["tail_embeds"],
+                result["head_embeds"],
+                start,
+                overlap_end,
+                embed_weight=embed_weight,
+                match_thr=match_thr,
+            )
+            first = (start + overlap_end + 1) // 2
+        last = end
+        if k + 1 < len(chunks):
+            last = (chunks[k + 1][0] + end + 1) // 2
+
+        id_map = {}
+        for track_id in sorted({record["track_id"] for record in result["records"]}):
+            if track_id in matches and matches[track_id] in prev_map:
+                id_map[track_id] = prev_map[matches[track_id]]
+            else:
+                id_map[track_id] = num_global_ids
+                num_global_ids += 1
+        for record in result["records"]:
+            if first <= record["frame_id"] < last:
+                records.append(dict(record, track_id=id_map[record["track_id"]]))
+        prev_map = id_map
+    records.sort(key=lambda record: (record["frame_id"], record["track_id"]))
+    return records
@@ -1,4 +1,7 @@
 import copy
+import hashlib
+import json
+import os
 import time
 import warnings
 from pathlib import Path
@@ -11,7 +14,7 @@ from mmcv.ops import RoIPool
 from mmcv.transforms import Compose
 from mmdet.evaluation import get_classes
 from mmdet.registry import MODELS
-from mmdet.structures import DetDataSample, SampleList
+from mmdet.structures import DetDataSample, SampleList, TrackDataSample
 from mmdet.utils import ConfigType, get_test_pipeline_cfg
 from mmengine.config import Config
 from mmengine.dataset import default_collate
@@ -19,15 +22,66 @@ from mmengine.model.utils import revert_sync_batchnorm
 from mmengine.registry import init_default_scope
 from mmengine.runner import autocast, load_checkpoint
 
+from .tensor_preprocessor import TensorPreprocessor
+
 ImagesType = Union[str, np.ndarray, Sequence[str], Sequence[np.ndarray]]
 
 
+def _snapshot_path(snapshot_dir: str, config: Config, checkpoint: str) -> str:
+    """Path of the model snapshot of ``config`` and ``checkpoint``.
+
+    The key hashes the resolved config, the identity of the checkpoint file
+    (path, size and modification time, hashing the content of a multi-GB
+    file would cost as much as loading it) and the default dtype.
+    """
+    stat = os.stat(checkpoint)
+    key = json.dumps(
+        dict(
+            config=config.to_dict(),
+            checkpoint=(os.path.abspath(checkpoint), stat.st_size, stat.st_mtime_ns),
+            dtype=str(torch.get_default_dtype()),
+            torch=torch.__version__,
+        ),
+        sort_keys=True,
+        default=str,
+    )
+    name = os.path.splitext(os.path.basename(checkpoint))[0]
+    return os.path.join(
+        snapshot_dir, f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.pth"
+    )
+
+
+def _save_snapshot(model: nn.Module, path: str) -> None:
+    """Save the loaded weights and the dataset meta."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    snapshot = dict(
+        state_dict=model.state_dict(),
+        dataset_meta=model.dataset_meta,
+    )
+    # write then rename, so concurrent workers never read a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(snapshot, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _load_snapshot(model: nn.Module, path: str) -> None:
+    """Load a snapshot saved by :func:`_save_snapshot`.
+
+    The file is memory mapped and the weights are assigned to the model
+    rather than copied, pages are read when the model is moved to its device.
+    """
+    snapshot = torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    model.load_state_dict(snapshot["state_dict"], assign=True)
+    model.dataset_meta = snapshot["dataset_meta"]
+
+
 def init_masa(
     config: Union[str, Path, Config],
     checkpoint: Optional[str] = None,
     palette: str = "none",
     device: str = "cuda:0",
     cfg_options: Optional[dict] = None,
+    snapshot_dir: Optional[str] = None,
 ) -> nn.Module:
     """Initialize a unified masa detector from config file.
 
@@ -44,6 +98,11 @@ def init_masa(
             Defaults to cuda:0.
         cfg_options (dict, optional): Options to override some settings in
             the used config.
+        snapshot_dir (str, optional): Directory of the model snapshots. The
+            first start with a config and a checkpoint saves the loaded
+            weights there, later starts memory map them instead of reading
+            the whole checkpoint. Defaults to the ``MASA_SNAPSHOT_DIR``
+            environment variable, or no snapshot if it is not set.
 
     Returns:
         nn.Module: The constructed detector.
@@ -71,12 +130,20 @@ def init_masa(
     if scope is not None:
         init_default_scope(config.get("default_scope", "mmdet"))
 
+    if snapshot_dir is None:
+        snapshot_dir = os.environ.get("MASA_SNAPSHOT_DIR", None)
+    snapshot_path = None
+    if snapshot_dir and checkpoint is not None:
+        snapshot_path = _snapshot_path(snapshot_dir, config, checkpoint)
+
     model = MODELS.build(config.model)
     model = revert_sync_batchnorm(model)
     if checkpoint is None:
         warnings.simplefilter("once")
         warnings.warn("checkpoint is None, use COCO classes by default.")
         model.dataset_meta = {"classes": get_classes("coco")}
+    elif snapshot_path is not None and os.path.exists(snapshot_path):
+        _load_snapshot(model, snapshot_path)
     else:
         checkpoint = load_checkpoint(model, checkpoint, map_location="cpu")
         # Weights converted from elsewhere may not have meta fields.
@@ -99,6 +166,8 @@ def init_masa(
                 "checkpoint's meta data, use COCO classes by default."
             )
             model.dataset_meta = {"classes": get_classes("coco")}
+        if snapshot_path is not None:
+            _save_snapshot(model, snapshot_path)
 
     # Priority:  args.palette -> config -> checkpoint
     if palette != "none":
@@ -196,6 +265,19 @@ def inference_detector(
         return result_list
 
 
+def _set_source_shape(data_sample: DetDataSample, ori_shape) -> None:
+    """Map the results of a frame decoded at a smaller size back to the
+    (h, w) ``ori_shape`` of the video, see :class:`VideoSource`."""
+    h, w = data_sample.ori_shape
+    w_scale, h_scale = data_sample.scale_factor
+    data_sample.set_metainfo(
+        dict(
+            ori_shape=tuple(ori_shape),
+            scale_factor=(w_scale * w / ori_shape[1], h_scale * h / ori_shape[0]),
+        )
+    )
+
+
 def inference_masa(
     model: nn.Module,
     img: np.ndarray,
@@ -209,6 +291,7 @@ def inference_masa(
     fp16=False,
     detector_type="mmdet",
     show_fps=False,
+    ori_shape=None,
 ) -> SampleList:
     """Inference image(s) with the masa model.
 
@@ -217,31 +300,70 @@ def inference_masa(
         img (np.ndarray): Loaded image.
         frame_id (int): frame id.
         video_len (int): demo video length
+        ori_shape (tuple[int, int], optional): (h, w) of the video when
+            ``img`` was decoded at a smaller size, the results are given
+            at this size. Defaults to None, the shape of ``img``.
     Returns:
         SampleList: The tracking data samples.
     """
-    data = dict(
-        img=[img.astype(np.float32)],
-        # img=[img.astype(np.uint8)],
-        frame_id=[frame_id],
-        ori_shape=[img.shape[:2]],
-        img_id=[frame_id + 1],
-        ori_video_length=[video_len],
-    )
+    if not model.is_keyframe(frame_id):
+        # the tracks are propagated, neither the pipeline nor the model run
+        start = time.time()
+        result = TrackDataSample()
+        result.video_data_samples = [
+            DetDataSample(
+                metainfo=dict(
+                    frame_id=frame_id,
+                    ori_shape=img.shape[:2] if ori_shape is None else tuple(ori_shape),
+                    img_id=frame_id + 1,
+                    ori_video_length=video_len,
+                )
+            )
+        ]
+        with torch.no_grad():
+            model.propagate(result[0])
+        if show_fps:
+            return result, 1 / max(time.time() - start, 1e-6)
+        return result
+
+    if isinstance(test_pipeline, TensorPreprocessor):
+        # the uint8 frame is resized and normalized on the device, the
+        # data preprocessor of the model is skipped
+        data = test_pipeline(
+            img,
+            frame_id,
+            video_len,
+            device=model.data_preprocessor.device,
+            text=text_prompt,
+            custom_entities=custom_entities,
+        )
+        forward = lambda data: model.predict(**data)
+    else:
+        data = dict(
+            img=[img.astype(np.float32)],
+            # img=[img.astype(np.uint8)],
+            frame_id=[frame_id],
+            ori_shape=[img.shape[:2]],
+            img_id=[frame_id + 1],
+            ori_video_length=[video_len],
+        )
 
-    if text_prompt is not None:
-        if detector_type == "mmdet":
-            data["text"] = [text_prompt]
-            data["custom_entities"] = [custom_entities]
-        elif detector_type == "yolo-world":
-            data["texts"] = [text_prompt]
-            data["custom_entities"] = [custom_entities]
+        if text_prompt is not None:
+            if detector_type == "mmdet":
+                data["text"] = [text_prompt]
+                data["custom_entities"] = [custom_entities]
+            elif detector_type == "yolo-world":
+                data["texts"] = [text_prompt]
+                data["custom_entities"] = [custom_entities]
 
-    data = test_pipeline(data)
+        data = default_collate([test_pipeline(data)])
+        forward = model.test_step
+
+    if ori_shape is not None:
+        _set_source_shape(data["data_samples"][0].video_data_samples[0], ori_shape)
 
     # forward the model
     with torch.no_grad():
-        data = default_collate([data])
         if det_bboxes is not None:
             data["data_samples"][0].video_data_samples[0].det_bboxes = det_bboxes
             data["data_samples"][0].video_data_samples[0].det_labels = det_labels
@@ -249,19 +371,114 @@ def inference_masa(
         if show_fps:
             start = time.time()
             with autocast(enabled=fp16):
-                result = model.test_step(data)[0]
+                result = forward(data)[0]
             end = time.time()
             fps = 1 / (end - start)
             return result, fps
 
         else:
             with autocast(enabled=fp16):
-                result = model.test_step(data)[0]
+                result = forward(data)[0]
             return result
 
 
+def inference_masa_batch(
+    model: nn.Module,
+    frames: Sequence[np.ndarray],
+    start_frame_id: int,
+    video_len: int,
+    test_pipeline: Optional[Compose] = None,
+    text_prompt=None,
+    custom_entities: bool = False,
+    det_bboxes=None,
+    det_labels=None,
+    fp16=False,
+    detector_type="mmdet",
+    show_fps=False,
+    ori_shape=None,
+) -> SampleList:
+    """Inference a batch of consecutive frames with the masa model.
+
+    The backbone, the masa adapter and the detector heads run once on the
+    whole batch, and the per-frame results are tracked in frame order. Every
+    frame is detected, the model cannot have a keyframe scheduler.
+
+    Args:
+        model (nn.Module): The loaded mot model.
+        frames (Sequence[np.ndarray]): K consecutive loaded images.
+        start_frame_id (int): frame id of the first image in ``frames``.
+        video_len (int): demo video length
+        det_bboxes (Sequence[Tensor], optional): Per-frame detections, only
+            used when the detections are given.
+        det_labels (Sequence[Tensor], optional): Per-frame labels of
+            ``det_bboxes``.
+        ori_shape (tuple[int, int], optional): (h, w) of the video when the
+            frames were decoded at a smaller size, as in
+            :func:`inference_masa`.
+    Returns:
+        SampleList: The tracking data samples, one per frame.
+    """
+    tensor_native = isinstance(test_pipeline, TensorPreprocessor)
+    if tensor_native:
+        data = test_pipeline(
+            frames,
+            list(range(start_frame_id, start_frame_id + len(frames))),
+            video_len,
+            device=model.data_preprocessor.device,
+            text=text_prompt,
+            custom_entities=custom_entities,
+        )
+    else:
+        data_list = []
+        for i, img in enumerate(frames):
+            frame_id = start_frame_id + i
+            data = dict(
+                img=[img.astype(np.float32)],
+                frame_id=[frame_id],
+                ori_shape=[img.shape[:2]],
+                img_id=[frame_id + 1],
+                ori_video_length=[video_len],
+            )
+
+            if text_prompt is not None:
+                if detector_type == "mmdet":
+                    data["text"] = [text_prompt]
+                    data["custom_entities"] = [custom_entities]
+                elif detector_type == "yolo-world":
+                    data["texts"] = [text_prompt]
+                    data["custom_entities"] = [custom_entities]
+
+            data_list.append(test_pipeline(data))
+        data = default_collate(data_list)
+
+    if ori_shape is not None:
+        for data_sample in data["data_samples"]:
+            _set_source_shape(data_sample.video_data_samples[0], ori_shape)
+
+    # forward the model
+    with torch.no_grad():
+        if det_bboxes is not None:
+            for data_sample, bboxes, labels in zip(
+                data["data_samples"], det_bboxes, det_labels
+            ):
+                data_sample.video_data_samples[0].det_bboxes = bboxes
+                data_sample.video_data_samples[0].det_labels = labels
+
+        start = time.time()
+        with autocast(enabled=fp16):
+            if not tensor_native:
+                data = model.data_preprocessor(data, False)
+            results = model.predict_batch(**data)
+        end = time.time()
+
+    if show_fps:
+        fps = len(frames) / (end - start)
+        return results, fps
+    return results
+
+
 def build_test_pipeline(
-    cfg: ConfigType, with_text=False, detector_type="mmdet"
+    cfg: ConfigType, with_text=False, detector_type="mmdet", tensor_native=False
 ) -> ConfigType:
     """Build test_pipeline for mot/vis demo. In mot/vis infer, original
     test_pipeline should remove the "LoadImageFromFile" and
@@ -269,9 +486,20 @@ def build_test_pipeline(
 
     Args:
          cfg (ConfigDict): The loaded config.
+         tensor_native (bool): Whether to build a :obj:`TensorPreprocessor`,
+            which preprocesses the uint8 frames on the device of the model
+            instead of the mmcv transforms and the data preprocessor.
+            Defaults to False.
     Returns:
          ConfigType: new test_pipeline
     """
+    if tensor_native:
+        if detector_type != "mmdet":
+            raise ValueError(
+                f"The tensor preprocessing does not support {detector_type} detectors"
+            )
+        return TensorPreprocessor.from_config(cfg, with_text=with_text)
+
     # remove the "LoadImageFromFile" and "LoadTrackAnnotations" in pipeline
     transform_broadcaster = cfg.inference_pipeline[0].copy()
     if detector_type == "yolo-world":
@@ -0,0 +1,226 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+from mmcv.transforms import Compose
+from mmdet.structures import TrackDataSample
+from mmengine.dataset import default_collate
+from mmengine.runner import autocast
+
+
+class _Stream:
+    """State of one stream: its tracker and its latest frame."""
+
+    def __init__(self, tracker, video_len: int) -> None:
+        self.tracker = tracker
+        self.video_len = video_len
+        self.next_frame_id = 0
+        self.pending = None
+        self.num_dropped = 0
+        self.num_processed = 0
+
+
+class MultiStreamEngine:
+    """Track several video streams with one MASA model.
+
+    Every stream keeps its own copy of the tracker of the model, keyed by its
+    stream id. The frames are submitted per stream with :meth:`submit`, and
+    every :meth:`step` runs the latest frame of each stream with a new frame
+    through the backbone, the MASA adapter and the detector heads in batches
+    of up to ``max_batch_size`` frames, then routes the results to the tracker
+    of their stream.
+
+    Only the latest frame of a stream waits for the next step: a frame
+    submitted before the previous one was processed replaces it, and the
+    frame ids of the stream keep counting the dropped frames, so the trackers
+    see the gap. When more than ``max_batch_size`` streams wait, the streams
+    served the longest ago go first.
+
+    :meth:`submit` can be called from other threads, e.g. one reader per
+    camera, while one thread calls :meth:`step`.
+
+    The model must be unified (the masa adapter reuses the detector backbone)
+    or take the detections given with the frames, as in
+    :meth:`MASA.predict_batch`. The per video state of the model, a feature
+    store, a keyframe schedule or an artifact writer, cannot be shared by the
+    streams and must not be set.
+
+    Args:
+        model (nn.Module): The loaded MASA model.
+        test_pipeline (Compose): The pipeline of :func:`build_test_pipeline`.
+        text_prompt (str, optional): Text prompt of all the streams.
+        custom_entities (bool): Whether the prompt lists custom entities.
+            Defaults to False.
+        fp16 (bool): Whether to run the model under autocast.
+            Defaults to False.
+        detector_type (str): 'mmdet' or 'yolo-world'. Defaults to 'mmdet'.
+        max_batch_size (int): Maximum number of frames per forward pass.
+            Defaults to 16.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        test_pipeline: Compose,
+        text_prompt: Optional[str] = None,
+        custom_entities: bool = False,
+        fp16: bool = False,
+        detector_type: str = "mmdet",
+        max_batch_size: int = 16,
+    ) -> None:
+        assert max_batch_size > 0
+        # they are keyed by the frame id, which every stream counts from 0
+        assert (
+            getattr(model, "feature_store", None) is None
+        ), "the streams cannot share a feature store"
+        assert (
+            getattr(model, "artifact_writer", None) is None
+        ), "the streams cannot share an artifact writer"
+        # predict_batch runs the detector on every frame
+        assert (
+            getattr(model, "keyframe_scheduler", None) is None
+        ), "keyframe_cfg is not supported with several streams"
+        self.model = model
+        self.test_pipeline = test_pipeline
+        self.text_prompt = text_prompt
+        self.custom_entities = custom_entities
+        self.fp16 = fp16
+        self.detector_type = detector_type
+        self.max_batch_size = max_batch_size
+        # streams in the order they are served, least recently served first
+        self.streams: Dict[Hashable, _Stream] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add_stream(self, stream_id: Hashable, video_len: int = -1) -> None:
+        """Start a stream with a fresh tracker.
+
+        Args:
+            stream_id (Hashable): Id of the stream.
+            video_len (int): Number of frames, -1 for a live stream.
+        """
+        tracker = copy.deepcopy(self.model.tracker)
+        tracker.reset()
+        with self.lock:
+            assert stream_id not in self.streams, f"stream {stream_id} already exists"
+            self.streams[stream_id] = _Stream(tracker, video_len)
+
+    def remove_stream(self, stream_id: Hashable) -> None:
+        """Stop a stream and drop its tracker and pending frame."""
+        with self.lock:
+            self.streams.pop(stream_id)
+
+    def stats(self, stream_id: Hashable) -> Dict[str, int]:
+        """Numbers of processed and dropped frames of a stream."""
+        stream = self.streams[stream_id]
+        return dict(processed=stream.num_processed, dropped=stream.num_dropped)
+
+    def submit(
+        self,
+        stream_id: Hashable,
+        frame: np.ndarray,
+        det_bboxes: Optional[torch.Tensor] = None,
+        det_labels: Optional[torch.Tensor] = None,
+    ) -> int:
+        """Queue the next frame of a stream, replacing its pending frame.
+
+        Returns:
+            int: Frame id of the frame in its stream.
+        """
+        with self.lock:
+            stream = self.streams[stream_id]
+            if stream.pending is not None:
+                stream.num_dropped += 1
+            frame_id = stream.next_frame_id
+            stream.next_frame_id += 1
+            stream.pending = (frame, frame_id, det_bboxes, det_labels)
+        return frame_id
+
+    @property
+    def num_pending(self) -> int:
+        with self.lock:
+            return sum(stream.pending is not None for stream in self.streams.values())
+
+    def _prepare(self, stream: _Stream, frame: np.ndarray, frame_id: int) -> dict:
+        data = dict(
+            img=[frame.astype(np.float32)],
+            frame_id=[frame_id],
+            ori_shape=[frame.shape[:2]],
+            img_id=[frame_id + 1],
+            ori_video_length=[stream.video_len],
+        )
+        if self.text_prompt is not None:
+            if self.detector_type == "mmdet":
+                data["text"] = [self.text_prompt]
+                data["custom_entities"] = [self.custom_entities]
+            elif self.detector_type == "yolo-world":
+                data["texts"] = [self.text_prompt]
+                data["custom_entities"] = [self.custom_entities]
+        return self.test_pipeline(data)
+
+    def _forward(self, batch: List[tuple]) -> List[TrackDataSample]:
+        data = default_collate([data for _, _, data, _, _ in batch])
+        for data_sample, (_, _, _, det_bboxes, det_labels) in zip(
+            data["data_samples"], batch
+        ):
+            if det_bboxes is not None:
+                data_sample.video_data_samples[0].det_bboxes = det_bboxes
+                data_sample.video_data_samples[0].det_labels = det_labels
+        trackers = [stream.tracker for _, stream, _, _, _ in batch]
+        with autocast(enabled=self.fp16):
+            data = self.model.data_preprocessor(data, False)
+            return self.model.predict_batch(**data, trackers=trackers)
+
+    def step(self) -> Dict[Hashable, TrackDataSample]:
+        """Process the pending frames of up to ``max_batch_size`` streams.
+
+        Returns:
+            dict: The tracking result of every processed stream, as returned
+            by :func:`inference_masa`, with the frame id of the result in
+            its stream in ``result[0].frame_id``.
+        """
+        with self.lock:
+            batch = []
+            for stream_id, stream in self.streams.items():
+                if stream.pending is not None:
+                    batch.append((stream_id, stream, stream.pending))
+                    stream.pending = None
+                    if len(batch) == self.max_batch_size:
+                        break
+            for stream_id, _, _ in batch:
+                self.streams.move_to_end(stream_id)
+        if len(batch) == 0:
+            return {}
+
+        # the frames of a forward pass must share the input size
+        groups = OrderedDict()
+        for stream_id, stream, (frame, frame_id, det_bboxes, det_labels) in batch:
+            data = self._prepare(stream, frame, frame_id)
+            key = tuple(data["inputs"].shape)
+            groups.setdefault(key, []).append(
+                (stream_id, stream, data, det_bboxes, det_labels)
+            )
+
+        results = {}
+        with torch.no_grad():
+            for group in groups.values():
+                for (stream_id, stream, _, _, _), result in zip(
+                    group, self._forward(group)
+                ):
+                    stream.num_processed += 1
+                    results[stream_id] = result
+        return results
+
+    def run(self, poll_interval: float = 0.001):
+        """Yield the results of :meth:`step` as long as streams are open,
+        waiting ``poll_interval`` seconds when no frame is pending."""
+        while len(self.streams) > 0:
+            results = self.step()
+            if len(results) == 0:
+                time.sleep(poll_interval)
+                continue
+            yield results
@@ -0,0 +1,230 @@
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from mmdet.structures import DetDataSample, TrackDataSample
+from mmdet.utils import ConfigType
+from mmengine.structures import InstanceData
+
+FramesType = Union[np.ndarray, torch.Tensor, Sequence[np.ndarray], Sequence[torch.Tensor]]
+
+
+def get_inference_resize(cfg: ConfigType) -> Optional[dict]:
+    """The ``Resize`` transform of the ``inference_pipeline`` of a MASA
+    config, None if there is none."""
+    resize = None
+    for transform in cfg.inference_pipeline[0]["transforms"]:
+        if "Resize" in transform["type"]:
+            resize = transform
+    return resize
+
+
+def rescaled_shape(
+    h: int, w: int, scale: Tuple[int, int], keep_ratio: bool = True
+) -> Tuple[int, int]:
+    """Shape (h, w) of a (h, w) image resized to ``scale`` by the ``Resize``
+    transform, rounded as in mmcv."""
+    if not keep_ratio:
+        return scale[1], scale[0]
+    scale_factor = min(max(scale) / max(h, w), min(scale) / min(h, w))
+    return int(h * float(scale_factor) + 0.5), int(w * float(scale_factor) + 0.5)
+
+
+class TensorPreprocessor:
+    """Inference-only replacement of the test pipeline of
+    :func:`build_test_pipeline` and of the ``TrackDataPreprocessor`` of the
+    model, for uint8 frames.
+
+    The frames are moved to the device as uint8 (asynchronously from pinned
+    memory), then resized, converted from BGR to RGB, normalized and padded
+    there, without the float32 copy of the whole frame, the mmcv transforms
+    and the collate. The metainfo (``ori_shape``, ``img_shape``,
+    ``scale_factor``, ``pad_shape``, ``batch_input_shape``...) is the same as
+    with the pipeline.
+
+    The resize is bilinear like the ``Resize`` of the pipeline. On the CPU it
+    runs on the uint8 frame, whose rounding changes the pixels by up to one
+    intensity level, the float resize of the other devices matches the
+    pipeline up to float rounding.
+
+    Args:
+        scale (tuple[int, int]): ``scale`` of the ``Resize`` transform,
+            (w, h), or the long and short edges with ``keep_ratio``.
+        keep_ratio (bool): Whether to keep the aspect ratio. Defaults to
+            True.
+        mean (Sequence[float], optional): Pixel mean of the channels, after
+            the channel conversion. Defaults to None, no normalization.
+        std (Sequence[float], optional): Pixel std of the channels.
+            Defaults to None.
+        bgr_to_rgb (bool): Whether to convert the frames from BGR to RGB.
+            Defaults to False.
+        pad_size_divisor (int): The padded size is a multiple of it.
+            Defaults to 1.
+        pad_value (float): Value of the padded pixels. Defaults to 0.
+        with_text (bool): Whether to keep the text prompt in the metainfo,
+            like the pipeline built ``with_text``. Defaults to False.
+        uint8_resize (bool, optional): Whether to resize the uint8 frames
+            instead of float ones. Defaults to None, on the CPU only.
+    """
+
+    def __init__(
+        self,
+        scale: Tuple[int, int],
+        keep_ratio: bool = True,
+        mean: Optional[Sequence[float]] = None,
+        std: Optional[Sequence[float]] = None,
+        bgr_to_rgb: bool = False,
+        pad_size_divisor: int = 1,
+        pad_value: float = 0,
+        with_text: bool = False,
+        uint8_resize: Optional[bool] = None,
+    ) -> None:
+        assert (mean is None) == (std is None)
+        self.scale = tuple(scale)
+        self.keep_ratio = keep_ratio
+        self.bgr_to_rgb = bgr_to_rgb
+        self.pad_size_divisor = max(pad_size_divisor, 1)
+        self.pad_value = pad_value
+        self.with_text = with_text
+        self.uint8_resize = uint8_resize
+        # (x - mean) / std as one multiply-add
+        self.norm_scale, self.norm_bias = None, None
+        if mean is not None:
+            mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+            std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+            self.norm_scale = 1 / std
+            self.norm_bias = -mean / std
+
+    @classmethod
+    def from_config(cls, cfg: ConfigType, with_text: bool = False) -> "TensorPreprocessor":
+        """Build it from the ``Resize`` of ``inference_pipeline`` and the
+        ``data_preprocessor`` of the model of a MASA config."""
+        resize = get_inference_resize(cfg)
+        if resize is None or resize["type"] not in ("Resize", "mmdet.Resize"):
+            raise ValueError(
+                "The tensor preprocessing only supports the Resize transform of mmdet"
+            )
+        if resize.get("scale") is None:
+            raise ValueError("The tensor preprocessing needs the scale of Resize")
+        if resize.get("interpolation", "bilinear") != "bilinear":
+            raise ValueError("The tensor preprocessing only resizes bilinearly")
+        preprocessor = cfg.model.data_preprocessor
+        if preprocessor.get("rgb_to_bgr", False):
+            raise ValueError("The tensor preprocessing takes BGR frames")
+        return cls(
+            scale=resize["scale"],
+            keep_ratio=resize.get("keep_ratio", False),
+            mean=preprocessor.get("mean"),
+            std=preprocessor.get("std"),
+            bgr_to_rgb=preprocessor.get("bgr_to_rgb", False),
+            pad_size_divisor=preprocessor.get("pad_size_divisor", 1),
+            pad_value=preprocessor.get("pad_value", 0),
+            with_text=with_text,
+        )
+
+    def target_size(self, h: int, w: int) -> Tuple[int, int]:
+        """Size (h, w) of a (h, w) frame after the resize, as in mmcv."""
+        return rescaled_shape(h, w, self.scale, self.keep_ratio)
+
+    def _pad_size(self, h: int, w: int) -> Tuple[int, int]:
+        divisor = self.pad_size_divisor
+        return -(-h // divisor) * divisor, -(-w // divisor) * divisor
+
+    def _transform(self, frame: torch.Tensor, device: torch.device) -> torch.Tensor:
+        """(H, W, C) uint8 frame to the (1, C, h, w) normalized input."""
+        h, w = frame.shape[:2]
+        # NCHW view of the HWC frame, i.e. channels last
+        x = frame.to(device, non_blocking=True).permute(2, 0, 1)[None]
+        uint8_resize = self.uint8_resize
+        if uint8_resize is None:
+            uint8_resize = x.device.type == "cpu"
+        if not uint8_resize:
+            x = x.float()
+        new_h, new_w = self.target_size(h, w)
+        if (new_h, new_w) != (h, w):
+            x = F.interpolate(x, size=(new_h, new_w), mode="bilinear", align_corners=False)
+        if self.bgr_to_rgb:
+            x = x.flip(1)
+        if self.norm_scale is None:
+            return x.float()
+        return torch.addcmul(
+            self.norm_bias.to(x.device), x, self.norm_scale.to(x.device)
+        )
+
+    def __call__(
+        self,
+        frames: FramesType,
+        frame_ids: Union[int, Sequence[int]],
+        video_len: int,
+        device: Union[str, torch.device] = "cpu",
+        text: Optional[str] = None,
+        custom_entities: bool = False,
+    ) -> dict:
+        """Preprocess frames for ``MASA.predict`` (one frame) or
+        ``MASA.predict_batch``.
+
+        Args:
+            frames (ndarray | Tensor | Sequence): One (H, W, C) uint8 BGR
+                frame, a sequence of them, or a (K, H, W, C) uint8 tensor,
+                pinned to copy it asynchronously to the GPU.
+            frame_ids (int | Sequence[int]): Frame id of every frame.
+            video_len (int): Length of the video.
+            device (str | torch.device): Device of the model.
+                Defaults to 'cpu'.
+            text (str, optional): Text prompt. Defaults to None.
+            custom_entities (bool): Whether the prompt names custom
+                entities. Defaults to False.
+
+        Returns:
+            dict: ``inputs``, the (K, 1, C, H, W) padded batch, and
+            ``data_samples``, one :obj:`TrackDataSample` per frame.
+        """
+        if isinstance(frames, np.ndarray) and frames.ndim == 3:
+            frames = [frames]
+        elif isinstance(frames, torch.Tensor):
+            frames = list(frames.unbind(0)) if frames.dim() == 4 else [frames]
+        if isinstance(frame_ids, int):
+            frame_ids = [frame_ids]
+        assert len(frames) == len(frame_ids)
+
+        inputs: List[torch.Tensor] = []
+        data_samples = []
+        for frame, frame_id in zip(frames, frame_ids):
+            if isinstance(frame, np.ndarray):
+                frame = torch.from_numpy(frame)
+            x = self._transform(frame, device)
+            inputs.append(x)
+
+            det_data_sample = DetDataSample()
+            det_data_sample.gt_instances = InstanceData()
+            det_data_sample.ignored_instances = InstanceData()
+            h, w = frame.shape[:2]
+            new_h, new_w = x.shape[-2:]
+            metainfo = dict(
+                img_id=frame_id + 1,
+                ori_shape=(h, w),
+                img_shape=(new_h, new_w),
+                scale_factor=(new_w / w, new_h / h),
+                frame_id=frame_id,
+                ori_video_length=video_len,
+                pad_shape=self._pad_size(new_h, new_w),
+            )
+            if self.with_text and text is not None:
+                metainfo.update(text=text, custom_entities=custom_entities)
+            det_data_sample.set_metainfo(metainfo)
+            track_data_sample = TrackDataSample()
+            track_data_sample.video_data_samples = [det_data_sample]
+            data_samples.append(track_data_sample)
+
+        pad_h, pad_w = self._pad_size(
+            max(x.size(-2) for x in inputs), max(x.size(-1) for x in inputs)
+        )
+        batch = inputs[0].new_full(
+            (len(inputs), 1, inputs[0].size(1), pad_h, pad_w), self.pad_value
+        )
+        for i, x in enumerate(inputs):
+            batch[i, 0, :, : x.size(-2), : x.size(-1)] = x[0]
+        for track_data_sample in data_samples:
+            track_data_sample[0].set_metainfo(dict(batch_input_shape=(pad_h, pad_w)))
+        return dict(inputs=batch, data_samples=data_samples)
@@ -0,0 +1,265 @@
+import queue
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from mmdet.utils import ConfigType
+
+from .tensor_preprocessor import get_inference_resize, rescaled_shape
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+def _resize(frame: np.ndarray, size: Optional[Tuple[int, int]]) -> np.ndarray:
+    """Bilinear resize of a uint8 frame to ``size`` (w, h), as the ``Resize``
+    transform of the test pipeline."""
+    if size is None or (frame.shape[1], frame.shape[0]) == size:
+        return frame
+    return cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR)
+
+
+class _OpenCVDecoder:
+    """Frames of a video file decoded by OpenCV."""
+
+    def __init__(self, path: str, threads: int = 0) -> None:
+        self.path = path
+        self.threads = threads
+        cap = self._open()
+        self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        self.frame_cnt = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+    def _open(self) -> cv2.VideoCapture:
+        if self.threads > 0 and hasattr(cv2, "CAP_PROP_N_THREADS"):
+            cap = cv2.VideoCapture(
+                self.path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, self.threads]
+            )
+        else:
+            cap = cv2.VideoCapture(self.path)
+        if not cap.isOpened():
+            raise IOError(f"Failed to open video: {self.path}")
+        return cap
+
+    def decode(self, start: int, size: Optional[Tuple[int, int]]) -> Iterator[np.ndarray]:
+        cap = self._open()
+        try:
+            if start > 0:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield _resize(frame, size)
+        finally:
+            cap.release()
+
+
+class _PyAVDecoder:
+    """Frames of a video file decoded by FFmpeg through PyAV, with frame
+    threading."""
+
+    def __init__(self, path: str, threads: int = 0) -> None:
+        self.path = path
+        self.threads = threads
+        with av.open(path) as container:
+            stream = container.streams.video[0]
+            self.width = stream.codec_context.width
+            self.height = stream.codec_context.height
+            self.fps = float(stream.average_rate or stream.guessed_rate or 0)
+            self.frame_cnt = stream.frames
+            if self.frame_cnt == 0 and stream.duration is not None:
+                self.frame_cnt = int(round(stream.duration * stream.time_base * self.fps))
+
+    def decode(self, start: int, size: Optional[Tuple[int, int]]) -> Iterator[np.ndarray]:
+        with av.open(self.path) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            if self.threads > 0:
+                stream.thread_count = self.threads
+            start_time = stream.start_time or 0
+            frame_idx = 0
+            if start > 0:
+                # seek to the keyframe before ``start``, then decode up to it
+                container.seek(
+                    start_time + int(start / self.fps / stream.time_base), stream=stream
+                )
+                frame_idx = None
+            for frame in container.decode(stream):
+                if frame_idx is None:
+                    frame_idx = int(round((frame.pts - start_time) * stream.time_base * self.fps))
+                if frame_idx >= start:
+                    # the bilinear filter of swscale does not match the one
+                    # of the pipeline, the BGR frame is resized by OpenCV
+                    yield _resize(frame.to_ndarray(format="bgr24"), size)
+                frame_idx += 1
+
+
+class VideoSource:
+    """Frames of a video file for the inference, decoded ahead in a
+    background thread, optionally at the input size of the model.
+
+    With ``scale`` the frames are resized when they are decoded, to the size
+    the ``Resize`` transform of the test pipeline would give them, and the
+    pipeline then has nothing left to resize. The boxes are mapped back to
+    the resolution of the video by passing :attr:`ori_shape` to
+    :func:`inference_masa`. The frames for rendering need the original
+    resolution, do not set ``scale`` for them.
+
+    The uint8 frames are resized bilinearly like the ``Resize`` transform,
+    within one intensity level of its float resize. The 'pyav' backend
+    decodes with the frame threads of FFmpeg, 'opencv' with the OpenCV
+    FFmpeg backend. 'auto' takes PyAV when it is installed.
+
+    Args:
+        path (str): Path of the video file.
+        scale (tuple[int, int], optional): ``scale`` of the ``Resize``
+            transform to decode at. Defaults to None, the original size.
+        keep_ratio (bool): ``keep_ratio`` of the ``Resize`` transform.
+            Defaults to True.
+        backend (str): 'auto', 'pyav' or 'opencv'. Defaults to 'auto'.
+        threads (int): Decoding threads, 0 lets the backend choose.
+            Defaults to 0.
+        prefetch (int): Number of frames decoded ahead, 0 decodes in the
+            calling thread. Defaults to 8.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        scale: Optional[Tuple[int, int]] = None,
+        keep_ratio: bool = True,
+        backend: str = "auto",
+        threads: int = 0,
+        prefetch: int = 8,
+    ) -> None:
+        assert backend in ("auto", "pyav", "opencv"), f"unknown backend {backend}"
+        if backend == "auto":
+            backend = "opencv" if av is None else "pyav"
+        if backend == "pyav":
+            if av is None:
+                raise RuntimeError("PyAV is not installed, please install it by: pip install av.")
+            self._decoder = _PyAVDecoder(path, threads)
+        else:
+            self._decoder = _OpenCVDecoder(path, threads)
+        self.path = path
+        self.backend = backend
+        self.prefetch = prefetch
+        self.decode_shape = self.ori_shape
+        if scale is not None:
+            self.decode_shape = rescaled_shape(self.height, self.width, scale, keep_ratio)
+
+    @classmethod
+    def from_config(cls, path: str, cfg: ConfigType, **kwargs) -> "VideoSource":
+        """Decode at the input size of the ``inference_pipeline`` of a MASA
+        config."""
+        resize = get_inference_resize(cfg)
+        if resize is None or resize.get("scale") is None:
+            raise ValueError("The inference pipeline has no Resize scale to decode at")
+        return cls(path, scale=resize["scale"], keep_ratio=resize.get("keep_ratio", False), **kwargs)
+
+    @property
+    def width(self) -> int:
+        """Width of the video."""
+        return self._decoder.width
+
+    @property
+    def height(self) -> int:
+        """Height of the video."""
+        return self._decoder.height
+
+    @property
+    def fps(self) -> float:
+        """Frame rate of the video."""
+        return self._decoder.fps
+
+    @property
+    def frame_cnt(self) -> int:
+        """Number of frames in the video."""
+        return self._decoder.frame_cnt
+
+    @property
+    def ori_shape(self) -> Tuple[int, int]:
+        """Shape (h, w) of the video."""
+        return self.height, self.width
+
+    def __len__(self) -> int:
+        return self.frame_cnt
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return self.frames()
+
+    def frames(self, start: int = 0, end: Optional[int] = None) -> Iterator[np.ndarray]:
+        """Decoded BGR frames from ``start`` to ``end`` (excluded, or to the
+        end of the video), of shape :attr:`decode_shape`."""
+        size = None
+        if self.decode_shape != self.ori_shape:
+            size = (self.decode_shape[1], self.decode_shape[0])
+        frames = self._decoder.decode(start, size)
+        if end is not None:
+            frames = (frame for _, frame in zip(range(start, end), frames))
+        if self.prefetch <= 0:
+            return frames
+        return self._prefetch(frames)
+
+    def batches(
+        self, batch_size: int, start: int = 0, end: Optional[int] = None
+    ) -> Iterator[List[np.ndarray]]:
+        """Lists of ``batch_size`` consecutive frames, e.g. for
+        :func:`inference_masa_batch`, the last one may be shorter."""
+        batch = []
+        for frame in self.frames(start, end):
+            batch.append(frame)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _prefetch(self, frames: Iterator[np.ndarray]) -> Iterator[np.ndarray]:
+        frame_queue = queue.Queue(maxsize=self.prefetch)
+        stop_event = threading.Event()
+        errors = []
+        done = object()
+
+        def decode():
+            try:
+                for frame in frames:
+                    while not stop_event.is_set():
+                        try:
+                            frame_queue.put(frame, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop_event.is_set():
+                        return
+            except Exception as e:
+                errors.append(e)
+            finally:
+                frames.close()
+                frame_queue.put(done)
+
+        decoder = threading.Thread(target=decode, daemon=True)
+        decoder.start()
+        try:
+            while True:
+                frame = frame_queue.get()
+                if frame is done:
+                    break
+                yield frame
+        finally:
+            # the consumer may stop early, let the decoder thread exit
+            stop_event.set()
+            while decoder.is_alive():
+                try:
+                    frame_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            decoder.join()
+        if errors:
+            raise errors[0]
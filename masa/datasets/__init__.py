@@ -1,12 +1,5 @@
 # Copyright (c) Tencent Inc. All rights reserved.
-from .bdd_masa_dataset import BDDVideoDataset
-from .dataset_wrappers import SeqMultiImageMixDataset
-from .evaluation import *  # NOQA
-from .masa_dataset import MASADataset
-from .pipelines import *  # NOQA
-from .rsconcat_dataset import RandomSampleConcatDataset
-from .tao_masa_dataset import Taov1Dataset, Taov05Dataset
-from .utils import yolow_collate
+from ..registry import lazy_getattr
 
 __all__ = [
     "yolow_collate",
@@ -17,3 +10,7 @@ __all__ = [
     "Taov1Dataset",
     "BDDVideoDataset",
 ]
+
+
+def __getattr__(name):
+    return lazy_getattr(__name__, name)
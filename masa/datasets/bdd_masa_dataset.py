@@ -6,7 +6,7 @@ from mmdet.datasets import BaseVideoDataset
 from mmdet.registry import DATASETS
 
 
-@DATASETS.register_module()
+@DATASETS.register_module(force=True)
 class BDDVideoDataset(BaseVideoDataset):
     """Dataset for TAO benchmark.
     """
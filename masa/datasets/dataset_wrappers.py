@@ -276,7 +276,7 @@ class SeqMultiImageMixDataset:
         return np.random.choice(self.indices)
 
 
-@DATASETS.register_module()
+@DATASETS.register_module(force=True)
 class SeqRandomMultiImageVideoMixDataset(SeqMultiImageMixDataset):
     def __init__(
         self, video_pipeline: Sequence[str], video_sample_ratio=0.5, *args, **kwargs
@@ -65,7 +65,7 @@ def get_tmpdir() -> str:
     return tmpdir
 
 
-@METRICS.register_module()
+@METRICS.register_module(force=True)
 class BDDTETAMetric(BaseVideoMetric):
     """Evaluation metrics for MOT Challenge.
 
@@ -43,7 +43,7 @@ def get_tmpdir() -> str:
     return tmpdir
 
 
-@METRICS.register_module()
+@METRICS.register_module(force=True)
 class TaoTETAMetric(BaseVideoMetric):
     """Evaluation metrics for TAO TETA and open-vocabulary MOT benchmark.
 
@@ -14,7 +14,7 @@ from mmengine.fileio import get_local_path
 from mmengine.logging import print_log
 
 
-@DATASETS.register_module()
+@DATASETS.register_module(force=True)
 class MASADataset(BaseDetDataset):
     """Dataset for COCO."""
 
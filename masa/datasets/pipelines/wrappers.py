@@ -44,7 +44,7 @@ def imdenormalize(img, mean, std, to_bgr=True):
     return img
 
 
-@TRANSFORMS.register_module()
+@TRANSFORMS.register_module(force=True)
 class MasaTransformBroadcaster(KeyMapper):
     """A transform wrapper to apply the wrapped transforms to multiple data
     items. For example, apply Resize to multiple images.
@@ -10,7 +10,7 @@ from torch.utils.data import Dataset
 from torch.utils.data.dataset import ConcatDataset as _ConcatDataset
 
 
-@DATASETS.register_module()
+@DATASETS.register_module(force=True)
 class RandomSampleConcatDataset(_ConcatDataset):
     def __init__(
         self,
@@ -85,7 +85,7 @@ class RandomSampleConcatDataset(_ConcatDataset):
         return chosen_dataset[sample_idx]
 
 
-@DATASETS.register_module()
+@DATASETS.register_module(force=True)
 class RandomSampleJointVideoConcatDataset(_ConcatDataset):
     def __init__(
         self,
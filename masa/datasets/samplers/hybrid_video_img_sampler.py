@@ -15,7 +15,7 @@ from torch.utils.data.dataset import ConcatDataset as _ConcatDataset
 from ..dataset_wrappers import SeqMultiImageMixDataset
 
 
-@DATA_SAMPLERS.register_module()
+@DATA_SAMPLERS.register_module(force=True)
 class HybridVideoImgSampler(Sampler):
     """Sampler that providing image-level sampling outputs for video datasets
     in tracking tasks. It could be both used in both distributed and
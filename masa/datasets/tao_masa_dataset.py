@@ -7,7 +7,7 @@ from mmdet.datasets import BaseVideoDataset, LVISV1Dataset, LVISV05Dataset
 from mmdet.registry import DATASETS
 
 
-@DATASETS.register_module()
+@DATASETS.register_module(force=True)
 class Taov05Dataset(BaseVideoDataset):
     """Dataset for TAO benchmark.
 
@@ -92,7 +92,7 @@ class Taov05Dataset(BaseVideoDataset):
             return data
 
 
-@DATASETS.register_module()
+@DATASETS.register_module(force=True)
 class Taov1Dataset(Taov05Dataset):
     """Dataset for TAO benchmark.
 
@@ -5,7 +5,7 @@ import torch
 from mmengine.dataset import COLLATE_FUNCTIONS
 
 
-@COLLATE_FUNCTIONS.register_module()
+@COLLATE_FUNCTIONS.register_module(force=True)
 def yolow_collate(data_batch: Sequence, use_ms_training: bool = False) -> dict:
     """Rewrite collate_fn to get faster training speed.
 
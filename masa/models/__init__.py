@@ -1,7 +1,7 @@
-from .detectors import *  # noqa
-from .losses import *  # noqa
-from .mot import *  # noqa
-from .necks import *  # noqa
-from .roi_heads import MasaTrackHead
-from .sam import *
-from .tracker import *
+from ..registry import lazy_getattr, lazy_names
+
+__all__ = lazy_names(__name__)
+
+
+def __getattr__(name):
+    return lazy_getattr(__name__, name)
@@ -1,6 +1,7 @@
-from .detic_masa import DeticMasa
-from .gdino_masa import GroundingDINOMasa
-from .grounding_dino import GroundingDINO
-from .sam_masa import SamMasa
+from ...registry import lazy_getattr, lazy_names
 
-__all__ = ["GroundingDINO", "DeticMasa", "GroundingDINOMasa", "SamMasa"]
+__all__ = lazy_names(__name__)
+
+
+def __getattr__(name):
+    return lazy_getattr(__name__, name)
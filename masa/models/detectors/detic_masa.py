@@ -16,6 +16,8 @@ from torch import Tensor
 
 from projects.Detic_new.detic import Detic
 
+from .prompt_cache import PROMPT_CACHE
+
 
 def encode_mask_results(mask_results):
     """Encode bitmap mask to RLE code.
@@ -81,6 +83,19 @@ class CLIPTextEncoder(nn.Module):
         return text_features
 
 
+CLIP_MODEL_NAME = "ViT-B/32"
+_text_encoder = None
+
+
+def get_text_encoder():
+    """Build the CLIP text encoder once per process."""
+    global _text_encoder
+    if _text_encoder is None:
+        _text_encoder = CLIPTextEncoder(CLIP_MODEL_NAME)
+        _text_encoder.eval()
+    return _text_encoder
+
+
 def get_class_weight(original_caption, prompt_prefix="a "):
     if isinstance(original_caption, str):
         if original_caption == "coco":
@@ -113,11 +128,17 @@ def get_class_weight(original_caption, prompt_prefix="a "):
     else:
         class_names = list(original_caption)
 
-    text_encoder = CLIPTextEncoder()
-    text_encoder.eval()
-    texts = [prompt_prefix + x for x in class_names]
-    print_log(f"Computing text embeddings for {len(class_names)} classes.")
-    embeddings = text_encoder(texts).detach().permute(1, 0).contiguous().cpu()
+    key = PROMPT_CACHE.make_key(
+        "CLIPTextEncoder", CLIP_MODEL_NAME, tuple(class_names), prompt_prefix
+    )
+    embeddings = PROMPT_CACHE.get(key)
+    if embeddings is None:
+        text_encoder = get_text_encoder()
+        texts = [prompt_prefix + x for x in class_names]
+        print_log(f"Computing text embeddings for {len(class_names)} classes.")
+        with torch.no_grad():
+            embeddings = text_encoder(texts).detach().permute(1, 0).contiguous().cpu()
+        PROMPT_CACHE.put(key, embeddings)
     return class_names, embeddings
 
 
@@ -144,7 +165,7 @@ def reset_cls_layer_weight(roi_head, weight):
         bbox_head.fc_cls.zs_weight = zs_weight
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class DeticMasa(Detic):
     def predict(
         self,
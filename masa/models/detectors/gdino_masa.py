@@ -3,17 +3,18 @@ Author: Siyuan Li
 Licensed: Apache-2.0 License
 """
 
-import copy
 import logging
 import re
 import warnings
 
 from mmdet.registry import MODELS
+from mmdet.structures import DetDataSample
 from mmengine.logging import MMLogger, print_log
 from mmengine.model.weight_init import (PretrainedInit, initialize,
                                         update_init_info)
 
 from .grounding_dino import GroundingDINO
+from .prompt_cache import PROMPT_CACHE, model_fingerprint
 
 
 def clean_label_name(name: str) -> str:
@@ -37,7 +38,7 @@ def chunks(lst: list, n: int) -> list:
     return all_
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class GroundingDINOMasa(GroundingDINO):
     """Implementation of `Grounding DINO: Marrying DINO with Grounded Pre-
     Training for Open-Set Object Detection.
@@ -46,15 +47,23 @@ class GroundingDINOMasa(GroundingDINO):
 
     Code is modified from the `official github repo
     <https://github.com/IDEA-Research/GroundingDINO>`_.
+
+    Args:
+        use_prompt_cache (bool): Whether to keep the text features of the
+            prompts in the shared :class:`PromptEmbeddingCache`, so switching
+            back to a known prompt does not run the language model again.
+            Defaults to True.
     """
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, *args, use_prompt_cache: bool = True, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
         self.track_text_prompt = None
         self.track_text_dict = None
         self.token_positive_maps = None
         self.track_entities = None
+        self.use_prompt_cache = use_prompt_cache
+        self._prompt_cache_id = None
 
     def init_weights(self) -> None:
         """Initialize weights for Transformer and other components."""
@@ -92,6 +101,127 @@ class GroundingDINOMasa(GroundingDINO):
 
         initialize(self, pretrained_cfg)
 
+    @property
+    def prompt_cache_id(self) -> str:
+        """str: Id of the text branch weights used in the prompt cache keys."""
+        if self._prompt_cache_id is None:
+            self._prompt_cache_id = model_fingerprint(self.language_model)
+        return self._prompt_cache_id
+
+    def get_prompt_features(
+        self,
+        text_prompt,
+        custom_entities: bool = False,
+        enhanced_text_prompt=None,
+        tokens_positive=None,
+    ) -> dict:
+        """Get the positive maps, the entities and the language model
+        features of one prompt, through the shared prompt cache.
+
+        Returns:
+            dict: ``token_positive_map``, ``text_prompt`` and ``entities`` as
+            returned by :meth:`get_tokens_positive_and_prompts`, and
+            ``text_dict``, the language model output for the prompt with a
+            batch size of 1 (one batch entry per chunk for chunked prompts).
+        """
+        key = None
+        if self.use_prompt_cache:
+            key = PROMPT_CACHE.make_key(
+                self.__class__.__name__,
+                self.prompt_cache_id,
+                text_prompt,
+                custom_entities,
+                enhanced_text_prompt,
+                tokens_positive,
+                self.test_cfg.get("chunked_size", -1),
+            )
+            prompt_features = PROMPT_CACHE.get(
+                key, device=self.text_feat_map.weight.device
+            )
+            if prompt_features is not None:
+                return prompt_features
+
+        (
+            token_positive_map,
+            processed_prompt,
+            _,
+            entities,
+        ) = self.get_tokens_positive_and_prompts(
+            text_prompt, custom_entities, enhanced_text_prompt, tokens_positive
+        )
+        if isinstance(processed_prompt, list):
+            # the chunks are stacked along the batch dimension
+            text_dict = self.language_model(processed_prompt)
+        else:
+            text_dict = self.language_model([processed_prompt])
+        prompt_features = dict(
+            token_positive_map=token_positive_map,
+            text_prompt=processed_prompt,
+            entities=entities,
+            text_dict=text_dict,
+        )
+        if key is not None:
+            PROMPT_CACHE.put(key, prompt_features)
+        return prompt_features
+
+    def predict_chunked(
+        self,
+        visual_feats,
+        text_dict: dict,
+        token_positive_maps: list,
+        batch_data_samples,
+        rescale: bool = True,
+    ) -> list:
+        """Predict with a chunked text prompt.
+
+        The chunks of the prompt are stacked along the batch dimension of
+        ``text_dict`` and run through the transformer together with the
+        visual features of one frame, which are broadcast rather than copied.
+        ``test_cfg.chunked_batch_size`` limits how many chunks share a pass.
+
+        Returns:
+            list[:obj:`InstanceData`]: The detections of every frame, with the
+            labels of all the chunks in one label space.
+        """
+        num_chunks = len(token_positive_maps)
+        group_size = self.test_cfg.get("chunked_batch_size", -1)
+        if group_size <= 0:
+            group_size = num_chunks
+        label_offsets = [0]
+        for token_positive_map in token_positive_maps[:-1]:
+            label_offsets.append(label_offsets[-1] + len(token_positive_map))
+
+        results_list = []
+        for i, data_sample in enumerate(batch_data_samples):
+            frame_feats = [feat[i : i + 1] for feat in visual_feats]
+            chunk_results = []
+            for start in range(0, num_chunks, group_size):
+                end = min(start + group_size, num_chunks)
+                chunk_data_samples = []
+                for c in range(start, end):
+                    chunk_data_sample = DetDataSample(metainfo=data_sample.metainfo)
+                    chunk_data_sample.token_positive_map = token_positive_maps[c]
+                    chunk_data_samples.append(chunk_data_sample)
+                chunk_text_dict = {k: v[start:end] for k, v in text_dict.items()}
+                chunk_feats = [
+                    feat.expand(end - start, *feat.shape[1:]) for feat in frame_feats
+                ]
+
+                head_inputs_dict = self.forward_transformer(
+                    chunk_feats, chunk_text_dict, chunk_data_samples
+                )
+                chunk_preds = self.bbox_head.predict(
+                    **head_inputs_dict,
+                    rescale=rescale,
+                    batch_data_samples=chunk_data_samples,
+                )
+                for c, pred_instances in zip(range(start, end), chunk_preds):
+                    if len(pred_instances) > 0:
+                        pred_instances.labels += label_offsets[c]
+                    chunk_results.append(pred_instances)
+            results_list.append(chunk_results[0].cat(chunk_results))
+        return results_list
+
     def predict(
         self, batch_inputs, detection_features, batch_data_samples, rescale: bool = True
     ):
@@ -114,44 +244,28 @@ class GroundingDINOMasa(GroundingDINO):
         else:
             custom_entities = False
 
-        if self.track_text_dict is not None and self.track_text_prompt == text_prompts:
-            # text feature map layer
-
-            is_rec_tasks = []
-            for i, data_samples in enumerate(batch_data_samples):
-                if self.token_positive_maps[i] is not None:
-                    is_rec_tasks.append(False)
-                else:
-                    is_rec_tasks.append(True)
-                data_samples.token_positive_map = self.token_positive_maps[i]
-
-            visual_feats = detection_features
-
-            head_inputs_dict = self.forward_transformer(
-                visual_feats, self.track_text_dict, batch_data_samples
-            )
-            results_list = self.bbox_head.predict(
-                **head_inputs_dict,
-                rescale=rescale,
-                batch_data_samples=batch_data_samples,
-            )
-
-            entities = self.track_entities
-
-        else:
+        if self.track_text_dict is None or self.track_text_prompt != text_prompts:
             self.track_text_prompt = text_prompts
 
-            if len(text_prompts) == 1:
+            shared_text_dict = None
+            if all(text_prompt == text_prompts[0] for text_prompt in text_prompts):
                 # All the text prompts are the same,
                 # so there is no need to calculate them multiple times.
+                prompt_features = self.get_prompt_features(
+                    text_prompts[0],
+                    custom_entities,
+                    enhanced_text_prompts[0],
+                    tokens_positives[0],
+                )
                 _positive_maps_and_prompts = [
-                    self.get_tokens_positive_and_prompts(
-                        text_prompts[0],
-                        custom_entities,
-                        enhanced_text_prompts[0],
-                        tokens_positives[0],
+                    (
+                        prompt_features["token_positive_map"],
+                        prompt_features["text_prompt"],
+                        None,
+                        prompt_features["entities"],
                     )
                 ] * len(batch_inputs)
+                shared_text_dict = prompt_features["text_dict"]
             else:
                 _positive_maps_and_prompts = [
                     self.get_tokens_positive_and_prompts(
@@ -168,73 +282,63 @@ class GroundingDINOMasa(GroundingDINO):
                 *_positive_maps_and_prompts
             )
 
-            self.token_positive_maps = token_positive_maps
-            self.track_entities = entities
-
-            # image feature extraction
-            visual_feats = detection_features
-
             if isinstance(text_prompts[0], list):
-                # chunked text prompts, only bs=1 is supported
-                assert len(batch_inputs) == 1
-                count = 0
-                results_list = []
-
-                entities = [[item for lst in entities[0] for item in lst]]
-
-                for b in range(len(text_prompts[0])):
-                    text_prompts_once = [text_prompts[0][b]]
-                    token_positive_maps_once = token_positive_maps[0][b]
-                    text_dict = self.language_model(text_prompts_once)
-                    # text feature map layer
-                    if self.text_feat_map is not None:
-                        text_dict["embedded"] = self.text_feat_map(
-                            text_dict["embedded"]
-                        )
-
-                    batch_data_samples[0].token_positive_map = token_positive_maps_once
-
-                    head_inputs_dict = self.forward_transformer(
-                        copy.deepcopy(visual_feats), text_dict, batch_data_samples
-                    )
-                    pred_instances = self.bbox_head.predict(
-                        **head_inputs_dict,
-                        rescale=rescale,
-                        batch_data_samples=batch_data_samples,
-                    )[0]
-
-                    if len(pred_instances) > 0:
-                        pred_instances.labels += count
-                    count += len(token_positive_maps_once)
-                    results_list.append(pred_instances)
-                results_list = [results_list[0].cat(results_list)]
-                is_rec_tasks = [False] * len(results_list)
+                # chunked text prompts, all the chunks are encoded as one
+                # text batch which is shared by the frames
+                assert (
+                    shared_text_dict is not None
+                ), "Chunked text prompts must be the same inside a batch."
+                text_dict = dict(shared_text_dict)
+                entities = [[item for lst in entities[0] for item in lst]] * len(
+                    batch_inputs
+                )
+            elif shared_text_dict is not None:
+                # frames of one video share the prompt, so encode it once
+                # and repeat it along the batch dimension
+                text_dict = {
+                    k: v.repeat(len(text_prompts), *([1] * (v.dim() - 1)))
+                    for k, v in shared_text_dict.items()
+                }
             else:
                 # extract text feats
                 text_dict = self.language_model(list(text_prompts))
-                # text feature map layer
-                if self.text_feat_map is not None:
-                    text_dict["embedded"] = self.text_feat_map(text_dict["embedded"])
-
-                is_rec_tasks = []
-                for i, data_samples in enumerate(batch_data_samples):
-                    if token_positive_maps[i] is not None:
-                        is_rec_tasks.append(False)
-                    else:
-                        is_rec_tasks.append(True)
-                    data_samples.token_positive_map = token_positive_maps[i]
+            # text feature map layer
+            if self.text_feat_map is not None:
+                text_dict["embedded"] = self.text_feat_map(text_dict["embedded"])
 
-                if self.track_text_dict is None:
-                    self.track_text_dict = text_dict
+            self.track_text_dict = text_dict
+            self.token_positive_maps = token_positive_maps
+            self.track_entities = entities
 
-                head_inputs_dict = self.forward_transformer(
-                    visual_feats, text_dict, batch_data_samples
-                )
-                results_list = self.bbox_head.predict(
-                    **head_inputs_dict,
-                    rescale=rescale,
-                    batch_data_samples=batch_data_samples,
-                )
+        entities = self.track_entities
+        visual_feats = detection_features
+
+        if isinstance(self.token_positive_maps[0], list):
+            results_list = self.predict_chunked(
+                visual_feats,
+                self.track_text_dict,
+                self.token_positive_maps[0],
+                batch_data_samples,
+                rescale=rescale,
+            )
+            is_rec_tasks = [False] * len(results_list)
+        else:
+            is_rec_tasks = []
+            for i, data_samples in enumerate(batch_data_samples):
+                if self.token_positive_maps[i] is not None:
+                    is_rec_tasks.append(False)
+                else:
+                    is_rec_tasks.append(True)
+                data_samples.token_positive_map = self.token_positive_maps[i]
+
+            head_inputs_dict = self.forward_transformer(
+                visual_feats, self.track_text_dict, batch_data_samples
+            )
+            results_list = self.bbox_head.predict(
+                **head_inputs_dict,
+                rescale=rescale,
+                batch_data_samples=batch_data_samples,
+            )
 
         for data_sample, pred_instances, entity, is_rec_task in zip(
             batch_data_samples, results_list, entities, is_rec_tasks
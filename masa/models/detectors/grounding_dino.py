@@ -1,6 +1,8 @@
 import copy
+import os
 import re
 import warnings
+from functools import lru_cache
 from typing import Dict, Optional, Tuple, Union
 
 import torch
@@ -17,18 +19,65 @@ from mmdet.utils import ConfigType
 from mmengine.runner.amp import autocast
 from torch import Tensor
 
-try:
-    import os
+# Directory searched first for the nltk resources, and where the missing
+# ones are downloaded to. Set ``MASA_NLTK_OFFLINE=1`` on machines without
+# network access to fail fast instead of waiting for download timeouts.
+NLTK_DATA_DIR = os.environ.get("MASA_NLTK_DATA", os.path.expanduser("~/nltk_data"))
+NLTK_RESOURCES = (
+    "punkt",
+    "punkt_tab",
+    "averaged_perceptron_tagger",
+    "averaged_perceptron_tagger_eng",
+)
+NER_CACHE_SIZE = 256
 
-    import nltk
+_nltk = None
 
-    download_dir = os.path.expanduser("~/nltk_data")
-    nltk.download("punkt", download_dir=download_dir, quiet=True)
-    nltk.download("averaged_perceptron_tagger", download_dir=download_dir, quiet=True)
-except ImportError:
-    raise RuntimeError(
-        "nltk is not installed, please install it by: " "pip install nltk."
-    )
+
+def set_nltk_data_dir(path: str) -> None:
+    """Set the local directory of the nltk resources.
+
+    Must be called before the first caption is parsed.
+    """
+    global NLTK_DATA_DIR
+    NLTK_DATA_DIR = path
+
+
+def get_nltk():
+    """Import nltk and make sure its tokenizer and tagger are usable.
+
+    This only happens when a caption is parsed for the first time, so the
+    processes which never run NER (e.g. ``custom_entities=True``) neither
+    import nltk nor touch the network.
+    """
+    global _nltk
+    if _nltk is not None:
+        return _nltk
+    try:
+        import nltk
+    except ImportError:
+        raise RuntimeError(
+            "nltk is not installed, please install it by: " "pip install nltk."
+        )
+
+    if NLTK_DATA_DIR not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DATA_DIR)
+    try:
+        nltk.pos_tag(nltk.word_tokenize("a cat"))
+    except LookupError:
+        if os.environ.get("MASA_NLTK_OFFLINE", "0") == "1":
+            raise RuntimeError(
+                f"nltk resources are missing in {NLTK_DATA_DIR} and "
+                "MASA_NLTK_OFFLINE is set. Download them on a connected "
+                f"machine with nltk.download(name, download_dir=...) for "
+                f"{', '.join(NLTK_RESOURCES)}, or use custom_entities=True."
+            )
+        # the resource names differ between nltk versions, get all of them
+        for resource in NLTK_RESOURCES:
+            nltk.download(resource, download_dir=NLTK_DATA_DIR, quiet=True)
+        nltk.pos_tag(nltk.word_tokenize("a cat"))
+    _nltk = nltk
+    return _nltk
 
 
 def find_noun_phrases(caption: str) -> list:
@@ -43,17 +92,7 @@ def find_noun_phrases(caption: str) -> list:
         >>> caption = 'There is two cat and a remote in the picture'
         >>> find_noun_phrases(caption) # ['cat', 'a remote', 'the picture']
     """
-    # try:
-    #     import nltk
-    #     import os
-    #     # nltk.download('punkt', download_dir='~/nltk_data')
-    #     # nltk.download('averaged_perceptron_tagger', download_dir='~/nltk_data')
-    #     download_dir = os.path.expanduser('~/nltk_data')
-    #     nltk.download('punkt', download_dir=download_dir)
-    #     nltk.download('averaged_perceptron_tagger', download_dir=download_dir)
-    # except ImportError:
-    #     raise RuntimeError('nltk is not installed, please install it by: '
-    #                        'pip install nltk.')
+    nltk = get_nltk()
 
     caption = caption.lower()
     tokens = nltk.word_tokenize(caption)
@@ -113,6 +152,9 @@ def remove_punctuation(text: str) -> str:
 
 def run_ner(caption: str) -> Tuple[list, list]:
     """Run NER on a caption and return the tokens and noun phrases.
+
+    The results are cached per caption.
+
     Args:
         caption (str): The input caption.
 
@@ -121,6 +163,12 @@ def run_ner(caption: str) -> Tuple[list, list]:
             - tokens_positive (List): A list of token positions.
             - noun_phrases (List): A list of noun phrases.
     """
+    # return copies, so the callers can not alter the cached results
+    return copy.deepcopy(_run_ner(caption))
+
+
+@lru_cache(maxsize=NER_CACHE_SIZE)
+def _run_ner(caption: str) -> Tuple[list, list]:
     noun_phrases = find_noun_phrases(caption)
     noun_phrases = [remove_punctuation(phrase) for phrase in noun_phrases]
     noun_phrases = [phrase for phrase in noun_phrases if phrase != ""]
@@ -0,0 +1,111 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import torch
+from mmengine.logging import print_log
+
+
+def model_fingerprint(module: torch.nn.Module, num_values: int = 64) -> str:
+    """Compute a cheap fingerprint of the weights of a module.
+
+    A few values of every parameter are hashed, which is enough to tell apart
+    two checkpoints of the same architecture without reading all weights.
+    """
+    sha = hashlib.sha1(module.__class__.__name__.encode())
+    with torch.no_grad():
+        for name, param in module.named_parameters():
+            sha.update(name.encode())
+            sha.update(str(tuple(param.shape)).encode())
+            sha.update(param.detach().flatten()[:num_values].float().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def _to_device(value: Any, device) -> Any:
+    if isinstance(value, torch.Tensor):
+        return value.to(device)
+    if isinstance(value, dict):
+        return {k: _to_device(v, device) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_device(v, device) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_to_device(v, device) for v in value)
+    return value
+
+
+class PromptEmbeddingCache:
+    """LRU cache of text prompt embeddings shared by the open vocabulary
+    detectors, with an optional on-disk store.
+
+    Entries are keyed by ``(model id, prompt, custom_entities, ...)``. When
+    ``cache_dir`` is set, every new entry is also saved there, so prompts that
+    are used often are encoded once per machine rather than once per process.
+
+    Args:
+        capacity (int): Maximum number of entries kept in memory.
+            Defaults to 32.
+        cache_dir (str, optional): Directory of the on-disk store. Defaults
+            to the ``MASA_PROMPT_CACHE_DIR`` environment variable, or no
+            on-disk store if it is not set.
+    """
+
+    def __init__(self, capacity: int = 32, cache_dir: Optional[str] = None) -> None:
+        assert capacity > 0
+        self.capacity = capacity
+        if cache_dir is None:
+            cache_dir = os.environ.get("MASA_PROMPT_CACHE_DIR", None)
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(*parts: Hashable) -> str:
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".pth")
+
+    def get(self, key: str, device=None) -> Optional[Any]:
+        """Get an entry from memory, then from disk, or None on a miss."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            try:
+                value = torch.load(self._path(key), map_location="cpu", weights_only=True)
+            except Exception as e:
+                print_log(f"Ignoring unreadable prompt cache entry {key}: {e}")
+                return None
+            if device is not None:
+                value = _to_device(value, device)
+            self._put_memory(key, value)
+            return value
+        return None
+
+    def put(self, key: str, value: Any) -> None:
+        """Add an entry to memory and, if enabled, to the on-disk store."""
+        self._put_memory(key, value)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write then rename, so concurrent workers never read a partial file
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            torch.save(_to_device(value, "cpu"), tmp_path)
+            os.replace(tmp_path, self._path(key))
+
+    def _put_memory(self, key: str, value: Any) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Clear the in-memory entries, the on-disk store is kept."""
+        self._entries.clear()
+
+
+PROMPT_CACHE = PromptEmbeddingCache()
@@ -15,7 +15,7 @@ from ..sam.mask_decoder import MaskDecoder
 from ..sam.prompt_encoder import PromptEncoder
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class SamMasa(BaseModule):
     mask_threshold: float = 0.0
     image_format: str = "RGB"
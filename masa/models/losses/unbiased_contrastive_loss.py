@@ -46,7 +46,7 @@ def multi_pos_cross_entropy(
     return loss
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class UnbiasedContrastLoss(nn.Module):
     def __init__(self, reduction="mean", loss_weight=1.0):
         super(UnbiasedContrastLoss, self).__init__()
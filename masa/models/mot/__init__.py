@@ -1,3 +1,5 @@
+from .feature_store import FeatureStore
 from .masa import MASA
+from .public_dets import PublicDets
 
-__all__ = ["MASA"]
+__all__ = ["MASA", "FeatureStore", "PublicDets"]
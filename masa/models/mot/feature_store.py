@@ -0,0 +1,155 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+import json
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+from mmengine.logging import print_log
+from torch import Tensor
+
+
+class FeatureStore:
+    """On-disk store of the prompt independent features of the frames of
+    one video, for a unified MASA model.
+
+    For every frame it keeps the visual features given to the detector head
+    (the outputs of the detector neck) and the MASA adapter features given to
+    the tracker. Running the video again, e.g. with another text prompt or
+    other thresholds, then reads them instead of running the backbone.
+
+    Every frame is one file, read memory mapped. The store is bound to the
+    weights it was filled with by ``model_id`` (see
+    :attr:`MASA.feature_store_id`) and to the video by ``video_id`` (see
+    :meth:`video_identity`), it is cleared when either changes. A frame is
+    only read back for the same input shape. The frames are keyed by their
+    frame id, the store must see the frame ids of the whole video.
+
+    Args:
+        store_dir (str): Directory of the store of the video.
+        model_id (str): Id of the weights computing the features.
+        video_id (str): Id of the video the frames come from.
+        max_gb (float, optional): Size of the store, the frames past it are
+            not stored. Defaults to None, no limit.
+        dtype (str, optional): dtype the features are stored in. Defaults to
+            'float16', None keeps their dtype.
+    """
+
+    def __init__(
+        self,
+        store_dir: str,
+        model_id: str,
+        video_id: str,
+        max_gb: Optional[float] = None,
+        dtype: Optional[str] = "float16",
+    ) -> None:
+        self.store_dir = store_dir
+        self.max_bytes = None if max_gb is None else int(max_gb * 2**30)
+        self.dtype = None if dtype is None else getattr(torch, dtype)
+        self._full = False
+        os.makedirs(store_dir, exist_ok=True)
+
+        meta = dict(model_id=model_id, video_id=video_id, dtype=dtype)
+        meta_path = os.path.join(store_dir, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                if json.load(f) != meta:
+                    print_log(
+                        f"{store_dir} holds the features of other weights or another "
+                        "video, clearing it",
+                        logger="current",
+                    )
+                    for name in self._frame_files():
+                        os.remove(os.path.join(store_dir, name))
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+        self.num_bytes = sum(
+            os.path.getsize(os.path.join(store_dir, name)) for name in self._frame_files()
+        )
+
+    @staticmethod
+    def video_identity(path: str) -> str:
+        """Id of a video file for ``video_id``: its absolute path, size and
+        modification time."""
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _frame_files(self) -> List[str]:
+        return [name for name in os.listdir(self.store_dir) if name.startswith("frame_")]
+
+    def _path(self, frame_id: int) -> str:
+        return os.path.join(self.store_dir, f"frame_{frame_id:06d}.pth")
+
+    def __contains__(self, frame_id: int) -> bool:
+        return os.path.exists(self._path(frame_id))
+
+    def get(
+        self, frame_id: int, input_shape: Sequence[int], device=None
+    ) -> Optional[Tuple[List[Tensor], List[Tensor]]]:
+        """The detector and MASA adapter features of a frame, in the dtypes
+        they were computed in, or None if the frame is not stored for this
+        input shape."""
+        path = self._path(frame_id)
+        if not os.path.exists(path):
+            return None
+        entry = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        if tuple(entry["input_shape"]) != tuple(input_shape):
+            return None
+
+        def restore(feats, dtypes):
+            return [
+                feat.to(device=device, dtype=getattr(torch, dtype), non_blocking=True)
+                for feat, dtype in zip(feats, dtypes)
+            ]
+
+        return (
+            restore(entry["det_feats"], entry["det_dtypes"]),
+            restore(entry["masa_feats"], entry["masa_dtypes"]),
+        )
+
+    def put(
+        self,
+        frame_id: int,
+        input_shape: Sequence[int],
+        det_feats: Sequence[Tensor],
+        masa_feats: Sequence[Tensor],
+    ) -> bool:
+        """Store the features of a frame, batch size 1. Returns False when
+        the store is full."""
+
+        def stored(feats):
+            return [
+                feat.detach().to(device="cpu", dtype=self.dtype, copy=True)
+                for feat in feats
+            ]
+
+        size = sum(
+            feat.numel() * (feat.element_size() if self.dtype is None else self.dtype.itemsize)
+            for feat in list(det_feats) + list(masa_feats)
+        )
+        path = self._path(frame_id)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        if self.max_bytes is not None and self.num_bytes - old_size + size > self.max_bytes:
+            if not self._full:
+                print_log(
+                    f"{self.store_dir} is full, the frames from {frame_id} on are not stored",
+                    logger="current",
+                )
+                self._full = True
+            return False
+
+        entry = dict(
+            input_shape=tuple(input_shape),
+            det_feats=stored(det_feats),
+            det_dtypes=[str(feat.dtype).replace("torch.", "") for feat in det_feats],
+            masa_feats=stored(masa_feats),
+            masa_dtypes=[str(feat.dtype).replace("torch.", "") for feat in masa_feats],
+        )
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(entry, tmp_path)
+        os.replace(tmp_path, path)
+        self.num_bytes += os.path.getsize(path) - old_size
+        return True
@@ -4,8 +4,8 @@ Licensed: Apache-2.0 License
 """
 
 import copy
+import hashlib
 import os
-import pickle
 import warnings
 from typing import Dict, List, Optional, Tuple, Union
 
@@ -17,8 +17,12 @@ from mmdet.utils import OptConfigType, OptMultiConfig
 from mmengine.structures import InstanceData
 from torch import Tensor
 
+from ..detectors.prompt_cache import model_fingerprint
+from ..tracker.keyframe_scheduler import KeyframeScheduler
+from .public_dets import PublicDets
 
-@MODELS.register_module()
+
+@MODELS.register_module(force=True)
 class MASA(BaseMOTModel):
 
     """Matching Anything By Segmenting Anything.
@@ -48,9 +52,15 @@ class MASA(BaseMOTModel):
         given_dets (bool): If True, detections are given. Defaults to False.
         with_segm (bool): If True, segmentation masks are included. Defaults to False.
         end_pkl_name (str): Suffix for pickle file names. Defaults to '.pth'.
+        public_det_prefetch (int): Number of frames whose public detections
+            are loaded ahead, see :class:`PublicDets`. Defaults to 8.
         unified_backbone (bool): If True, use a unified backbone. Defaults to False.
         use_masa_backbone (bool): If True, use the MASA backbone. Defaults to False.
         benchmark (str): Benchmark for evaluation. Defaults to 'tao'.
+        keyframe_cfg (dict, optional): Arguments of a
+            :class:`KeyframeScheduler`. If set, :meth:`predict` only runs the
+            detector on the keyframes and propagates the tracks with their
+            velocity on the other frames. Defaults to None.
     """
 
     def __init__(
@@ -75,9 +85,11 @@ class MASA(BaseMOTModel):
         given_dets=False,
         with_segm=False,
         end_pkl_name=".pth",
+        public_det_prefetch: int = 8,
         unified_backbone=False,
         use_masa_backbone=False,
         benchmark="tao",
+        keyframe_cfg: Optional[dict] = None,
     ) -> None:
         super().__init__(data_preprocessor, init_cfg)
 
@@ -178,9 +190,19 @@ class MASA(BaseMOTModel):
         self.public_det_path = public_det_path
         self.with_segm = with_segm
         self.end_pkl_name = end_pkl_name
+        self.public_det_prefetch = public_det_prefetch
+        self._public_dets = None
         self.given_dets = given_dets
 
         self.unified_backbone = unified_backbone
+        self.keyframe_scheduler = (
+            None if keyframe_cfg is None else KeyframeScheduler(**keyframe_cfg)
+        )
+        # optional FeatureStore of the video, set by the inference tools
+        self.feature_store = None
+        self._feature_store_id = None
+        # optional DetArtifactWriter recording the inputs of the tracker
+        self.artifact_writer = None
 
     @property
     def with_rpn(self) -> bool:
@@ -192,6 +214,92 @@ class MASA(BaseMOTModel):
         """bool: whether the detector has a RoI head"""
         return hasattr(self, "roi_head") and self.roi_head is not None
 
+    @property
+    def public_dets(self) -> PublicDets:
+        """:class:`PublicDets`: The public detections of
+        ``public_det_path``."""
+        if self._public_dets is None:
+            self._public_dets = PublicDets(
+                self.public_det_path,
+                end_pkl_name=self.end_pkl_name,
+                with_masks=self.with_segm,
+                prefetch=self.public_det_prefetch,
+            )
+        return self._public_dets
+
+    def public_det_key(self, img_path: str) -> str:
+        """Key of the public detections of a frame in :attr:`public_dets`,
+        its path relative to the frames of the benchmark."""
+        if self.benchmark == "bdd":
+            img_path = img_path.replace("data/bdd/bdd100k/images/track/val/", "")
+        elif self.benchmark == "tao":
+            img_path = img_path.replace("data/tao/frames/", "")
+        return os.path.splitext(img_path)[0]
+
+    @property
+    def feature_store_id(self) -> str:
+        """str: Id of the weights computing the features kept by a
+        :class:`FeatureStore`."""
+        if self._feature_store_id is None:
+            modules = [self.detector.backbone, self.masa_adapter]
+            if self.detector.with_neck:
+                modules.append(self.detector.neck)
+            sha = hashlib.sha1()
+            for module in modules:
+                sha.update(model_fingerprint(module).encode())
+            self._feature_store_id = sha.hexdigest()
+        return self._feature_store_id
+
+    def extract_unified_feats(
+        self, imgs: Tensor, img_data_samples: list
+    ) -> Tuple[list, list]:
+        """The visual features of the detector head and the MASA adapter
+        features of frames with a unified backbone.
+
+        With a :attr:`feature_store`, the frames it holds are read from it
+        and the backbone only runs on the other ones, whose features are
+        stored.
+
+        Returns:
+            tuple[list[Tensor], list[Tensor]]: The detector features (the
+            neck outputs) and the MASA adapter features, batch first.
+        """
+        store = self.feature_store
+        if store is None:
+            x = self.detector.backbone(imgs)
+            x_m = self.masa_adapter(x)
+            if self.detector.with_neck:
+                x = self.detector.neck(x)
+            return x, x_m
+
+        input_shape = tuple(imgs.shape[1:])
+        cached = [
+            store.get(img_data_sample.frame_id, input_shape, device=imgs.device)
+            for img_data_sample in img_data_samples
+        ]
+        missing = [i for i, feats in enumerate(cached) if feats is None]
+        if missing:
+            x = self.detector.backbone(
+                imgs if len(missing) == len(cached) else imgs[missing]
+            )
+            x_m = self.masa_adapter(x)
+            if self.detector.with_neck:
+                x = self.detector.neck(x)
+            for j, i in enumerate(missing):
+                det_feats = [feat[j : j + 1] for feat in x]
+                masa_feats = [feat[j : j + 1] for feat in x_m]
+                store.put(
+                    img_data_samples[i].frame_id, input_shape, det_feats, masa_feats
+                )
+                cached[i] = (det_feats, masa_feats)
+        if len(missing) == len(cached):
+            return x, x_m
+        det_feats, masa_feats = zip(*cached)
+        return (
+            [torch.cat(level) for level in zip(*det_feats)],
+            [torch.cat(level) for level in zip(*masa_feats)],
+        )
+
     def predict(
         self,
         inputs: Tensor,
@@ -229,43 +337,22 @@ class MASA(BaseMOTModel):
 
         for frame_id in range(video_len):
             img_data_sample = track_data_sample[frame_id]
+            if not self.is_keyframe(img_data_sample.frame_id):
+                self.propagate(img_data_sample)
+                continue
             single_img = inputs[:, frame_id].contiguous()
             if self.load_public_dets:
-                img_name = img_data_sample.img_path
-                if img_name is not None:
-                    if self.benchmark == "bdd":
-                        pickle_name = img_name.replace(
-                            "data/bdd/bdd100k/images/track/val/", ""
-                        ).replace(".jpg", self.end_pkl_name)
-                    elif self.benchmark == "tao":
-                        pickle_name = img_name.replace("data/tao/frames/", "").replace(
-                            ".jpg", self.end_pkl_name
-                        )
-
-                path = os.path.join(self.public_det_path, pickle_name)
-                pickle_res = pickle.load(open(path, "rb"))
-                det_labels = torch.tensor(pickle_res["det_labels"]).to("cuda")
-                det_bboxes = (
-                    torch.tensor(pickle_res["det_bboxes"]).to("cuda").to(torch.float32)
+                dets = self.public_dets.get(
+                    self.public_det_key(img_data_sample.img_path)
                 )
-                if len(det_bboxes) != 0:
-                    if det_bboxes.size(1) == 4:
-                        det_bboxes = torch.cat(
-                            [
-                                det_bboxes,
-                                torch.ones(det_bboxes.size(0), 1).to(det_bboxes.device),
-                            ],
-                            dim=1,
-                        )
-
+                device = single_img.device
                 det_results = InstanceData()
-                det_results.labels = det_labels
-                det_results.bboxes = det_bboxes[:, :4]
-                det_results.scores = det_bboxes[:, 4]
+                det_results.labels = dets["labels"].to(device)
+                det_results.bboxes = dets["bboxes"].to(device)
+                det_results.scores = dets["scores"].to(device)
 
                 if self.with_segm:
-                    segm_results = pickle_res["det_masks"]
-                    det_results.masks = segm_results
+                    det_results.masks = dets["masks"]
 
                 img_data_sample.pred_instances = det_results
 
@@ -339,24 +426,17 @@ class MASA(BaseMOTModel):
                             rescale=rescale,
                         )[0]
                     else:
-                        x = self.detector.backbone(single_img)
-                        x_m = self.masa_adapter(x)
-                        if self.detector.with_neck:
-                            x = self.detector.neck(x)
-
+                        x, x_m = self.extract_unified_feats(
+                            single_img, [img_data_sample]
+                        )
                         img_data_sample = self.detector.predict(
                             single_img, x, [img_data_sample], rescale=rescale
                         )[0]
                 else:
                     raise NotImplementedError
 
-            frame_pred_track_instances = self.tracker.track(
-                model=self,
-                img=single_img,
-                feats=x_m,
-                data_sample=img_data_sample,
-                with_segm=self.with_segm,
-                **kwargs,
+            frame_pred_track_instances = self._track(
+                self.tracker, single_img, x_m, img_data_sample, **kwargs
             )
             if self.with_segm:
                 if frame_pred_track_instances.mask_inds is not None:
@@ -366,9 +446,214 @@ class MASA(BaseMOTModel):
                     ]
 
             img_data_sample.pred_track_instances = frame_pred_track_instances
+            if self.keyframe_scheduler is not None:
+                self.keyframe_scheduler.update(
+                    img_data_sample.frame_id, frame_pred_track_instances
+                )
 
         return [track_data_sample]
 
+    def _track(self, tracker, img, feats, img_data_sample, **kwargs):
+        """Track the detections of a frame, adding them with their
+        embeddings to ``self.artifact_writer`` when it is set."""
+        writer = self.artifact_writer
+        model = self if writer is None else writer.recording_model(self)
+        frame_pred_track_instances = tracker.track(
+            model=model,
+            img=img,
+            feats=feats,
+            data_sample=img_data_sample,
+            with_segm=self.with_segm,
+            **kwargs,
+        )
+        if writer is not None:
+            writer.add(img_data_sample, model)
+        return frame_pred_track_instances
+
+    def is_keyframe(self, frame_id: int) -> bool:
+        """Whether the frame ``frame_id`` runs the detector, always True
+        without ``keyframe_cfg``."""
+        return self.keyframe_scheduler is None or self.keyframe_scheduler.is_keyframe(
+            frame_id
+        )
+
+    def propagate(self, img_data_sample) -> None:
+        """Set the tracks propagated by the tracker as the results of a frame
+        which is not a keyframe."""
+        img_data_sample.pred_track_instances = self.tracker.propagate(
+            img_data_sample.frame_id
+        )
+
+    def tracking_state_dict(self) -> dict:
+        """State of the tracker and of the keyframe scheduler, to resume a
+        video from the next frame with :meth:`load_tracking_state_dict`."""
+        return dict(
+            tracker=self.tracker.state_dict(),
+            keyframe_scheduler=(
+                None
+                if self.keyframe_scheduler is None
+                else self.keyframe_scheduler.state_dict()
+            ),
+        )
+
+    def load_tracking_state_dict(self, state: dict) -> None:
+        """Restore the state of :meth:`tracking_state_dict`, the tracks on
+        the device of the model."""
+        device = next(self.parameters()).device
+        self.tracker.load_state_dict(state["tracker"], device=device)
+        if self.keyframe_scheduler is not None:
+            if state["keyframe_scheduler"] is None:
+                self.keyframe_scheduler.reset()
+            else:
+                self.keyframe_scheduler.load_state_dict(state["keyframe_scheduler"])
+
+    def predict_batch(
+        self,
+        inputs: Tensor,
+        data_samples: TrackSampleList,
+        rescale: bool = True,
+        trackers: Optional[list] = None,
+        **kwargs,
+    ) -> TrackSampleList:
+        """Predict results for consecutive frames of one video in a batch.
+
+        Unlike :meth:`predict`, the N dimension of ``inputs`` holds K
+        consecutive frames of the same video. The backbone, the MASA adapter
+        and the detector heads run once on the whole batch, then the per-frame
+        results are fed through the tracker in frame order.
+
+        With ``trackers``, the K frames can come from different videos, the
+        frame ``i`` is tracked by ``trackers[i]``, which is reset when the
+        frame is the first of its video. The frames of one video must still
+        be in frame order.
+
+        Every frame runs the detector, ``keyframe_cfg`` is not supported: the
+        scheduler picks the next keyframe from the tracks of the previous
+        one, which a batch detects before tracking. Use :meth:`predict`.
+
+        Args:
+            inputs (Tensor): of shape (K, 1, C, H, W) encoding K frames.
+            data_samples (list[:obj:`TrackDataSample`]): K data samples,
+                one per frame, in frame order.
+            rescale (bool, Optional): If False, then returned bboxes and masks
+                will fit the scale of img, otherwise, returned bboxes and masks
+                will fit the scale of original image shape. Defaults to True.
+            trackers (list, optional): The tracker of every frame. Defaults
+                to None, which tracks all the frames with ``self.tracker``.
+
+        Returns:
+            TrackSampleList: Tracking results of the K frames.
+        """
+        assert inputs.dim() == 5, "The img must be 5D Tensor (K, 1, C, H, W)."
+        assert (
+            inputs.size(1) == 1
+        ), "MASA batch inference only supports one frame per data sample."
+        assert inputs.size(0) == len(data_samples)
+        assert (
+            self.keyframe_scheduler is None
+        ), "keyframe_cfg is not supported with batch inference, use predict."
+
+        if trackers is None:
+            trackers = [self.tracker] * len(data_samples)
+            if data_samples[0][0].frame_id == 0:
+                self.tracker.reset()
+        else:
+            assert len(trackers) == len(data_samples)
+            for tracker, track_data_sample in zip(trackers, data_samples):
+                if track_data_sample[0].frame_id == 0:
+                    tracker.reset()
+
+        imgs = inputs[:, 0].contiguous()
+        img_data_samples = [track_data_sample[0] for track_data_sample in data_samples]
+
+        if self.load_public_dets or self.given_dets:
+            for img_data_sample in img_data_samples:
+                det_results = InstanceData()
+                if self.load_public_dets:
+                    dets = self.public_dets.get(
+                        self.public_det_key(img_data_sample.img_path)
+                    )
+                    det_results.labels = dets["labels"].to(imgs.device)
+                    det_results.bboxes = dets["bboxes"].to(imgs.device)
+                    det_results.scores = dets["scores"].to(imgs.device)
+                    if self.with_segm:
+                        det_results.masks = dets["masks"]
+                    img_data_sample.pred_instances = det_results
+                    continue
+                assert (
+                    "det_bboxes" in img_data_sample
+                ), "det_bboxes must be given when given_dets is True."
+                assert (
+                    "det_labels" in img_data_sample
+                ), "det_labels must be given when given_dets is True."
+                det_bboxes = img_data_sample.det_bboxes
+                if len(det_bboxes) != 0 and det_bboxes.size(1) == 4:
+                    det_bboxes = torch.cat(
+                        [det_bboxes, det_bboxes.new_ones(det_bboxes.size(0), 1)],
+                        dim=1,
+                    )
+                det_results.labels = img_data_sample.det_labels
+                det_results.bboxes = det_bboxes[:, :4]
+                det_results.scores = det_bboxes[:, 4]
+                img_data_sample.pred_instances = det_results
+
+            if self.unified_backbone:
+                if hasattr(self.detector.backbone, "with_text_model"):
+                    x = self.detector.backbone.forward_image(imgs)
+                elif self.detector.__class__.__name__ == "SamMasa":
+                    x = self.detector.backbone.forward_base_multi_level(imgs)
+                else:
+                    x = self.detector.backbone(imgs)
+            elif self.use_masa_backbone:
+                x = self.backbone.forward(imgs)
+            x_m = self.masa_adapter(x)
+        elif self.unified_backbone:
+            if hasattr(self.detector.backbone, "with_text_model"):
+                for img_data_sample in img_data_samples:
+                    texts = img_data_sample.texts
+                    ## fix some inconsistency caused by the implementation of yolo-world and mmdet
+                    if type(texts[0]) == list:
+                        new_texts = [text[0] for text in texts]
+                        del img_data_sample.texts
+                        img_data_sample.set_field(
+                            new_texts, "texts", field_type="metainfo"
+                        )
+                (
+                    backbone_feats,
+                    img_feats,
+                    text_feats,
+                ) = self.detector.extract_feat(imgs, img_data_samples)
+                x_m = self.masa_adapter(backbone_feats)
+                img_data_samples = self.detector.predict(
+                    imgs, (img_feats, text_feats), img_data_samples, rescale=rescale
+                )
+            else:
+                x, x_m = self.extract_unified_feats(imgs, img_data_samples)
+                img_data_samples = self.detector.predict(
+                    imgs, x, img_data_samples, rescale=rescale
+                )
+        else:
+            raise NotImplementedError
+
+        # tracking is sequential, so feed the frames one by one
+        for i, img_data_sample in enumerate(img_data_samples):
+            frame_pred_track_instances = self._track(
+                trackers[i],
+                imgs[i : i + 1],
+                [feat[i : i + 1] for feat in x_m],
+                img_data_sample,
+                **kwargs,
+            )
+            if self.with_segm:
+                if frame_pred_track_instances.mask_inds is not None:
+                    frame_pred_track_instances.masks = [
+                        img_data_sample.pred_instances.masks[j]
+                        for j in frame_pred_track_instances.mask_inds
+                    ]
+            img_data_sample.pred_track_instances = frame_pred_track_instances
+
+        return data_samples
+
     def parse_tensors(self, tensor_tuple, key_ids, ref_ids):
         key_tensors = []
         ref_tensors = []
@@ -0,0 +1,189 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+
+def _parse_dets(res: dict, with_masks: bool) -> dict:
+    """The boxes, scores and labels (and masks) of a public detection
+    pickle, boxes without a score column score 1."""
+    det_bboxes = torch.as_tensor(np.asarray(res["det_bboxes"]), dtype=torch.float32)
+    if det_bboxes.numel() == 0:
+        det_bboxes = det_bboxes.new_zeros((0, 5))
+    elif det_bboxes.size(1) == 4:
+        det_bboxes = torch.cat([det_bboxes, det_bboxes.new_ones(len(det_bboxes), 1)], dim=1)
+    dets = dict(
+        bboxes=det_bboxes[:, :4].contiguous(),
+        scores=det_bboxes[:, 4].contiguous(),
+        labels=torch.as_tensor(np.asarray(res["det_labels"]), dtype=torch.int64).reshape(-1),
+    )
+    if with_masks:
+        dets["masks"] = res["det_masks"]
+    return dets
+
+
+class PublicDets:
+    """Public detections of the frames of a benchmark, for MASA
+    ``load_public_dets``.
+
+    The detections are stored per sequence, in one file
+    ``<det_root>/<sequence>/public_dets.pth`` holding the boxes, scores and
+    labels of all the frames with the offsets of the frames, read memory
+    mapped, and the masks in ``public_masks.pkl`` (see :meth:`consolidate` and
+    ``tools/format_conversion/consolidate_public_dets.py``). The sequences
+    without it are read from the pickle of every frame,
+    ``<det_root>/<sequence>/<frame><end_pkl_name>``.
+
+    The frames after the requested one are loaded ahead in a background
+    thread, in the order of their names, which is the order of the frames
+    of the benchmarks.
+
+    Args:
+        det_root (str): Directory of the public detections.
+        end_pkl_name (str): Suffix of the pickles of the frames.
+            Defaults to '.pth'.
+        with_masks (bool): Whether to load the ``det_masks`` too.
+            Defaults to False.
+        prefetch (int): Number of frames loaded ahead, 0 loads in the calling
+            thread. Defaults to 8.
+    """
+
+    FILE_NAME = "public_dets.pth"
+    MASK_FILE_NAME = "public_masks.pkl"
+
+    def __init__(
+        self,
+        det_root: str,
+        end_pkl_name: str = ".pth",
+        with_masks: bool = False,
+        prefetch: int = 8,
+    ) -> None:
+        self.det_root = det_root
+        self.end_pkl_name = end_pkl_name
+        self.with_masks = with_masks
+        self.prefetch = prefetch
+        self._executor = (
+            ThreadPoolExecutor(1, thread_name_prefix="public_dets") if prefetch > 0 else None
+        )
+        self._sequence = None
+        self._store = None
+        self._frames: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._futures = {}
+
+    @classmethod
+    def consolidate(
+        cls, seq_dir: str, end_pkl_name: str = ".pth", with_masks: bool = False
+    ) -> str:
+        """Gather the pickles of the frames of a sequence into its
+        ``public_dets.pth`` (and ``public_masks.pkl``), and return its
+        path."""
+        frames = sorted(
+            name[: -len(end_pkl_name)]
+            for name in os.listdir(seq_dir)
+            if name.endswith(end_pkl_name)
+            and name not in (cls.FILE_NAME, cls.MASK_FILE_NAME)
+        )
+        dets = []
+        for frame in frames:
+            with open(os.path.join(seq_dir, frame + end_pkl_name), "rb") as f:
+                dets.append(_parse_dets(pickle.load(f), with_masks))
+        counts = torch.tensor([len(d["bboxes"]) for d in dets], dtype=torch.int64)
+        store = dict(
+            frames=frames,
+            offsets=torch.cat([counts.new_zeros(1), counts.cumsum(0)]),
+            bboxes=torch.cat([d["bboxes"] for d in dets]) if dets else torch.zeros((0, 4)),
+            scores=torch.cat([d["scores"] for d in dets]) if dets else torch.zeros((0,)),
+            labels=(
+                torch.cat([d["labels"] for d in dets])
+                if dets
+                else torch.zeros((0,), dtype=torch.int64)
+            ),
+        )
+        if with_masks:
+            mask_path = os.path.join(seq_dir, cls.MASK_FILE_NAME)
+            with open(f"{mask_path}.{os.getpid()}.tmp", "wb") as f:
+                pickle.dump([d["masks"] for d in dets], f)
+            os.replace(f"{mask_path}.{os.getpid()}.tmp", mask_path)
+        path = os.path.join(seq_dir, cls.FILE_NAME)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(store, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def _open(self, sequence: str) -> None:
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        seq_dir = os.path.join(self.det_root, sequence)
+        path = os.path.join(seq_dir, self.FILE_NAME)
+        mask_path = os.path.join(seq_dir, self.MASK_FILE_NAME)
+        if os.path.exists(path) and (not self.with_masks or os.path.exists(mask_path)):
+            self._store = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+            if self.with_masks:
+                with open(mask_path, "rb") as f:
+                    self._store["masks"] = pickle.load(f)
+            self._frames = self._store["frames"]
+        else:
+            self._store = None
+            self._frames = []
+            if os.path.isdir(seq_dir):
+                self._frames = sorted(
+                    name[: -len(self.end_pkl_name)]
+                    for name in os.listdir(seq_dir)
+                    if name.endswith(self.end_pkl_name)
+                    and name not in (self.FILE_NAME, self.MASK_FILE_NAME)
+                )
+        self._index = {frame: i for i, frame in enumerate(self._frames)}
+        self._sequence = sequence
+
+    def _load(
+        self, sequence: str, frame: str, store: Optional[dict], index: Dict[str, int]
+    ) -> dict:
+        if store is None:
+            path = os.path.join(self.det_root, sequence, frame + self.end_pkl_name)
+            with open(path, "rb") as f:
+                return _parse_dets(pickle.load(f), self.with_masks)
+        if frame not in index:
+            raise FileNotFoundError(
+                f"No public detections of {frame} in {os.path.join(self.det_root, sequence)}"
+            )
+        i = index[frame]
+        start, end = store["offsets"][i : i + 2].tolist()
+        dets = {key: store[key][start:end].clone() for key in ("bboxes", "scores", "labels")}
+        if self.with_masks:
+            dets["masks"] = store["masks"][i]
+        return dets
+
+    def get(self, key: str) -> dict:
+        """The ``bboxes``, ``scores`` and ``labels`` (and ``masks``) of the
+        frame ``key``, ``<sequence>/<frame>`` relative to ``det_root``
+        without the suffix, on the CPU."""
+        sequence, frame = os.path.split(key)
+        if sequence != self._sequence:
+            self._open(sequence)
+        future = self._futures.pop(frame, None)
+        if future is None:
+            dets = self._load(sequence, frame, self._store, self._index)
+        else:
+            dets = future.result()
+
+        if self._executor is not None and frame in self._index:
+            i = self._index[frame]
+            upcoming = self._frames[i + 1 : i + 1 + self.prefetch]
+            for stale in set(self._futures) - set(upcoming):
+                self._futures.pop(stale).cancel()
+            for next_frame in upcoming:
+                if next_frame not in self._futures:
+                    self._futures[next_frame] = self._executor.submit(
+                        self._load, sequence, next_frame, self._store, self._index
+                    )
+        return dets
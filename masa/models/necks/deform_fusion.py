@@ -149,7 +149,7 @@ class DyHeadBlock(nn.Module):
 
         return outs
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class DeformFusion(BaseModule):
     """Deformable Fusion Module for MASA."""
 
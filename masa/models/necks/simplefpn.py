@@ -17,7 +17,7 @@ class Norm2d(nn.Module):
         return x
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class SimpleFPN(BaseModule):
     r"""Simplified Feature Pyramid Network.
 
@@ -8,7 +8,7 @@ from mmengine.model import BaseModule
 from torch import Tensor
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class MasaTrackHead(BaseModule):
     """The masa track head. This takes the features from masa adapter to produce the final """
 
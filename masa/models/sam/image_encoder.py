@@ -16,7 +16,7 @@ from .common import LayerNorm2d, MLPBlock
 
 
 # This class and its supporting functions below lightly adapted from the SAM ViTDet backbone.
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class ImageEncoderViT(nn.Module):
     def __init__(
         self,
@@ -16,7 +16,7 @@ from .common import LayerNorm2d
 from .transformer import TwoWayTransformer
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class MaskDecoder(BaseModule):
     def __init__(
         self,
@@ -15,7 +15,7 @@ from torch import nn
 from .common import LayerNorm2d
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class PromptEncoder(BaseModule):
     def __init__(
         self,
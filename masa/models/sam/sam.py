@@ -10,7 +10,7 @@ from .mask_decoder import MaskDecoder
 from .prompt_encoder import PromptEncoder
 
 
-@MODELS.register_module()
+@MODELS.register_module(force=True)
 class Sam(nn.Module):
     mask_threshold: float = 0.0
     image_format: str = "RGB"
@@ -1,2 +1,7 @@
+from .det_artifacts import (DetArtifactWriter, load_det_artifacts,
+                            replay_det_artifacts)
+from .keyframe_scheduler import KeyframeScheduler
 from .masa_bdd_tracker import MasaBDDTracker
 from .masa_tao_tracker import MasaTaoTracker
+from .reid_gallery import ReIDGallery
+from .track_store import TrackStore
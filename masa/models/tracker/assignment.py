@@ -0,0 +1,170 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+def greedy_assign(match_scores: np.ndarray, thr: float) -> np.ndarray:
+    """Greedy assignment of the rows in order.
+
+    Every row takes its best column among the ones not taken by the rows
+    before it, if the score is above ``thr``. This is the matching loop of
+    the trackers, where the taken columns are zeroed, computed on the host:
+    the row maxima are computed at once and a row only needs a new search
+    when its best column has been taken.
+
+    Args:
+        match_scores (np.ndarray): Scores of shape (N, M).
+        thr (float): Minimum score of a match, non-negative, so a zeroed
+            column can never match again.
+
+    Returns:
+        np.ndarray: Column of every row, -1 for the unmatched rows.
+    """
+    assert thr >= 0
+    num_rows, num_cols = match_scores.shape
+    assigned = np.full((num_rows,), -1, dtype=np.int64)
+    if num_rows == 0 or num_cols == 0:
+        return assigned
+    best_cols = match_scores.argmax(axis=1)
+    best_scores = match_scores[np.arange(num_rows), best_cols]
+    taken = np.zeros((num_cols,), dtype=bool)
+    for i in np.nonzero(best_scores > thr)[0]:
+        col = best_cols[i]
+        if taken[col]:
+            row_scores = np.where(taken, 0, match_scores[i])
+            col = row_scores.argmax()
+            if not row_scores[col] > thr:
+                continue
+        assigned[i] = col
+        taken[col] = True
+    return assigned
+
+
+def optimal_assign(match_scores: np.ndarray, thr: float) -> np.ndarray:
+    """Assignment maximizing the sum of the scores of the matches, with the
+    pairs scoring at most ``thr`` not allowed to match.
+
+    Args:
+        match_scores (np.ndarray): Scores of shape (N, M).
+        thr (float): Minimum score of a match.
+
+    Returns:
+        np.ndarray: Column of every row, -1 for the unmatched rows.
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    assigned = np.full((match_scores.shape[0],), -1, dtype=np.int64)
+    valid = match_scores > thr
+    if not valid.any():
+        return assigned
+    # only the rows and columns with a valid pair take part
+    rows = np.nonzero(valid.any(axis=1))[0]
+    cols = np.nonzero(valid.any(axis=0))[0]
+    scores = match_scores[np.ix_(rows, cols)]
+    # a forbidden pair is worth the same as no match
+    cost = np.where(scores > thr, -scores, 0.0)
+    row_inds, col_inds = linear_sum_assignment(cost)
+    keep = scores[row_inds, col_inds] > thr
+    assigned[rows[row_inds[keep]]] = cols[col_inds[keep]]
+    return assigned
+
+
+def greedy_assign_pairs(
+    rows: np.ndarray, cols: np.ndarray, scores: np.ndarray, num_rows: int, thr: float
+) -> np.ndarray:
+    """:func:`greedy_assign` on the scores of some pairs only, the other
+    pairs being unable to match.
+
+    Args:
+        rows (np.ndarray): Row of every pair.
+        cols (np.ndarray): Column of every pair.
+        scores (np.ndarray): Score of every pair.
+        num_rows (int): Number of rows.
+        thr (float): Minimum score of a match, non-negative.
+
+    Returns:
+        np.ndarray: Column of every row, -1 for the unmatched rows.
+    """
+    assert thr >= 0
+    assigned = np.full((num_rows,), -1, dtype=np.int64)
+    keep = scores > thr
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    if rows.size == 0:
+        return assigned
+    # every row then its columns from the best, ties to the lowest column
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols = rows[order], cols[order]
+    row_ids, row_starts = np.unique(rows, return_index=True)
+    row_ends = np.append(row_starts[1:], rows.size)
+    taken = np.zeros((int(cols.max()) + 1,), dtype=bool)
+    for row, start, end in zip(row_ids, row_starts, row_ends):
+        for col in cols[start:end]:
+            if not taken[col]:
+                assigned[row] = col
+                taken[col] = True
+                break
+    return assigned
+
+
+def optimal_assign_pairs(
+    rows: np.ndarray, cols: np.ndarray, scores: np.ndarray, num_rows: int, thr: float
+) -> np.ndarray:
+    """:func:`optimal_assign` on the scores of some pairs only, the other
+    pairs being unable to match."""
+    keep = scores > thr
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    assigned = np.full((num_rows,), -1, dtype=np.int64)
+    if rows.size == 0:
+        return assigned
+    # the dense problem only spans the rows and columns with a valid pair
+    row_ids, rows = np.unique(rows, return_inverse=True)
+    col_ids, cols = np.unique(cols, return_inverse=True)
+    match_scores = np.full((row_ids.size, col_ids.size), -np.inf, dtype=scores.dtype)
+    match_scores[rows, cols] = scores
+    sub_assigned = optimal_assign(match_scores, thr)
+    matched = sub_assigned > -1
+    assigned[row_ids[matched]] = col_ids[sub_assigned[matched]]
+    return assigned
+
+
+ASSIGN_METHODS = dict(greedy=greedy_assign, optimal=optimal_assign)
+ASSIGN_PAIRS_METHODS = dict(greedy=greedy_assign_pairs, optimal=optimal_assign_pairs)
+
+
+def assign(match_scores: Tensor, thr: float, method: str = "greedy") -> Tensor:
+    """Match the rows of ``match_scores`` to its columns.
+
+    The scores are copied to the host once, the assignment runs there.
+    Rows which must not match can be set to ``-inf`` beforehand.
+
+    Returns:
+        Tensor: Column of every row on the CPU, -1 for the unmatched rows.
+    """
+    assigned = ASSIGN_METHODS[method](
+        match_scores.detach().float().cpu().numpy(), thr
+    )
+    return torch.from_numpy(assigned)
+
+
+def assign_pairs(
+    rows: Tensor, cols: Tensor, scores: Tensor, num_rows: int, thr: float, method: str = "greedy"
+) -> Tensor:
+    """Match rows to columns given the scores of some pairs only, for
+    example the pairs found by a spatial index.
+
+    Returns:
+        Tensor: Column of every row on the CPU, -1 for the unmatched rows.
+    """
+    assigned = ASSIGN_PAIRS_METHODS[method](
+        rows.cpu().numpy(),
+        cols.cpu().numpy(),
+        scores.detach().float().cpu().numpy(),
+        num_rows,
+        thr,
+    )
+    return torch.from_numpy(assigned)
@@ -0,0 +1,222 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+import os
+import shutil
+from typing import List, Optional, Tuple
+
+import torch
+from mmdet.structures import DetDataSample
+from mmengine.structures import InstanceData
+from torch import Tensor
+
+from .embed_storage import EMBED_DTYPES
+
+
+class _RecordingTrackHead:
+    """Track head keeping the embeddings it computed last."""
+
+    def __init__(self, track_head) -> None:
+        self.track_head = track_head
+        self.embeds = None
+
+    def predict(self, feats, bboxes) -> Tensor:
+        self.embeds = self.track_head.predict(feats, bboxes)
+        return self.embeds
+
+
+class _RecordingModel:
+    """The model given to the tracker while recording, the track head
+    keeps the embeddings of the frame."""
+
+    def __init__(self, model) -> None:
+        self.model = model
+        self.track_head = _RecordingTrackHead(model.track_head)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+class _ReplayTrackHead:
+    """Track head returning the recorded embeddings of the frame."""
+
+    embeds = None
+
+    def predict(self, feats, bboxes) -> Tensor:
+        return self.embeds
+
+
+class _ReplayModel:
+
+    def __init__(self) -> None:
+        self.track_head = _ReplayTrackHead()
+
+
+class DetArtifactWriter:
+    """Records the detections of the frames of one video with the track
+    head embeddings of the boxes, the inputs of the tracker, so other tracker
+    settings can be replayed offline by :func:`replay_det_artifacts`.
+
+    Set it as the ``artifact_writer`` of the MASA model, which adds every
+    tracked frame, then :meth:`save` it. The artifacts are columnar: the
+    boxes, scores, labels and embeddings of all the frames are concatenated,
+    with the offsets of the frames.
+
+    For long videos, :meth:`flush` moves the frames added so far to a part
+    file, and the checkpoints of the video keep the small :meth:`state_dict`
+    instead of the writer.
+
+    Args:
+        embed_dtype (str): dtype the embeddings are saved in.
+            Defaults to 'float16'.
+    """
+
+    def __init__(self, embed_dtype: str = "float16") -> None:
+        self.embed_dtype = embed_dtype
+        self.frame_ids: List[int] = []
+        self.bboxes: List[Tensor] = []
+        self.scores: List[Tensor] = []
+        self.labels: List[Tensor] = []
+        self.embeds: List[Tensor] = []
+        # part files of the flushed frames, and their number of frames
+        self.parts: List[str] = []
+        self.num_flushed = 0
+
+    def __len__(self) -> int:
+        return self.num_flushed + len(self.frame_ids)
+
+    def recording_model(self, model) -> _RecordingModel:
+        """The model to give to the tracker to record the embeddings of a
+        frame, for :meth:`add`."""
+        return _RecordingModel(model)
+
+    def add(self, data_sample: DetDataSample, model: _RecordingModel) -> None:
+        """Add the detections of a frame tracked with ``model``."""
+        pred_instances = data_sample.pred_instances
+        bboxes = pred_instances.bboxes.detach().float().cpu()
+        embeds = model.track_head.embeds
+        if embeds is None:
+            # the tracker returns before the track head without detections
+            embeds = bboxes.new_zeros((0, 0))
+        self.frame_ids.append(int(data_sample.frame_id))
+        self.bboxes.append(bboxes)
+        self.scores.append(pred_instances.scores.detach().float().cpu())
+        self.labels.append(pred_instances.labels.detach().cpu().to(torch.int32))
+        self.embeds.append(embeds.detach().to("cpu", EMBED_DTYPES[self.embed_dtype]))
+
+    def _columns(self, frames: List[dict]) -> dict:
+        """Concatenate the columns of ``frames``, dicts of ``frame_ids``,
+        the frame ``counts``, ``bboxes``, ``scores``, ``labels`` and
+        ``embeds``."""
+        embed_dim = max((embeds.size(1) for f in frames for embeds in f["embeds"]), default=0)
+        embeds = [e for f in frames for e in f["embeds"] if e.numel() > 0]
+        counts = torch.cat([f["counts"] for f in frames]) if frames else torch.zeros((0,), dtype=torch.int64)
+        bboxes = [b for f in frames for b in f["bboxes"]]
+        scores = [s for f in frames for s in f["scores"]]
+        labels = [label for f in frames for label in f["labels"]]
+        return dict(
+            frame_ids=(
+                torch.cat([f["frame_ids"] for f in frames])
+                if frames
+                else torch.zeros((0,), dtype=torch.int64)
+            ),
+            offsets=torch.cat([counts.new_zeros(1), counts.cumsum(0)]),
+            bboxes=torch.cat(bboxes) if bboxes else torch.zeros((0, 4)),
+            scores=torch.cat(scores) if scores else torch.zeros((0,)),
+            labels=torch.cat(labels) if labels else torch.zeros((0,), dtype=torch.int32),
+            embeds=(
+                torch.cat(embeds)
+                if embeds
+                else torch.zeros((0, embed_dim), dtype=EMBED_DTYPES[self.embed_dtype])
+            ),
+        )
+
+    def _added(self) -> dict:
+        """The frames added since the last :meth:`flush`, in the format of
+        the part files."""
+        return dict(
+            frame_ids=torch.tensor(self.frame_ids, dtype=torch.int64),
+            counts=torch.tensor([len(bboxes) for bboxes in self.bboxes], dtype=torch.int64),
+            bboxes=self.bboxes,
+            scores=self.scores,
+            labels=self.labels,
+            embeds=self.embeds,
+        )
+
+    def flush(self, part_dir: str) -> None:
+        """Move the frames added since the last flush to a part file in
+        ``part_dir``, read back by :meth:`save`."""
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, f"{len(self.parts):06d}.pth")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(self._added(), tmp_path)
+        os.replace(tmp_path, path)
+        self.parts.append(path)
+        self.num_flushed += len(self.frame_ids)
+        self.frame_ids, self.bboxes, self.scores, self.labels, self.embeds = [], [], [], [], []
+
+    def state_dict(self) -> dict:
+        """The part files flushed so far, for the checkpoint of the
+        video."""
+        return dict(parts=list(self.parts), num_flushed=self.num_flushed)
+
+    def load_state_dict(self, state: dict) -> None:
+        """Go on after the parts of :meth:`state_dict`, dropping the frames
+        added since the last flush."""
+        self.parts = list(state["parts"])
+        self.num_flushed = state["num_flushed"]
+        self.frame_ids, self.bboxes, self.scores, self.labels, self.embeds = [], [], [], [], []
+
+    def save(self, path: str, **meta) -> None:
+        """Save the artifacts of the frames added so far, flushed or not,
+        with ``meta``, and remove the part files."""
+        frames = [torch.load(part, map_location="cpu", weights_only=True) for part in self.parts]
+        artifacts = self._columns(frames + [self._added()])
+        artifacts["meta"] = meta
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(artifacts, tmp_path)
+        os.replace(tmp_path, path)
+        for part_dir in {os.path.dirname(part) for part in self.parts}:
+            shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def load_det_artifacts(path: str) -> dict:
+    """Load the artifacts saved by :meth:`DetArtifactWriter.save`."""
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def replay_det_artifacts(
+    tracker, artifacts: dict, device: Optional[str] = None
+) -> List[Tuple[int, InstanceData]]:
+    """Track the recorded detections of a video with ``tracker``, which is
+    reset first.
+
+    Args:
+        tracker: A MASA tracker, e.g. built with other thresholds than the
+            recording one.
+        artifacts (dict): The artifacts of :func:`load_det_artifacts`.
+        device (str, optional): Device to track on. Defaults to None, the
+            CPU.
+
+    Returns:
+        list[tuple[int, InstanceData]]: The frame id and the tracking
+        results of every recorded frame.
+    """
+    tracker.reset()
+    model = _ReplayModel()
+    offsets = artifacts["offsets"].tolist()
+    results = []
+    for i, frame_id in enumerate(artifacts["frame_ids"].tolist()):
+        start, end = offsets[i], offsets[i + 1]
+        data_sample = DetDataSample(metainfo=dict(frame_id=frame_id, scale_factor=(1.0, 1.0)))
+        data_sample.pred_instances = InstanceData(
+            bboxes=artifacts["bboxes"][start:end].to(device),
+            scores=artifacts["scores"][start:end].to(device),
+            labels=artifacts["labels"][start:end].long().to(device),
+        )
+        model.track_head.embeds = artifacts["embeds"][start:end].to(device, torch.float32)
+        pred_track_instances = tracker.track(model, None, None, data_sample, rescale=False)
+        results.append((frame_id, pred_track_instances))
+    return results
@@ -0,0 +1,106 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+EMBED_DTYPES = dict(
+    float32=torch.float32,
+    float16=torch.float16,
+    bfloat16=torch.bfloat16,
+    int8=torch.int8,
+)
+
+
+def quantize_embeds(
+    embeds: Tensor, embed_dtype: Optional[str] = None
+) -> Tuple[Tensor, Optional[Tensor]]:
+    """Values of ``embeds`` stored as ``embed_dtype``, and their scales.
+
+    ``int8`` keeps one scale per embedding (symmetric, the largest value
+    maps to 127), the other dtypes are a plain cast without scales. With
+    ``embed_dtype`` None the embeddings are kept as they are.
+
+    Returns:
+        tuple[Tensor, Tensor | None]: The stored values and the scales,
+        None except for ``int8``.
+    """
+    if embed_dtype is None:
+        return embeds, None
+    if embed_dtype != "int8":
+        return embeds.to(EMBED_DTYPES[embed_dtype]), None
+    embeds = embeds.float()
+    scales = embeds.abs().amax(dim=1).clamp(min=1e-12) / 127
+    codes = torch.round(embeds / scales[:, None]).to(torch.int8)
+    return codes, scales
+
+
+def dequantize_embeds(
+    values: Tensor, scales: Optional[Tensor] = None, dtype: Optional[torch.dtype] = None
+) -> Tensor:
+    """Embeddings of stored values, in ``dtype``. Defaults to the dtype of
+    the values, float32 for the ``int8`` codes."""
+    if dtype is None:
+        dtype = values.dtype if scales is None else torch.float32
+    embeds = values.to(dtype)
+    if scales is not None:
+        embeds = embeds * scales[:, None].to(dtype)
+    return embeds
+
+
+def embed_mm(queries: Tensor, values: Tensor, scales: Optional[Tensor] = None) -> Tensor:
+    """``queries @ dequantize_embeds(values, scales).t()`` in the dtype of
+    the queries.
+
+    The stored values are cast once as the operand of the matrix product and
+    the scales are applied to its (N, M) output, so the dequantized (M, D)
+    embeddings are never built.
+    """
+    if values.dtype != queries.dtype:
+        values = values.to(queries.dtype)
+    products = torch.mm(queries, values.t())
+    if scales is not None:
+        products = products * scales[None, :].to(products.dtype)
+    return products
+
+
+def embed_norms(values: Tensor, scales: Optional[Tensor] = None, dtype: Optional[torch.dtype] = None) -> Tensor:
+    """L2 norms of the embeddings of stored values, in ``dtype`` (as in
+    :func:`dequantize_embeds`)."""
+    if dtype is None:
+        dtype = values.dtype if scales is None else torch.float32
+    norms = values.to(dtype).norm(p=2, dim=1)
+    if scales is not None:
+        norms = norms * scales.to(dtype)
+    return norms
+
+
+def embed_cosine(
+    queries: Tensor,
+    values: Tensor,
+    scales: Optional[Tensor] = None,
+    products: Optional[Tensor] = None,
+) -> Tensor:
+    """Cosine similarities of ``queries`` and the embeddings of stored
+    values.
+
+    The embeddings stored in the dtype of the queries are normalized before
+    their product, as always. Otherwise the similarities are the products
+    ``products`` of :func:`embed_mm` (computed if not given) divided by the
+    norms, which saves a second matrix product over the stored values.
+    """
+    if scales is None and values.dtype == queries.dtype:
+        return torch.mm(
+            F.normalize(queries, p=2, dim=1),
+            F.normalize(values, p=2, dim=1).t(),
+        )
+    if products is None:
+        products = embed_mm(queries, values, scales)
+    norms = queries.norm(p=2, dim=1).clamp(min=1e-12)
+    value_norms = embed_norms(values, scales, queries.dtype).clamp(min=1e-12)
+    return products / (norms[:, None] * value_norms[None, :])
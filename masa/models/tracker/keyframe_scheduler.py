@@ -0,0 +1,130 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+import torch
+from mmengine.structures import InstanceData
+
+
+class KeyframeScheduler:
+    """Choose the frames of a video which run the detector.
+
+    The keyframes run the backbone, the detector and the tracker, the frames
+    in between only propagate the tracks of the last keyframe with their
+    velocity (see ``propagate`` of the trackers). Keyframes are ``stride``
+    frames apart, the first frame of a video is always one.
+
+    With ``adaptive``, the stride starts at 1 and doubles at every keyframe,
+    up to ``stride``, as long as the tracks are kept: it drops back to 1 when
+    more than ``max_lost_ratio`` of the tracks of the previous keyframe are
+    not found again, and it is limited so that the tracks move less than
+    ``max_motion`` times their size between two keyframes.
+
+    The stride should stay below ``memo_tracklet_frames`` of the tracker,
+    otherwise a track missed at one keyframe is lost.
+
+    Args:
+        stride (int): Frames between two keyframes, at most with
+            ``adaptive``. Defaults to 1.
+        adaptive (bool): Whether to adapt the stride to the motion and the
+            track loss. Defaults to False.
+        max_motion (float): Largest displacement of a track between two
+            keyframes, relative to the size of its box. Defaults to 0.2.
+        max_lost_ratio (float): Largest share of the tracks of a keyframe
+            missing at the next one. Defaults to 0.2.
+    """
+
+    def __init__(
+        self,
+        stride: int = 1,
+        adaptive: bool = False,
+        max_motion: float = 0.2,
+        max_lost_ratio: float = 0.2,
+    ) -> None:
+        assert stride >= 1
+        self.stride = stride
+        self.adaptive = adaptive
+        self.max_motion = max_motion
+        self.max_lost_ratio = max_lost_ratio
+        self.reset()
+
+    def reset(self) -> None:
+        self.current_stride = 1 if self.adaptive else self.stride
+        self.last_keyframe = None
+        self.last_tracks = None
+
+    def state_dict(self) -> dict:
+        """Current stride and last keyframe, to resume a video."""
+        return dict(
+            current_stride=self.current_stride,
+            last_keyframe=self.last_keyframe,
+            last_tracks=(
+                None
+                if self.last_tracks is None
+                else dict(
+                    bboxes=self.last_tracks.bboxes.clone(),
+                    instances_id=self.last_tracks.instances_id.clone(),
+                )
+            ),
+        )
+
+    def load_state_dict(self, state: dict) -> None:
+        self.current_stride = state["current_stride"]
+        self.last_keyframe = state["last_keyframe"]
+        self.last_tracks = None
+        if state["last_tracks"] is not None:
+            self.last_tracks = InstanceData(
+                bboxes=state["last_tracks"]["bboxes"].cpu(),
+                instances_id=state["last_tracks"]["instances_id"].cpu(),
+            )
+
+    def is_keyframe(self, frame_id: int) -> bool:
+        """Whether ``frame_id`` runs the detector. Frame 0, or a frame id
+        going back, starts a new video."""
+        return (
+            self.last_keyframe is None
+            or frame_id <= self.last_keyframe
+            or frame_id - self.last_keyframe >= self.current_stride
+        )
+
+    def update(self, frame_id: int, pred_track_instances: InstanceData) -> None:
+        """Record the tracking results of the keyframe ``frame_id``."""
+        if self.last_keyframe is None or frame_id <= self.last_keyframe:
+            self.reset()
+        elif self.adaptive:
+            self.current_stride = self._next_stride(
+                frame_id - self.last_keyframe, pred_track_instances
+            )
+        self.last_keyframe = frame_id
+        self.last_tracks = InstanceData(
+            bboxes=pred_track_instances.bboxes.detach().float().cpu(),
+            instances_id=pred_track_instances.instances_id.cpu(),
+        )
+
+    def _next_stride(self, gap: int, tracks: InstanceData) -> int:
+        last_ids = self.last_tracks.instances_id
+        if last_ids.numel() == 0:
+            return min(self.current_stride * 2, self.stride)
+        ids = tracks.instances_id.cpu()
+        found = torch.isin(last_ids, ids)
+        if 1 - found.float().mean().item() > self.max_lost_ratio:
+            return 1
+        if not found.any():
+            return min(self.current_stride * 2, self.stride)
+
+        # displacement per frame of the tracks found again, relative to their size
+        last_ids = last_ids[found]
+        last_bboxes = self.last_tracks.bboxes[found]
+        order = torch.argsort(ids)
+        bboxes = tracks.bboxes.detach().float().cpu()[
+            order[torch.searchsorted(ids[order], last_ids)]
+        ]
+        last_centers = (last_bboxes[:, :2] + last_bboxes[:, 2:4]) / 2
+        centers = (bboxes[:, :2] + bboxes[:, 2:4]) / 2
+        sizes = (last_bboxes[:, 2:4] - last_bboxes[:, :2]).clamp(min=1).prod(dim=1).sqrt()
+        motion = ((centers - last_centers).norm(dim=1) / sizes).max().item() / gap
+        stride = min(self.current_stride * 2, self.stride)
+        if motion > 0:
+            stride = min(stride, max(1, int(self.max_motion / motion)))
+        return stride
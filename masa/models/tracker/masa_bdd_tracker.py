@@ -3,10 +3,9 @@ Author: Siyuan Li
 Licensed: Apache-2.0 License
 """
 
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import torch
-import torch.nn.functional as F
 from mmdet.models.trackers.base_tracker import BaseTracker
 from mmdet.registry import MODELS
 from mmdet.structures import TrackDataSample
@@ -14,8 +13,12 @@ from mmdet.structures.bbox import bbox_overlaps
 from mmengine.structures import InstanceData
 from torch import Tensor
 
+from .embed_storage import embed_cosine, embed_mm, quantize_embeds
+from .reid_gallery import ReIDGallery
+from .track_store import TrackStore
 
-@MODELS.register_module()
+
+@MODELS.register_module(force=True)
 class MasaBDDTracker(BaseTracker):
     """Tracker for MASA on BDD benchmark.
 
@@ -40,6 +43,15 @@ class MasaBDDTracker(BaseTracker):
         with_cats (bool): Whether to track with the same category.
             Defaults to False.
         match_metric (str): The match metric. Can be 'bisoftmax', 'softmax', or 'cosine'. Defaults to 'bisoftmax'.
+        reid_gallery (dict, optional): Arguments of a :class:`ReIDGallery`
+            keeping the embeddings of the expired tracks. The new objects
+            matching one of them take its id back instead of a new one.
+            Defaults to None.
+        embed_dtype (str, optional): Dtype the embeddings of the tracks and
+            of the backdrops are stored in, 'float16', 'bfloat16' or 'int8'
+            (with one scale per embedding) to save memory on long memories.
+            The matching dequantizes them within its matrix products.
+            Defaults to None, the dtype of the track head.
     """
 
     def __init__(
@@ -55,8 +67,13 @@ class MasaBDDTracker(BaseTracker):
         nms_class_iou_thr: float = 0.7,
         with_cats: bool = False,
         match_metric: str = "bisoftmax",
+        reid_gallery: Optional[dict] = None,
+        embed_dtype: Optional[str] = None,
         **kwargs
     ):
+        # set before the base class calls reset
+        self.reid_gallery_cfg = reid_gallery
+        self.embed_dtype = embed_dtype
         super().__init__(**kwargs)
         assert 0 <= memo_momentum <= 1.0
         assert memo_tracklet_frames >= 0
@@ -76,14 +93,54 @@ class MasaBDDTracker(BaseTracker):
         self.match_metric = match_metric
 
         self.num_tracks = 0
-        self.tracks = dict()
+        self.tracks = TrackStore(with_velocity=True, embed_dtype=self.embed_dtype)
         self.backdrops = []
 
     def reset(self):
         """Reset the buffer of the tracker."""
         self.num_tracks = 0
-        self.tracks = dict()
+        self.tracks = TrackStore(with_velocity=True, embed_dtype=self.embed_dtype)
         self.backdrops = []
+        self.reid_gallery = (
+            None
+            if self.reid_gallery_cfg is None
+            else ReIDGallery(**self.reid_gallery_cfg)
+        )
+
+    def state_dict(self) -> dict:
+        """State of the tracker (tracks, backdrops, number of ids given and
+        re-id gallery), on the CPU. Restored with :meth:`load_state_dict`,
+        the tracker continues a video as if it had never stopped."""
+        return dict(
+            num_tracks=self.num_tracks,
+            tracks=self.tracks.state_dict(),
+            backdrops=[
+                {key: value.cpu().clone() for key, value in backdrop.items()}
+                for backdrop in self.backdrops
+            ],
+            reid_gallery=(
+                None if self.reid_gallery is None else self.reid_gallery.state_dict()
+            ),
+        )
+
+    def load_state_dict(self, state: dict, device: Optional[torch.device] = None) -> None:
+        """Restore the state of :meth:`state_dict`.
+
+        Args:
+            state (dict): The state of the tracker.
+            device (torch.device, optional): Device of the restored tracks,
+                that of the detections they are matched to. Defaults to None,
+                which keeps the device the state is loaded on.
+        """
+        self.reset()
+        self.num_tracks = state["num_tracks"]
+        self.tracks.load_state_dict(state["tracks"], device=device)
+        self.backdrops = [
+            {key: value.to(device, copy=True) for key, value in backdrop.items()}
+            for backdrop in state["backdrops"]
+        ]
+        if self.reid_gallery is not None and state["reid_gallery"] is not None:
+            self.reid_gallery.load_state_dict(state["reid_gallery"], device=device)
 
     def update(
         self,
@@ -105,104 +162,112 @@ class MasaBDDTracker(BaseTracker):
             frame_id (int): The id of current frame, 0-index.
         """
         tracklet_inds = ids > -1
-
-        for id, bbox, embed, label, score in zip(
+        # update the tracked ones and initialize new tracks
+        self.tracks.update(
             ids[tracklet_inds],
             bboxes[tracklet_inds],
             embeds[tracklet_inds],
             labels[tracklet_inds],
             scores[tracklet_inds],
-        ):
-            id = int(id)
-            # update the tracked ones and initialize new tracks
-            if id in self.tracks.keys():
-                velocity = (bbox - self.tracks[id]["bbox"]) / (
-                    frame_id - self.tracks[id]["last_frame"]
-                )
-                self.tracks[id]["bbox"] = bbox
-                self.tracks[id]["embed"] = (1 - self.memo_momentum) * self.tracks[id][
-                    "embed"
-                ] + self.memo_momentum * embed
-                self.tracks[id]["last_frame"] = frame_id
-                self.tracks[id]["label"] = label
-                self.tracks[id]["score"] = score
-                self.tracks[id]["velocity"] = (
-                    self.tracks[id]["velocity"] * self.tracks[id]["acc_frame"]
-                    + velocity
-                ) / (self.tracks[id]["acc_frame"] + 1)
-                self.tracks[id]["acc_frame"] += 1
-            else:
-                self.tracks[id] = dict(
-                    bbox=bbox,
-                    embed=embed,
-                    label=label,
-                    score=score,
-                    last_frame=frame_id,
-                    velocity=torch.zeros_like(bbox),
-                    acc_frame=0,
-                )
+            frame_id,
+            self.memo_momentum,
+        )
+
         # backdrop update according to IoU
         backdrop_inds = torch.nonzero(ids == -1, as_tuple=False).squeeze(1)
         ious = bbox_overlaps(bboxes[backdrop_inds], bboxes)
-        for i, ind in enumerate(backdrop_inds):
-            if (ious[i, :ind] > self.nms_backdrop_iou_thr).any():
-                backdrop_inds[i] = -1
-        backdrop_inds = backdrop_inds[backdrop_inds > -1]
+        before = torch.arange(bboxes.size(0), device=ious.device)[
+            None, :
+        ] < backdrop_inds[:, None].to(ious.device)
+        duplicates = ((ious > self.nms_backdrop_iou_thr) & before).any(dim=1)
+        backdrop_inds = backdrop_inds[~duplicates.to(backdrop_inds.device)]
         # old backdrops would be removed at first
-        self.backdrops.insert(
-            0,
-            dict(
-                bboxes=bboxes[backdrop_inds],
-                embeds=embeds[backdrop_inds],
-                labels=labels[backdrop_inds],
-            ),
+        backdrop_embeds, backdrop_scales = quantize_embeds(
+            embeds[backdrop_inds], self.embed_dtype
+        )
+        backdrop = dict(
+            bboxes=bboxes[backdrop_inds],
+            embeds=backdrop_embeds,
+            labels=labels[backdrop_inds],
         )
+        if backdrop_scales is not None:
+            backdrop["embed_scales"] = backdrop_scales
+        self.backdrops.insert(0, backdrop)
 
-        # pop memo
-        invalid_ids = []
-        for k, v in self.tracks.items():
-            if frame_id - v["last_frame"] >= self.memo_tracklet_frames:
-                invalid_ids.append(k)
-        for invalid_id in invalid_ids:
-            self.tracks.pop(invalid_id)
+        # pop memo, the expired tracks go to the re-id gallery
+        expired = self.tracks.pop_expired(frame_id, self.memo_tracklet_frames)
+        if self.reid_gallery is not None:
+            if expired is not None:
+                self.reid_gallery.add(**expired)
+            self.reid_gallery.evict(frame_id)
 
         if len(self.backdrops) > self.memo_backdrop_frames:
             self.backdrops.pop()
 
+    @property
+    def memo_embed_scales(self) -> Optional[Tensor]:
+        """Scales of the embeddings of :attr:`memo`, None unless they are
+        stored as int8."""
+        if self.embed_dtype != "int8":
+            return None
+        return torch.cat(
+            [self.tracks.view("embed_scales")]
+            + [backdrop["embed_scales"] for backdrop in self.backdrops]
+        )
+
     @property
     def memo(self) -> Tuple[Tensor, ...]:
         """Get tracks memory."""
-        memo_embeds = []
-        memo_ids = []
-        memo_bboxes = []
-        memo_labels = []
-        # velocity of tracks
-        memo_vs = []
         # get tracks
-        for k, v in self.tracks.items():
-            memo_bboxes.append(v["bbox"][None, :])
-            memo_embeds.append(v["embed"][None, :])
-            memo_ids.append(k)
-            memo_labels.append(v["label"].view(1, 1))
-            memo_vs.append(v["velocity"][None, :])
-        memo_ids = torch.tensor(memo_ids, dtype=torch.long).view(1, -1)
+        memo_bboxes = [self.tracks.view("bboxes")]
+        memo_embeds = [self.tracks.view("embeds")]
+        memo_ids = [self.tracks.view("ids")]
+        memo_labels = [self.tracks.view("labels")]
+        # velocity of tracks
+        memo_vs = [self.tracks.view("velocities")]
+        if len(self.backdrops) == 0:
+            return memo_bboxes[0], memo_labels[0], memo_embeds[0], memo_ids[0], memo_vs[0]
         # get backdrops
         for backdrop in self.backdrops:
-            backdrop_ids = torch.full(
-                (1, backdrop["embeds"].size(0)), -1, dtype=torch.long
-            )
-            backdrop_vs = torch.zeros_like(backdrop["bboxes"])
             memo_bboxes.append(backdrop["bboxes"])
             memo_embeds.append(backdrop["embeds"])
-            memo_ids = torch.cat([memo_ids, backdrop_ids], dim=1)
-            memo_labels.append(backdrop["labels"][:, None])
-            memo_vs.append(backdrop_vs)
+            memo_ids.append(
+                torch.full((backdrop["embeds"].size(0),), -1, dtype=torch.long)
+            )
+            memo_labels.append(backdrop["labels"])
+            memo_vs.append(torch.zeros_like(backdrop["bboxes"]))
 
         memo_bboxes = torch.cat(memo_bboxes, dim=0)
         memo_embeds = torch.cat(memo_embeds, dim=0)
-        memo_labels = torch.cat(memo_labels, dim=0).squeeze(1)
+        memo_labels = torch.cat(memo_labels, dim=0)
         memo_vs = torch.cat(memo_vs, dim=0)
-        return memo_bboxes, memo_labels, memo_embeds, memo_ids.squeeze(0), memo_vs
+        memo_ids = torch.cat(memo_ids, dim=0)
+        return memo_bboxes, memo_labels, memo_embeds, memo_ids, memo_vs
+
+    def propagate(self, frame_id: int) -> InstanceData:
+        """Tracking results of a frame without detections: the tracks of the
+        last tracked frame, moved to ``frame_id`` with their velocity. The
+        tracker itself is not updated.
+
+        Args:
+            frame_id (int): The id of the frame, 0-index.
+
+        Returns:
+            :obj:`InstanceData`: The propagated tracks, with ``bboxes``,
+            ``labels``, ``scores`` and ``instances_id``.
+        """
+        pred_track_instances = InstanceData()
+        tracks = self.tracks.predict(frame_id)
+        if tracks["bboxes"] is None:
+            pred_track_instances.bboxes = torch.zeros((0, 4))
+            pred_track_instances.labels = torch.zeros((0,), dtype=torch.long)
+            pred_track_instances.scores = torch.zeros((0,))
+        else:
+            pred_track_instances.bboxes = tracks["bboxes"]
+            pred_track_instances.labels = tracks["labels"]
+            pred_track_instances.scores = tracks["scores"]
+        pred_track_instances.instances_id = tracks["ids"]
+        return pred_track_instances
 
     def track(
         self,
@@ -271,17 +336,15 @@ class MasaBDDTracker(BaseTracker):
             mask_inds = []
 
         # duplicate removal for potential backdrops and cross classes
-        valids = bboxes.new_ones((bboxes.size(0)))
         ious = bbox_overlaps(bboxes, bboxes)
-        for i in range(1, bboxes.size(0)):
-            thr = (
-                self.nms_backdrop_iou_thr
-                if scores[i] < self.obj_score_thr
-                else self.nms_class_iou_thr
-            )
-            if (ious[i, :i] > thr).any():
-                valids[i] = 0
-        valids = valids == 1
+        thrs = torch.where(
+            scores < self.obj_score_thr,
+            ious.new_tensor(self.nms_backdrop_iou_thr),
+            ious.new_tensor(self.nms_class_iou_thr),
+        )
+        # compare every box with the boxes before it
+        before = torch.ones_like(ious, dtype=torch.bool).tril(diagonal=-1)
+        valids = ~((ious > thrs[:, None]) & before).any(dim=1)
         bboxes = bboxes[valids]
         scores = scores[valids]
         labels = labels[valids]
@@ -295,20 +358,18 @@ class MasaBDDTracker(BaseTracker):
         # match if buffer is not empty
         if bboxes.size(0) > 0 and not self.empty:
             (memo_bboxes, memo_labels, memo_embeds, memo_ids, memo_vs) = self.memo
+            memo_embed_scales = self.memo_embed_scales
 
             if self.match_metric == "bisoftmax":
-                feats = torch.mm(embeds, memo_embeds.t())
+                feats = embed_mm(embeds, memo_embeds, memo_embed_scales)
                 d2t_scores = feats.softmax(dim=1)
                 t2d_scores = feats.softmax(dim=0)
                 match_scores = (d2t_scores + t2d_scores) / 2
             elif self.match_metric == "softmax":
-                feats = torch.mm(embeds, memo_embeds.t())
+                feats = embed_mm(embeds, memo_embeds, memo_embed_scales)
                 match_scores = feats.softmax(dim=1)
             elif self.match_metric == "cosine":
-                match_scores = torch.mm(
-                    F.normalize(embeds, p=2, dim=1),
-                    F.normalize(memo_embeds, p=2, dim=1).t(),
-                )
+                match_scores = embed_cosine(embeds, memo_embeds, memo_embed_scales)
             else:
                 raise NotImplementedError
             # track with the same category
@@ -332,6 +393,11 @@ class MasaBDDTracker(BaseTracker):
                                 ids[i] = -2
         # initialize new tracks
         new_inds = (ids == -1) & (scores > self.init_score_thr).cpu()
+        if self.reid_gallery is not None:
+            # objects coming back take the id of their expired track
+            new_inds = self.reid_gallery.reidentify(
+                ids, embeds, labels if self.with_cats else None, new_inds
+            )
         num_news = new_inds.sum()
         ids[new_inds] = torch.arange(
             self.num_tracks, self.num_tracks + num_news, dtype=torch.long
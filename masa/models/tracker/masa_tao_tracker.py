@@ -3,10 +3,10 @@ Author: Siyuan Li
 Licensed: Apache-2.0 License
 """
 
-from typing import List, Tuple
+import math
+from typing import List, Optional, Tuple
 
 import torch
-import torch.nn.functional as F
 from mmdet.models.trackers.base_tracker import BaseTracker
 from mmdet.registry import MODELS
 from mmdet.structures import TrackDataSample
@@ -14,8 +14,23 @@ from mmdet.structures.bbox import bbox_overlaps
 from mmengine.structures import InstanceData
 from torch import Tensor
 
+from .assignment import ASSIGN_METHODS, assign, assign_pairs
+from .embed_storage import embed_cosine, embed_mm, embed_norms
+from .reid_gallery import ReIDGallery
+from .spatial_index import radius_pairs
+from .track_store import TrackStore
 
-@MODELS.register_module()
+
+def _logsumexp(x: Tensor, dim: int) -> Tensor:
+    """``x.logsumexp(dim)`` without the denormal exponentials of the terms
+    far below the maximum, which slow the CPU kernels down by an order of
+    magnitude and do not change the float32 sum."""
+    maxes = x.amax(dim=dim, keepdim=True)
+    sums = (x - maxes).clamp_(min=-80).exp_().sum(dim=dim)
+    return sums.log_() + maxes.squeeze(dim)
+
+
+@MODELS.register_module(force=True)
 class MasaTaoTracker(BaseTracker):
     """Tracker for MASA on TAO benchmark.
 
@@ -38,6 +53,26 @@ class MasaTaoTracker(BaseTracker):
         match_metric (str): The match metric. Can be 'bisoftmax', 'softmax', or 'cosine'. Defaults to 'bisoftmax'.
         max_distance (float): Maximum distance for considering matches. Defaults to -1.
         fps (int): Frames per second of the input video. Used for calculating growth factor. Defaults to 1.
+        assign_method (str): How the detections are matched to the tracks.
+            'greedy' matches the detections in the order of their scores,
+            each to its best free track, 'optimal' maximizes the sum of the
+            match scores. Defaults to 'greedy'.
+        use_spatial_index (bool): Whether to score only the pairs of
+            detections and tracks found by a grid index over the box centres:
+            the pairs close enough to pass ``match_score_thr`` under the
+            distance mask when ``max_distance`` is set, and only the pairs of
+            the same category when ``with_cats`` is True. The matches are
+            the same as without the index, apart from the category blocking.
+            Defaults to False.
+        reid_gallery (dict, optional): Arguments of a :class:`ReIDGallery`
+            keeping the embeddings of the expired tracks. The new objects
+            matching one of them take its id back instead of a new one.
+            Defaults to None.
+        embed_dtype (str, optional): Dtype the embeddings of the tracks are
+            stored in, 'float16', 'bfloat16' or 'int8' (with one scale per
+            embedding) to save memory on long memories. The matching
+            dequantizes them within its matrix products. Defaults to None,
+            the dtype of the track head.
     """
 
     def __init__(
@@ -52,8 +87,15 @@ class MasaTaoTracker(BaseTracker):
         with_cats: bool = True,
         max_distance: float = -1,
         fps=1,
+        assign_method: str = "greedy",
+        use_spatial_index: bool = False,
+        reid_gallery: Optional[dict] = None,
+        embed_dtype: Optional[str] = None,
         **kwargs
     ):
+        # set before the base class calls reset
+        self.reid_gallery_cfg = reid_gallery
+        self.embed_dtype = embed_dtype
         super().__init__(**kwargs)
         assert 0 <= memo_momentum <= 1.0
         assert memo_tracklet_frames >= 0
@@ -67,18 +109,53 @@ class MasaTaoTracker(BaseTracker):
         self.with_cats = with_cats
 
         self.num_tracks = 0
-        self.tracks = dict()
+        self.tracks = TrackStore(with_velocity=True, embed_dtype=self.embed_dtype)
         self.backdrops = []
         self.max_distance = max_distance  # Maximum distance for considering matches
         self.fps = fps
         self.growth_factor = self.fps / 6  # Growth factor for the distance mask
         self.distance_smoothing_factor = 100 / self.fps
+        assert assign_method in ASSIGN_METHODS
+        self.assign_method = assign_method
+        self.use_spatial_index = use_spatial_index
 
     def reset(self):
         """Reset the buffer of the tracker."""
         self.num_tracks = 0
-        self.tracks = dict()
+        self.tracks = TrackStore(with_velocity=True, embed_dtype=self.embed_dtype)
         self.backdrops = []
+        self.reid_gallery = (
+            None
+            if self.reid_gallery_cfg is None
+            else ReIDGallery(**self.reid_gallery_cfg)
+        )
+
+    def state_dict(self) -> dict:
+        """State of the tracker (tracks, number of ids given and re-id
+        gallery), on the CPU. Restored with :meth:`load_state_dict`, the
+        tracker continues a video as if it had never stopped."""
+        return dict(
+            num_tracks=self.num_tracks,
+            tracks=self.tracks.state_dict(),
+            reid_gallery=(
+                None if self.reid_gallery is None else self.reid_gallery.state_dict()
+            ),
+        )
+
+    def load_state_dict(self, state: dict, device: Optional[torch.device] = None) -> None:
+        """Restore the state of :meth:`state_dict`.
+
+        Args:
+            state (dict): The state of the tracker.
+            device (torch.device, optional): Device of the restored tracks,
+                that of the detections they are matched to. Defaults to None,
+                which keeps the device the state is loaded on.
+        """
+        self.reset()
+        self.num_tracks = state["num_tracks"]
+        self.tracks.load_state_dict(state["tracks"], device=device)
+        if self.reid_gallery is not None and state["reid_gallery"] is not None:
+            self.reid_gallery.load_state_dict(state["reid_gallery"], device=device)
 
     def update(
         self,
@@ -100,72 +177,60 @@ class MasaTaoTracker(BaseTracker):
             frame_id (int): The id of current frame, 0-index.
         """
         tracklet_inds = ids > -1
-
-        for id, bbox, embed, label, score in zip(
+        # update the tracked ones and initialize new tracks
+        self.tracks.update(
             ids[tracklet_inds],
             bboxes[tracklet_inds],
             embeds[tracklet_inds],
             labels[tracklet_inds],
             scores[tracklet_inds],
-        ):
-            id = int(id)
-            # update the tracked ones and initialize new tracks
-            if id in self.tracks.keys():
-                self.tracks[id]["bbox"] = bbox
-                self.tracks[id]["embed"] = (1 - self.memo_momentum) * self.tracks[id][
-                    "embed"
-                ] + self.memo_momentum * embed
-                self.tracks[id]["last_frame"] = frame_id
-                self.tracks[id]["label"] = label
-                self.tracks[id]["score"] = score
-            else:
-                self.tracks[id] = dict(
-                    bbox=bbox,
-                    embed=embed,
-                    label=label,
-                    score=score,
-                    last_frame=frame_id,
-                )
+            frame_id,
+            self.memo_momentum,
+        )
 
-        # pop memo
-        invalid_ids = []
-        for k, v in self.tracks.items():
-            if frame_id - v["last_frame"] >= self.memo_tracklet_frames:
-                invalid_ids.append(k)
-        for invalid_id in invalid_ids:
-            self.tracks.pop(invalid_id)
+        # pop memo, the expired tracks go to the re-id gallery
+        expired = self.tracks.pop_expired(frame_id, self.memo_tracklet_frames)
+        if self.reid_gallery is not None:
+            if expired is not None:
+                self.reid_gallery.add(**expired)
+            self.reid_gallery.evict(frame_id)
 
     @property
     def memo(self) -> Tuple[Tensor, ...]:
-        """Get tracks memory."""
-        memo_embeds = []
-        memo_ids = []
-        memo_bboxes = []
-        memo_labels = []
-        memo_frame_ids = []
-
-        # get tracks
-        for k, v in self.tracks.items():
-            memo_bboxes.append(v["bbox"][None, :])
-            memo_embeds.append(v["embed"][None, :])
-            memo_ids.append(k)
-            memo_labels.append(v["label"].view(1, 1))
-            memo_frame_ids.append(v["last_frame"])
-
-        memo_ids = torch.tensor(memo_ids, dtype=torch.long).view(1, -1)
-        memo_bboxes = torch.cat(memo_bboxes, dim=0)
-        memo_embeds = torch.cat(memo_embeds, dim=0)
-        memo_labels = torch.cat(memo_labels, dim=0).squeeze(1)
-        memo_frame_ids = torch.tensor(memo_frame_ids, dtype=torch.long).view(1, -1)
-
+        """Get tracks memory, as views of the track store."""
         return (
-            memo_bboxes,
-            memo_labels,
-            memo_embeds,
-            memo_ids.squeeze(0),
-            memo_frame_ids.squeeze(0),
+            self.tracks.view("bboxes"),
+            self.tracks.view("labels"),
+            self.tracks.view("embeds"),
+            self.tracks.view("ids"),
+            self.tracks.view("last_frames"),
         )
 
+    def propagate(self, frame_id: int) -> InstanceData:
+        """Tracking results of a frame without detections: the tracks of the
+        last tracked frame, moved to ``frame_id`` with their velocity. The
+        tracker itself is not updated.
+
+        Args:
+            frame_id (int): The id of the frame, 0-index.
+
+        Returns:
+            :obj:`InstanceData`: The propagated tracks, with ``bboxes``,
+            ``labels``, ``scores`` and ``instances_id``.
+        """
+        pred_track_instances = InstanceData()
+        tracks = self.tracks.predict(frame_id)
+        if tracks["bboxes"] is None:
+            pred_track_instances.bboxes = torch.zeros((0, 4))
+            pred_track_instances.labels = torch.zeros((0,), dtype=torch.long)
+            pred_track_instances.scores = torch.zeros((0,))
+        else:
+            pred_track_instances.bboxes = tracks["bboxes"]
+            pred_track_instances.labels = tracks["labels"]
+            pred_track_instances.scores = tracks["scores"]
+        pred_track_instances.instances_id = tracks["ids"]
+        return pred_track_instances
+
     def compute_distance_mask(self, bboxes1, bboxes2, frame_ids1, frame_ids2):
         """Compute a mask based on the pairwise center distances and frame IDs with piecewise soft-weighting."""
         centers1 = (bboxes1[:, :2] + bboxes1[:, 2:]) / 2.0
@@ -193,6 +258,142 @@ class MasaTaoTracker(BaseTracker):
 
         return soft_distance_mask
 
+    def dense_match_scores(
+        self,
+        bboxes: Tensor,
+        embeds: Tensor,
+        memo_bboxes: Tensor,
+        memo_embeds: Tensor,
+        memo_frame_ids: Tensor,
+        frame_id: int,
+        memo_embed_scales: Optional[Tensor] = None,
+    ) -> Tensor:
+        """Match scores of all the pairs of detections and tracks."""
+        feats = embed_mm(embeds, memo_embeds, memo_embed_scales)
+        d2t_scores = feats.softmax(dim=1)
+        t2d_scores = feats.softmax(dim=0)
+        match_scores_bisoftmax = (d2t_scores + t2d_scores) / 2
+
+        match_scores_cosine = embed_cosine(
+            embeds, memo_embeds, memo_embed_scales, products=feats
+        )
+
+        match_scores = (match_scores_bisoftmax + match_scores_cosine) / 2
+
+        if self.max_distance != -1:
+
+            # Compute the mask based on spatial proximity
+            current_frame_ids = torch.full(
+                (bboxes.size(0),), frame_id, dtype=torch.long
+            )
+            distance_mask = self.compute_distance_mask(
+                bboxes, memo_bboxes, current_frame_ids, memo_frame_ids
+            )
+
+            # Apply the mask to the match scores
+            match_scores = match_scores * distance_mask
+        return match_scores
+
+    def pair_match_scores(
+        self,
+        bboxes: Tensor,
+        labels: Tensor,
+        embeds: Tensor,
+        memo_bboxes: Tensor,
+        memo_labels: Tensor,
+        memo_embeds: Tensor,
+        memo_frame_ids: Tensor,
+        frame_id: int,
+        block_size: int = 1024,
+        memo_embed_scales: Optional[Tensor] = None,
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        """Match scores of the pairs found by the spatial index.
+
+        The scores are the ones of the dense matrix in :meth:`track`. The
+        softmax normalizers of the bisoftmax still cover all the pairs, they
+        are accumulated over blocks of ``block_size`` detections, but the
+        scores and the distance mask are only computed for the candidates.
+
+        Returns:
+            tuple[Tensor, Tensor, Tensor]: Detection index, track index and
+            match score of every candidate pair.
+        """
+        centers = (bboxes[:, :2] + bboxes[:, 2:4]) / 2.0
+        memo_centers = (memo_bboxes[:, :2] + memo_bboxes[:, 2:4]) / 2.0
+        with_distance = self.max_distance != -1 and self.match_score_thr > 0
+        if with_distance:
+            frame_gaps = (frame_id - memo_frame_ids).abs().to(bboxes.device)
+            adaptive_max_distance = self.max_distance * torch.exp(
+                frame_gaps.float() / self.growth_factor
+            )
+            # farther than this, the soft distance mask keeps any match score
+            # (at most 1) under match_score_thr
+            radius = adaptive_max_distance + self.distance_smoothing_factor * math.log(
+                1 / self.match_score_thr
+            )
+        else:
+            radius = memo_centers.new_full((memo_centers.size(0),), float("inf"))
+        rows, cols = radius_pairs(
+            centers,
+            memo_centers,
+            radius,
+            labels if self.with_cats else None,
+            memo_labels if self.with_cats else None,
+        )
+
+        # softmax normalizers over all the pairs, one block of rows at a time,
+        # the similarities of the candidates are picked from the same blocks
+        row_lse, pair_feats = [], []
+        col_lse = embeds.new_full((memo_embeds.size(0),), float("-inf"))
+        block_ends = torch.searchsorted(
+            rows,
+            torch.arange(
+                block_size,
+                embeds.size(0) + block_size,
+                block_size,
+                device=rows.device,
+            ),
+        ).tolist()
+        pair_start = 0
+        for start, pair_end in zip(range(0, embeds.size(0), block_size), block_ends):
+            feats = embed_mm(
+                embeds[start : start + block_size], memo_embeds, memo_embed_scales
+            )
+            row_lse.append(_logsumexp(feats, dim=1))
+            col_lse = torch.logaddexp(col_lse, _logsumexp(feats, dim=0))
+            pair_feats.append(
+                feats[
+                    rows[pair_start:pair_end] - start, cols[pair_start:pair_end]
+                ]
+            )
+            pair_start = pair_end
+        row_lse = torch.cat(row_lse)
+        feats = torch.cat(pair_feats)
+
+        match_scores_bisoftmax = (
+            torch.exp(feats - row_lse[rows]) + torch.exp(feats - col_lse[cols])
+        ) / 2
+        # same as the dot products of the normalized embeddings
+        norms = embeds.norm(p=2, dim=1).clamp(min=1e-12)
+        memo_norms = embed_norms(memo_embeds, memo_embed_scales, embeds.dtype).clamp(
+            min=1e-12
+        )
+        match_scores_cosine = feats / (norms[rows] * memo_norms[cols])
+        match_scores = (match_scores_bisoftmax + match_scores_cosine) / 2
+
+        if with_distance:
+            distances = (centers[rows] - memo_centers[cols]).norm(dim=1)
+            pair_max_distance = adaptive_max_distance[cols]
+            distance_mask = torch.where(
+                distances <= pair_max_distance,
+                torch.ones_like(distances),
+                torch.exp(
+                    -(distances - pair_max_distance) / self.distance_smoothing_factor
+                ),
+            )
+            match_scores = match_scores * distance_mask
+        return rows, cols, match_scores
+
     def track(
         self,
         model: torch.nn.Module,
@@ -282,47 +483,61 @@ class MasaTaoTracker(BaseTracker):
                 memo_ids,
                 memo_frame_ids,
             ) = self.memo
-
-            feats = torch.mm(embeds, memo_embeds.t())
-            d2t_scores = feats.softmax(dim=1)
-            t2d_scores = feats.softmax(dim=0)
-            match_scores_bisoftmax = (d2t_scores + t2d_scores) / 2
-
-            match_scores_cosine = torch.mm(
-                F.normalize(embeds, p=2, dim=1),
-                F.normalize(memo_embeds, p=2, dim=1).t(),
-            )
-
-            match_scores = (match_scores_bisoftmax + match_scores_cosine) / 2
-
-            if self.max_distance != -1:
-
-                # Compute the mask based on spatial proximity
-                current_frame_ids = torch.full(
-                    (bboxes.size(0),), frame_id, dtype=torch.long
+            memo_embed_scales = self.tracks.view("embed_scales")
+
+            if self.use_spatial_index and (
+                (self.max_distance != -1 and self.match_score_thr > 0)
+                or self.with_cats
+            ):
+                rows, cols, pair_scores = self.pair_match_scores(
+                    bboxes,
+                    labels,
+                    embeds,
+                    memo_bboxes,
+                    memo_labels,
+                    memo_embeds,
+                    memo_frame_ids,
+                    frame_id,
+                    memo_embed_scales=memo_embed_scales,
                 )
-                distance_mask = self.compute_distance_mask(
-                    bboxes, memo_bboxes, current_frame_ids, memo_frame_ids
+                # keep bboxes with high object score and remove background bboxes
+                valid = scores[rows] > self.obj_score_thr
+                memo_inds = assign_pairs(
+                    rows[valid],
+                    cols[valid],
+                    pair_scores[valid],
+                    bboxes.size(0),
+                    self.match_score_thr,
+                    self.assign_method,
                 )
-
-                # Apply the mask to the match scores
-                match_scores = match_scores * distance_mask
-
-            # track according to match_scores
-            for i in range(bboxes.size(0)):
-                conf, memo_ind = torch.max(match_scores[i, :], dim=0)
-                id = memo_ids[memo_ind]
-                if conf > self.match_score_thr:
-                    if id > -1:
-                        # keep bboxes with high object score
-                        # and remove background bboxes
-                        if scores[i] > self.obj_score_thr:
-                            ids[i] = id
-                            match_scores[:i, memo_ind] = 0
-                            match_scores[i + 1 :, memo_ind] = 0
+            else:
+                match_scores = self.dense_match_scores(
+                    bboxes,
+                    embeds,
+                    memo_bboxes,
+                    memo_embeds,
+                    memo_frame_ids,
+                    frame_id,
+                    memo_embed_scales=memo_embed_scales,
+                )
+                # track according to match_scores, keep bboxes with high object
+                # score and remove background bboxes
+                match_scores = match_scores.masked_fill(
+                    (scores <= self.obj_score_thr)[:, None], float("-inf")
+                )
+                memo_inds = assign(
+                    match_scores, self.match_score_thr, self.assign_method
+                )
+            matched = memo_inds > -1
+            ids[matched] = memo_ids[memo_inds[matched]]
 
         # initialize new tracks
         new_inds = (ids == -1) & (scores > self.init_score_thr).cpu()
+        if self.reid_gallery is not None:
+            # objects coming back take the id of their expired track
+            new_inds = self.reid_gallery.reidentify(
+                ids, embeds, labels if self.with_cats else None, new_inds
+            )
         num_news = new_inds.sum()
         ids[new_inds] = torch.arange(
             self.num_tracks, self.num_tracks + num_news, dtype=torch.long
@@ -367,9 +582,12 @@ class MasaTaoTracker(BaseTracker):
         else:
             raise NotImplementedError
 
-        for i, ind in enumerate(low_inds):
-            if (ious[i, :ind] > distractor_nms_thr).any():
-                valid_inds[ind] = False
+        # a low score box is a distractor if it overlaps any box before it
+        before = torch.arange(bboxes.size(0), device=ious.device)[None, :] < low_inds[
+            :, None
+        ].to(ious.device)
+        distractors = ((ious > distractor_nms_thr) & before).any(dim=1)
+        valid_inds[low_inds[distractors.to(low_inds.device)]] = False
 
         bboxes = bboxes[valid_inds]
         labels = labels[valid_inds]
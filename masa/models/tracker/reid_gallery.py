@@ -0,0 +1,312 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+STORAGE_DTYPES = dict(int8=torch.int8, float16=torch.float16, float32=torch.float32)
+
+
+class ReIDGallery:
+    """Bounded memory of the embeddings of the expired tracks, which gives
+    their ids back to the objects that come back into view.
+
+    The embeddings are L2-normalized and stored quantized, ``int8`` with one
+    scale per entry by default. When the gallery is full, the entries whose
+    tracks were seen the longest ago are evicted first, and with ``max_age``
+    the entries are also evicted once their tracks have not been seen for
+    that many frames.
+
+    The search is an exact cosine similarity, computed with one matrix
+    product per block of ``block_size`` entries. With ``num_lists`` > 0, the
+    entries are partitioned by a spherical k-means once the gallery holds
+    ``train_size`` of them, and a query is only compared to the entries of
+    its ``num_probes`` closest lists, which bounds the cost of a lookup by
+    the size of the lists instead of the size of the gallery.
+
+    Args:
+        capacity (int): Maximum number of entries. Defaults to 1000.
+        max_age (int): Frames after which an entry is evicted, -1 to keep
+            the entries until the gallery is full. Defaults to -1.
+        match_thr (float): Minimum cosine similarity of a detection to an
+            entry to take its id. Defaults to 0.7.
+        storage (str): Dtype of the stored embeddings, 'int8', 'float16' or
+            'float32'. Defaults to 'int8'.
+        num_lists (int): Number of partitions of the gallery, 0 for an
+            exhaustive search. Defaults to 0.
+        num_probes (int): Number of partitions searched by a query.
+            Defaults to 4.
+        train_size (int, optional): Number of entries the partitions are
+            computed from, at most ``capacity``. Defaults to
+            ``32 * num_lists``.
+        block_size (int): Number of entries per matrix product of the
+            exhaustive search. Defaults to 4096.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 1000,
+        max_age: int = -1,
+        match_thr: float = 0.7,
+        storage: str = "int8",
+        num_lists: int = 0,
+        num_probes: int = 4,
+        train_size: Optional[int] = None,
+        block_size: int = 4096,
+    ) -> None:
+        assert capacity > 0
+        assert storage in STORAGE_DTYPES
+        assert num_lists >= 0 and num_probes > 0
+        self.capacity = capacity
+        self.max_age = max_age
+        self.match_thr = match_thr
+        self.storage = storage
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        train_size = 32 * num_lists if train_size is None else train_size
+        self.train_size = min(train_size, capacity)
+        assert self.train_size >= num_lists
+        self.block_size = block_size
+
+        self.size = 0
+        self.ids = torch.zeros((0,), dtype=torch.long)
+        self.last_frames = torch.zeros((0,), dtype=torch.long)
+        self.codes = None
+        self.scales = None
+        self.labels = None
+        self.lists = None
+        self.centroids = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def state_dict(self) -> dict:
+        """Copy of the entries and the partitions, on the CPU."""
+        state = dict(size=self.size, centroids=None)
+        for name in ["ids", "last_frames", "codes", "scales", "labels", "lists"]:
+            value = getattr(self, name)
+            state[name] = None if value is None else value[: self.size].cpu().clone()
+        if self.centroids is not None:
+            state["centroids"] = self.centroids.cpu().clone()
+        return state
+
+    def load_state_dict(self, state: dict, device: Optional[torch.device] = None) -> None:
+        """Restore the entries of :meth:`state_dict`, the embeddings on
+        ``device`` (kept where they are loaded by default)."""
+        assert state["size"] <= self.capacity
+
+        self.size = state["size"]
+        if state["codes"] is None:
+            self.ids = torch.zeros((0,), dtype=torch.long)
+            self.last_frames = torch.zeros((0,), dtype=torch.long)
+            self.codes = self.scales = self.labels = self.lists = None
+        else:
+            # preallocated to the capacity, like in add
+            for name in ["ids", "last_frames", "codes", "scales", "labels", "lists"]:
+                value = state[name]
+                value = value.cpu() if name in ["ids", "last_frames"] else value.to(device)
+                full = value.new_zeros((self.capacity,) + tuple(value.shape[1:]))
+                full[: self.size] = value
+                setattr(self, name, full)
+        self.centroids = state["centroids"]
+        if self.centroids is not None:
+            self.centroids = self.centroids.to(device, copy=True)
+
+    def _quantize(self, embeds: Tensor) -> Tuple[Tensor, Tensor]:
+        embeds = F.normalize(embeds.float(), p=2, dim=1)
+        if self.storage != "int8":
+            return embeds.to(STORAGE_DTYPES[self.storage]), embeds.new_ones(embeds.size(0))
+        scales = embeds.abs().amax(dim=1).clamp(min=1e-12) / 127
+        codes = torch.round(embeds / scales[:, None]).to(torch.int8)
+        return codes, scales
+
+    def _dequantize(self, rows: Optional[Tensor] = None) -> Tensor:
+        codes = self.codes[: self.size] if rows is None else self.codes[rows]
+        scales = self.scales[: self.size] if rows is None else self.scales[rows]
+        return codes.float() * scales[:, None]
+
+    def _select(self, rows: Tensor) -> None:
+        """Keep the rows ``rows`` (CPU tensor), in that order."""
+        for name in ["ids", "last_frames"]:
+            value = getattr(self, name)
+            value[: rows.numel()] = value[rows]
+        rows_dev = rows.to(self.codes.device)
+        for name in ["codes", "scales", "labels", "lists"]:
+            value = getattr(self, name)
+            value[: rows.numel()] = value[rows_dev]
+        self.size = rows.numel()
+
+    def _assign_lists(self, embeds: Tensor) -> Tensor:
+        return torch.mm(embeds, self.centroids.t()).argmax(dim=1)
+
+    def _train(self, num_iters: int = 10) -> None:
+        """Spherical k-means of the entries into ``num_lists`` partitions."""
+        embeds = self._dequantize()
+        embeds = F.normalize(embeds, p=2, dim=1)
+        g = torch.Generator().manual_seed(0)
+        init = torch.randperm(self.size, generator=g)[: self.num_lists]
+        centroids = embeds[init.to(embeds.device)]
+        for _ in range(num_iters):
+            lists = torch.mm(embeds, centroids.t()).argmax(dim=1)
+            sums = centroids.new_zeros(centroids.shape).index_add_(0, lists, embeds)
+            counts = torch.bincount(lists, minlength=self.num_lists)
+            # empty lists keep their centroid
+            sums[counts == 0] = centroids[counts == 0]
+            centroids = F.normalize(sums, p=2, dim=1)
+        self.centroids = centroids
+        self.lists[: self.size] = self._assign_lists(embeds)
+
+    def add(self, ids: Tensor, embeds: Tensor, labels: Tensor, last_frames: Tensor) -> None:
+        """Store the embeddings of expired tracks, evicting the entries seen
+        the longest ago if the gallery is full."""
+        ids = ids.cpu()
+        last_frames = last_frames.cpu()
+        if ids.numel() == 0:
+            return
+        codes, scales = self._quantize(embeds)
+        if self.codes is None:
+            self.ids = torch.zeros((self.capacity,), dtype=torch.long)
+            self.last_frames = torch.zeros((self.capacity,), dtype=torch.long)
+            self.codes = codes.new_zeros((self.capacity, codes.size(1)))
+            self.scales = scales.new_zeros((self.capacity,))
+            self.labels = labels.new_zeros((self.capacity,))
+            self.lists = torch.zeros((self.capacity,), dtype=torch.long, device=codes.device)
+
+        if self.size + ids.numel() > self.capacity:
+            # least recently seen first, the new entries being the most recent
+            all_frames = torch.cat([self.last_frames[: self.size], last_frames])
+            order = torch.argsort(all_frames, descending=True, stable=True)
+            keep = order[: self.capacity]
+            keep_old = keep[keep < self.size].sort()[0]
+            keep_new = keep[keep >= self.size].sort()[0] - self.size
+            self._select(keep_old)
+            ids, last_frames = ids[keep_new], last_frames[keep_new]
+            keep_new = keep_new.to(codes.device)
+            codes, scales, labels = codes[keep_new], scales[keep_new], labels[keep_new]
+
+        start, end = self.size, self.size + ids.numel()
+        self.ids[start:end] = ids
+        self.last_frames[start:end] = last_frames
+        self.codes[start:end] = codes
+        self.scales[start:end] = scales
+        self.labels[start:end] = labels
+        self.size = end
+        if self.num_lists > 0:
+            if self.centroids is not None:
+                rows = torch.arange(start, end, device=codes.device)
+                self.lists[start:end] = self._assign_lists(self._dequantize(rows))
+            elif self.size >= self.train_size:
+                self._train()
+
+    def remove(self, ids: Tensor) -> None:
+        """Remove the entries of ``ids``."""
+        if self.size == 0 or ids.numel() == 0:
+            return
+        keep = ~torch.isin(self.ids[: self.size], ids.cpu())
+        if not keep.all():
+            self._select(torch.nonzero(keep, as_tuple=False).squeeze(1))
+
+    def evict(self, frame_id: int) -> None:
+        """Remove the entries older than ``max_age`` frames."""
+        if self.max_age < 0 or self.size == 0:
+            return
+        keep = (frame_id - self.last_frames[: self.size]) <= self.max_age
+        if not keep.all():
+            self._select(torch.nonzero(keep, as_tuple=False).squeeze(1))
+
+    def _search_exhaustive(self, queries: Tensor, labels: Optional[Tensor]) -> Tuple[Tensor, Tensor]:
+        best_scores = queries.new_full((queries.size(0),), float("-inf"))
+        best_rows = torch.zeros((queries.size(0),), dtype=torch.long, device=queries.device)
+        for start in range(0, self.size, self.block_size):
+            end = min(start + self.block_size, self.size)
+            scores = torch.mm(queries, self.codes[start:end].float().t()) * self.scales[start:end]
+            if labels is not None:
+                scores = scores.masked_fill(labels[:, None] != self.labels[None, start:end], float("-inf"))
+            block_scores, block_rows = scores.max(dim=1)
+            better = block_scores > best_scores
+            best_scores = torch.where(better, block_scores, best_scores)
+            best_rows = torch.where(better, block_rows + start, best_rows)
+        return best_scores, best_rows
+
+    def _search_lists(self, queries: Tensor, labels: Optional[Tensor]) -> Tuple[Tensor, Tensor]:
+        lists = self.lists[: self.size]
+        num_probes = min(self.num_probes, self.num_lists)
+        probes = torch.mm(queries, self.centroids.t()).topk(num_probes, dim=1)[1]
+        best_scores = queries.new_full((queries.size(0),), float("-inf"))
+        best_rows = torch.zeros((queries.size(0),), dtype=torch.long, device=queries.device)
+        # one matrix product per probed list, with the queries probing it
+        for list_id in torch.unique(probes).tolist():
+            query_inds = torch.nonzero((probes == list_id).any(dim=1), as_tuple=False).squeeze(1)
+            rows = torch.nonzero(lists == list_id, as_tuple=False).squeeze(1)
+            if rows.numel() == 0:
+                continue
+            scores = torch.mm(queries[query_inds], self._dequantize(rows).t())
+            if labels is not None:
+                scores = scores.masked_fill(
+                    labels[query_inds][:, None] != self.labels[rows][None], float("-inf")
+                )
+            list_scores, list_rows = scores.max(dim=1)
+            better = list_scores > best_scores[query_inds]
+            best_scores[query_inds[better]] = list_scores[better]
+            best_rows[query_inds[better]] = rows[list_rows[better]]
+        return best_scores, best_rows
+
+    def search(self, embeds: Tensor, labels: Optional[Tensor] = None) -> Tensor:
+        """Id of the best entry of every embedding, -1 if its similarity is
+        not above ``match_thr``.
+
+        Args:
+            embeds (Tensor): Embeddings of shape (N, C).
+            labels (Tensor, optional): Labels of shape (N, ). If given, only
+                the entries of the same label are searched.
+
+        Returns:
+            Tensor: Ids of shape (N, ) on the CPU. An id is given to one
+            embedding at most, the first one.
+        """
+        ids = torch.full((embeds.size(0),), -1, dtype=torch.long)
+        if self.size == 0 or embeds.size(0) == 0:
+            return ids
+        queries = F.normalize(embeds.float(), p=2, dim=1)
+        if self.num_lists > 0 and self.centroids is not None:
+            best_scores, best_rows = self._search_lists(queries, labels)
+        else:
+            best_scores, best_rows = self._search_exhaustive(queries, labels)
+        matched = (best_scores > self.match_thr).cpu()
+        best_ids = self.ids[best_rows.cpu()]
+        taken = set()
+        for i in torch.nonzero(matched, as_tuple=False).squeeze(1).tolist():
+            id = int(best_ids[i])
+            if id not in taken:
+                ids[i] = id
+                taken.add(id)
+        return ids
+
+    def reidentify(
+        self, ids: Tensor, embeds: Tensor, labels: Optional[Tensor], new_inds: Tensor
+    ) -> Tensor:
+        """Give the ids of the gallery to the new objects that match them.
+
+        The ids of the detections ``new_inds`` are set in place to the ids
+        of their matches, which are removed from the gallery since their
+        tracks are live again.
+
+        Returns:
+            Tensor: ``new_inds`` without the re-identified detections.
+        """
+        if self.size == 0 or not new_inds.any():
+            return new_inds
+        inds = torch.nonzero(new_inds, as_tuple=False).squeeze(1)
+        inds_dev = inds.to(embeds.device)
+        found = self.search(embeds[inds_dev], None if labels is None else labels[inds_dev])
+        reidentified = found > -1
+        ids[inds[reidentified]] = found[reidentified]
+        self.remove(found[reidentified])
+        new_inds = new_inds.clone()
+        new_inds[inds[reidentified]] = False
+        return new_inds
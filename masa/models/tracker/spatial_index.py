@@ -0,0 +1,115 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+from typing import Optional, Tuple
+
+import torch
+from torch import Tensor
+
+_NEIGHBOUR_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+
+def _expand_ranges(starts: Tensor, counts: Tensor) -> Tuple[Tensor, Tensor]:
+    """Owner and position of every element of the ranges
+    ``[starts[i], starts[i] + counts[i])``."""
+    owners = torch.repeat_interleave(torch.arange(counts.numel(), device=counts.device), counts)
+    range_starts = torch.cumsum(counts, dim=0) - counts
+    offsets = torch.arange(owners.numel(), device=counts.device) - range_starts[owners]
+    return owners, starts[owners] + offsets
+
+
+def _grid_pairs(
+    query_points: Tensor,
+    ref_points: Tensor,
+    radius: float,
+    query_labels: Optional[Tensor] = None,
+    ref_labels: Optional[Tensor] = None,
+) -> Tuple[Tensor, Tensor]:
+    """Pairs within ``radius`` of each other, through a uniform grid hash.
+
+    The grid cells are ``radius`` wide, so the neighbours of a query are in
+    the 3x3 cells around its own. With labels, the label is part of the cell
+    key and only the pairs of the same label are found.
+    """
+    cell_size = max(radius, 1e-3)
+    query_cells = torch.floor(query_points / cell_size).long()
+    ref_cells = torch.floor(ref_points / cell_size).long()
+    low = torch.minimum(query_cells.min(dim=0)[0], ref_cells.min(dim=0)[0]) - 1
+    query_cells = query_cells - low
+    ref_cells = ref_cells - low
+    span = torch.maximum(query_cells.max(dim=0)[0], ref_cells.max(dim=0)[0]) + 2
+
+    def cell_keys(cells, labels):
+        keys = cells[:, 0] * span[1] + cells[:, 1]
+        if labels is not None:
+            keys = keys + labels.long() * (span[0] * span[1])
+        return keys
+
+    ref_keys = cell_keys(ref_cells, ref_labels)
+    ref_keys, order = ref_keys.sort()
+
+    rows, cols = [], []
+    for dx, dy in _NEIGHBOUR_OFFSETS:
+        offset = query_cells.new_tensor([dx, dy])
+        keys = cell_keys(query_cells + offset, query_labels)
+        starts = torch.searchsorted(ref_keys, keys)
+        counts = torch.searchsorted(ref_keys, keys, right=True) - starts
+        owners, positions = _expand_ranges(starts, counts)
+        rows.append(owners)
+        cols.append(order[positions])
+    rows = torch.cat(rows)
+    cols = torch.cat(cols)
+
+    distances = (query_points[rows] - ref_points[cols]).pow(2).sum(dim=1)
+    keep = distances <= radius * radius
+    return rows[keep], cols[keep]
+
+
+def radius_pairs(
+    query_points: Tensor,
+    ref_points: Tensor,
+    radius: Tensor,
+    query_labels: Optional[Tensor] = None,
+    ref_labels: Optional[Tensor] = None,
+) -> Tuple[Tensor, Tensor]:
+    """Find the pairs ``(i, j)`` with ``|query_i - ref_j| <= radius_j``.
+
+    The references are grouped by radius, which for the trackers only
+    depends on the number of frames since the track was seen, and every group
+    is searched with a grid of its own radius. An infinite radius only blocks
+    by label.
+
+    Args:
+        query_points (Tensor): Points of shape (N, 2).
+        ref_points (Tensor): Points of shape (M, 2).
+        radius (Tensor): Search radius of every reference, of shape (M, ).
+        query_labels (Tensor, optional): Labels of shape (N, ). If given with
+            ``ref_labels``, only the pairs of the same label are returned.
+        ref_labels (Tensor, optional): Labels of shape (M, ).
+
+    Returns:
+        tuple[Tensor, Tensor]: Query and reference index of every pair,
+        sorted by query then reference.
+    """
+    if query_labels is None or ref_labels is None:
+        query_labels = ref_labels = None
+    rows = [query_points.new_zeros((0,), dtype=torch.long)]
+    cols = [query_points.new_zeros((0,), dtype=torch.long)]
+    if query_points.size(0) > 0 and ref_points.size(0) > 0:
+        for group_radius in torch.unique(radius).tolist():
+            ref_inds = torch.nonzero(radius == group_radius, as_tuple=False).squeeze(1)
+            group_rows, group_cols = _grid_pairs(
+                query_points,
+                ref_points[ref_inds],
+                group_radius,
+                query_labels,
+                None if ref_labels is None else ref_labels[ref_inds],
+            )
+            rows.append(group_rows)
+            cols.append(ref_inds[group_cols])
+    rows = torch.cat(rows)
+    cols = torch.cat(cols)
+    order = torch.argsort(rows * max(ref_points.size(0), 1) + cols)
+    return rows[order], cols[order]
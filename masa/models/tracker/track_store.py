@@ -0,0 +1,311 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+from typing import Dict, List, Optional
+
+import torch
+from torch import Tensor
+
+from .embed_storage import EMBED_DTYPES, dequantize_embeds, quantize_embeds
+
+
+class TrackStore:
+    """Structure-of-arrays memory of the live tracks of a tracker.
+
+    Every attribute of the tracks is kept in one preallocated tensor, which
+    grows by doubling. Rows ``[0, len(store))`` hold the live tracks sorted by
+    id, which is also their creation order, so ``ids`` doubles as the id index
+    (looked up with ``searchsorted``) and the memory keeps the order of the
+    former ``dict`` of tracks.
+
+    The ids and the last frame ids are kept on the CPU, like the ids of the
+    trackers, the other attributes on the device of the detections.
+
+    The embeddings can be stored in a smaller dtype (see
+    :func:`quantize_embeds`), ``int8`` with their scales in ``embed_scales``.
+    :meth:`view` then gives the stored values, to be used with the functions
+    of ``embed_storage``.
+
+    Args:
+        with_velocity (bool): Whether to keep the mean velocity of the boxes
+            of the tracks. Defaults to False.
+        capacity (int): Number of rows allocated at the first update.
+            Defaults to 64.
+        embed_dtype (str, optional): Dtype of the stored embeddings,
+            'float32', 'float16', 'bfloat16' or 'int8'. Defaults to None,
+            the dtype of the embeddings of the first update.
+    """
+
+    def __init__(
+        self, with_velocity: bool = False, capacity: int = 64, embed_dtype: Optional[str] = None
+    ) -> None:
+        assert capacity > 0
+        assert embed_dtype is None or embed_dtype in EMBED_DTYPES
+        self.with_velocity = with_velocity
+        self.init_capacity = capacity
+        self.embed_dtype = embed_dtype
+        self.size = 0
+        self.ids = torch.zeros((0,), dtype=torch.long)
+        self.last_frames = torch.zeros((0,), dtype=torch.long)
+        self.bboxes = None
+        self.embeds = None
+        self.embed_scales = None
+        self.labels = None
+        self.scores = None
+        self.velocities = None
+        self.acc_frames = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, id: int) -> bool:
+        return self.find(torch.tensor([int(id)]))[0].item() >= 0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, id: int) -> Dict[str, Tensor]:
+        """Attributes of one track, as in the former ``dict`` of tracks."""
+        row = self.find(torch.tensor([int(id)]))[0].item()
+        if row < 0:
+            raise KeyError(id)
+        track = dict(
+            bbox=self.bboxes[row],
+            embed=self.get_embeds(slice(row, row + 1))[0],
+            label=self.labels[row],
+            score=self.scores[row],
+            last_frame=int(self.last_frames[row]),
+        )
+        if self.with_velocity:
+            track["velocity"] = self.velocities[row]
+            track["acc_frame"] = int(self.acc_frames[row])
+        return track
+
+    def keys(self) -> List[int]:
+        return self.ids[: self.size].tolist()
+
+    @property
+    def device(self) -> Optional[torch.device]:
+        return None if self.bboxes is None else self.bboxes.device
+
+    def view(self, name: str) -> Tensor:
+        """Zero-copy view of the live rows of an attribute.
+
+        The view shares the storage of the store, it is only valid until the
+        next :meth:`update`. None for the attributes which are not kept.
+        """
+        value = getattr(self, name)
+        return None if value is None else value[: self.size]
+
+    def get_embeds(self, rows, dtype: Optional[torch.dtype] = None) -> Tensor:
+        """Dequantized embeddings of ``rows`` (index or slice on the device
+        of the store), see :func:`dequantize_embeds`."""
+        scales = None if self.embed_scales is None else self.embed_scales[rows]
+        return dequantize_embeds(self.embeds[rows], scales, dtype)
+
+    def _set_embeds(self, rows, embeds: Tensor) -> None:
+        values, scales = quantize_embeds(embeds, self.embed_dtype)
+        self.embeds[rows] = values
+        if scales is not None:
+            self.embed_scales[rows] = scales
+
+    def find(self, ids: Tensor) -> Tensor:
+        """Rows of ``ids`` (CPU tensor), -1 for the ids which are not live."""
+        if self.size == 0:
+            return torch.full_like(ids, -1)
+        live_ids = self.ids[: self.size]
+        rows = torch.searchsorted(live_ids, ids).clamp(max=self.size - 1)
+        return torch.where(live_ids[rows] == ids, rows, torch.full_like(rows, -1))
+
+    def state_dict(self) -> Dict[str, Optional[Tensor]]:
+        """Copy of the live tracks, on the CPU so that it can be saved and
+        loaded on any device."""
+        names = ["ids", "last_frames", "bboxes", "embeds", "embed_scales", "labels", "scores"]
+        if self.with_velocity:
+            names += ["velocities", "acc_frames"]
+        state = dict(with_velocity=self.with_velocity, size=self.size)
+        for name in names:
+            value = getattr(self, name)
+            state[name] = None if value is None else value[: self.size].cpu().clone()
+        return state
+
+    def load_state_dict(self, state: dict, device: Optional[torch.device] = None) -> None:
+        """Restore the tracks of :meth:`state_dict`, the attributes other
+        than the ids and the last frame ids on ``device`` (kept where they
+        are loaded by default)."""
+        assert state["with_velocity"] == self.with_velocity
+        self.size = state["size"]
+        self.ids = state["ids"].to("cpu", copy=True)
+        self.last_frames = state["last_frames"].to("cpu", copy=True)
+        names = ["bboxes", "embeds", "embed_scales", "labels", "scores", "velocities", "acc_frames"]
+        for name in names:
+            value = state.get(name)
+            setattr(self, name, None if value is None else value.to(device, copy=True))
+
+    def _allocate(self, bboxes: Tensor, embeds: Tensor, labels: Tensor, scores: Tensor, capacity: int) -> None:
+        def empty_like(value, rows):
+            return value.new_zeros((rows,) + tuple(value.shape[1:]))
+
+        if self.bboxes is None:
+            self.bboxes = empty_like(bboxes, capacity)
+            if self.embed_dtype is None:
+                self.embeds = empty_like(embeds, capacity)
+            else:
+                self.embeds = embeds.new_zeros(
+                    (capacity, embeds.size(1)), dtype=EMBED_DTYPES[self.embed_dtype]
+                )
+            if self.embed_dtype == "int8":
+                self.embed_scales = embeds.new_zeros((capacity,), dtype=torch.float32)
+            self.labels = empty_like(labels, capacity)
+            self.scores = empty_like(scores, capacity)
+            if self.with_velocity:
+                self.velocities = empty_like(bboxes, capacity)
+                self.acc_frames = torch.zeros((capacity,), dtype=torch.long, device=bboxes.device)
+            self.ids = torch.zeros((capacity,), dtype=torch.long)
+            self.last_frames = torch.zeros((capacity,), dtype=torch.long)
+            return
+
+        names = ["ids", "last_frames", "bboxes", "embeds", "labels", "scores"]
+        if self.embed_scales is not None:
+            names.append("embed_scales")
+        if self.with_velocity:
+            names += ["velocities", "acc_frames"]
+        for name in names:
+            old = getattr(self, name)
+            new = empty_like(old, capacity)
+            new[: self.size] = old[: self.size]
+            setattr(self, name, new)
+
+    def update(
+        self,
+        ids: Tensor,
+        bboxes: Tensor,
+        embeds: Tensor,
+        labels: Tensor,
+        scores: Tensor,
+        frame_id: int,
+        momentum: float,
+    ) -> None:
+        """Update the matched tracks and add the new ones, all at once.
+
+        The embeddings of the matched tracks are updated with
+        ``(1 - momentum) * embed + momentum * new_embed``, in the dtype of
+        ``embeds``. ``ids`` must be unique and >= 0.
+        """
+        ids = ids.cpu()
+        if ids.numel() == 0:
+            return
+        rows = self.find(ids)
+        matched = rows >= 0
+
+        if matched.any():
+            rows_cpu = rows[matched]
+            rows_dev = rows_cpu.to(self.device)
+            src = torch.nonzero(matched, as_tuple=False).squeeze(1).to(bboxes.device)
+            new_bboxes = bboxes[src]
+            if self.with_velocity:
+                frame_gaps = (frame_id - self.last_frames[rows_cpu]).to(self.device)
+                velocity = (new_bboxes - self.bboxes[rows_dev]) / frame_gaps[:, None]
+                acc_frames = self.acc_frames[rows_dev]
+                self.velocities[rows_dev] = (
+                    self.velocities[rows_dev] * acc_frames[:, None] + velocity
+                ) / (acc_frames[:, None] + 1)
+                self.acc_frames[rows_dev] = acc_frames + 1
+            self.bboxes[rows_dev] = new_bboxes
+            self._set_embeds(
+                rows_dev,
+                (1 - momentum) * self.get_embeds(rows_dev, embeds.dtype)
+                + momentum * embeds[src],
+            )
+            self.labels[rows_dev] = labels[src]
+            self.scores[rows_dev] = scores[src]
+            self.last_frames[rows_cpu] = frame_id
+
+        if not matched.all():
+            new = torch.nonzero(~matched, as_tuple=False).squeeze(1)
+            num_new = new.numel()
+            capacity = 0 if self.bboxes is None else self.bboxes.size(0)
+            if self.size + num_new > capacity:
+                capacity = max(capacity, self.init_capacity)
+                while capacity < self.size + num_new:
+                    capacity *= 2
+                self._allocate(bboxes, embeds, labels, scores, capacity)
+            start, end = self.size, self.size + num_new
+            src = new.to(bboxes.device)
+            self.ids[start:end] = ids[new]
+            self.last_frames[start:end] = frame_id
+            self.bboxes[start:end] = bboxes[src]
+            self._set_embeds(slice(start, end), embeds[src])
+            self.labels[start:end] = labels[src]
+            self.scores[start:end] = scores[src]
+            if self.with_velocity:
+                self.velocities[start:end] = 0
+                self.acc_frames[start:end] = 0
+            self.size = end
+            # new ids usually come after the live ones, sort them otherwise
+            appended = self.ids[max(start - 1, 0) : end]
+            if not bool((appended[1:] > appended[:-1]).all()):
+                self._select(torch.argsort(self.ids[:end]))
+
+    def _select(self, rows: Tensor) -> None:
+        """Keep the rows ``rows`` (CPU tensor), in that order."""
+        names = ["ids", "last_frames"]
+        for name in names:
+            value = getattr(self, name)
+            value[: rows.numel()] = value[rows]
+        rows_dev = rows.to(self.device)
+        names = ["bboxes", "embeds", "labels", "scores"]
+        if self.embed_scales is not None:
+            names.append("embed_scales")
+        if self.with_velocity:
+            names += ["velocities", "acc_frames"]
+        for name in names:
+            value = getattr(self, name)
+            value[: rows.numel()] = value[rows_dev]
+        self.size = rows.numel()
+
+    def predict(self, frame_id: int) -> Dict[str, Tensor]:
+        """The tracks of the last updated frame, moved to ``frame_id`` with
+        their mean velocity (not moved without velocities).
+
+        Returns:
+            dict[str, Tensor]: ``ids``, ``bboxes``, ``labels`` and ``scores``.
+        """
+        if self.size == 0:
+            return dict(ids=self.ids[:0], bboxes=None, labels=None, scores=None)
+        last_frames = self.last_frames[: self.size]
+        rows = torch.nonzero(last_frames == last_frames.max(), as_tuple=False).squeeze(1)
+        rows_dev = rows.to(self.device)
+        bboxes = self.bboxes[rows_dev]
+        if self.with_velocity:
+            gaps = (frame_id - last_frames[rows]).to(self.device)
+            bboxes = bboxes + self.velocities[rows_dev] * gaps[:, None]
+        return dict(
+            ids=self.ids[rows],
+            bboxes=bboxes,
+            labels=self.labels[rows_dev],
+            scores=self.scores[rows_dev],
+        )
+
+    def pop_expired(self, frame_id: int, memo_frames: int) -> Optional[Dict[str, Tensor]]:
+        """Remove the tracks not updated in the last ``memo_frames`` frames.
+
+        Returns:
+            dict[str, Tensor] | None: ``ids``, ``embeds``, ``labels`` and
+            ``last_frames`` of the removed tracks, None if there are none.
+        """
+        keep = (frame_id - self.last_frames[: self.size]) < memo_frames
+        if keep.all():
+            return None
+        expired = torch.nonzero(~keep, as_tuple=False).squeeze(1)
+        expired_dev = expired.to(self.device)
+        popped = dict(
+            ids=self.ids[expired],
+            embeds=self.get_embeds(expired_dev),
+            labels=self.labels[expired_dev],
+            last_frames=self.last_frames[expired],
+        )
+        self._select(torch.nonzero(keep, as_tuple=False).squeeze(1))
+        return popped
@@ -0,0 +1,172 @@
+"""
+Author: Siyuan Li
+Licensed: Apache-2.0 License
+"""
+
+import inspect
+from importlib import import_module
+from typing import Any, List
+
+# Modules registered by MASA, as ``{registry: {name: implementing module}}``.
+# ``import masa`` only registers a stub for each of them, the implementing
+# module is imported the first time the stub is built, so a process pays for
+# the modules its config actually uses. The implementing modules register
+# with ``force=True`` to replace their stub.
+#
+# ``GroundingDINO`` is not listed, its name is also used by mmdet, it is
+# registered when ``GroundingDINOMasa`` is imported.
+LAZY_MODULES = {
+    "MODELS": {
+        "MASA": "masa.models.mot.masa",
+        "MasaTaoTracker": "masa.models.tracker.masa_tao_tracker",
+        "MasaBDDTracker": "masa.models.tracker.masa_bdd_tracker",
+        "MasaTrackHead": "masa.models.roi_heads.track_heads.masa_track_head",
+        "SimpleFPN": "masa.models.necks.simplefpn",
+        "DeformFusion": "masa.models.necks.deform_fusion",
+        "UnbiasedContrastLoss": "masa.models.losses.unbiased_contrastive_loss",
+        "GroundingDINOMasa": "masa.models.detectors.gdino_masa",
+        "DeticMasa": "masa.models.detectors.detic_masa",
+        "SamMasa": "masa.models.detectors.sam_masa",
+        "Sam": "masa.models.sam.sam",
+        "ImageEncoderViT": "masa.models.sam.image_encoder",
+        "MaskDecoder": "masa.models.sam.mask_decoder",
+        "PromptEncoder": "masa.models.sam.prompt_encoder",
+    },
+    "DATASETS": {
+        "MASADataset": "masa.datasets.masa_dataset",
+        "BDDVideoDataset": "masa.datasets.bdd_masa_dataset",
+        "Taov05Dataset": "masa.datasets.tao_masa_dataset",
+        "Taov1Dataset": "masa.datasets.tao_masa_dataset",
+        "RandomSampleConcatDataset": "masa.datasets.rsconcat_dataset",
+        "RandomSampleJointVideoConcatDataset": "masa.datasets.rsconcat_dataset",
+        "SeqMultiImageMixDataset": "masa.datasets.dataset_wrappers",
+        "SeqRandomMultiImageVideoMixDataset": "masa.datasets.dataset_wrappers",
+    },
+    "TRANSFORMS": {
+        "PackMatchInputs": "masa.datasets.pipelines.formatting",
+        "LoadMatchAnnotations": "masa.datasets.pipelines.loading",
+        "MixUniformRefFrameSample": "masa.datasets.pipelines.framesample",
+        "SeqMosaic": "masa.datasets.pipelines.transforms",
+        "SeqMixUp": "masa.datasets.pipelines.transforms",
+        "SeqCopyPaste": "masa.datasets.pipelines.transforms",
+        "SeqRandomAffine": "masa.datasets.pipelines.transforms",
+        "FilterMatchAnnotations": "masa.datasets.pipelines.transforms",
+    },
+    "MMCV_TRANSFORMS": {
+        "MasaTransformBroadcaster": "masa.datasets.pipelines.wrappers",
+    },
+    "METRICS": {
+        "TaoTETAMetric": "masa.datasets.evaluation.tao_teta_metric",
+        "BDDTETAMetric": "masa.datasets.evaluation.bdd_teta_metric",
+    },
+    "VISUALIZERS": {
+        "MasaTrackLocalVisualizer": "masa.visualization.visualizer",
+    },
+    "DATA_SAMPLERS": {
+        "HybridVideoImgSampler": "masa.datasets.samplers.hybrid_video_img_sampler",
+    },
+    "COLLATE_FUNCTIONS": {
+        "yolow_collate": "masa.datasets.utils",
+    },
+}
+
+# Public names of the lazy packages, as ``{name: implementing module}``.
+LAZY_ATTRS = {
+    name: module for modules in LAZY_MODULES.values() for name, module in modules.items()
+}
+LAZY_ATTRS.update(
+    {
+        "GroundingDINO": "masa.models.detectors.grounding_dino",
+        "PromptEmbeddingCache": "masa.models.detectors.prompt_cache",
+        "PROMPT_CACHE": "masa.models.detectors.prompt_cache",
+        "TwoWayTransformer": "masa.models.sam.transformer",
+        "SamPredictor": "masa.models.sam.predictor",
+        "SamAutomaticMaskGenerator": "masa.models.sam.automatic_mask_generator",
+        "sam_model_registry": "masa.models.sam.build_sam",
+        "TrackStore": "masa.models.tracker.track_store",
+        "ReIDGallery": "masa.models.tracker.reid_gallery",
+        "KeyframeScheduler": "masa.models.tracker.keyframe_scheduler",
+        "DetArtifactWriter": "masa.models.tracker.det_artifacts",
+        "load_det_artifacts": "masa.models.tracker.det_artifacts",
+        "replay_det_artifacts": "masa.models.tracker.det_artifacts",
+        "FeatureStore": "masa.models.mot.feature_store",
+        "PublicDets": "masa.models.mot.public_dets",
+    }
+)
+
+
+def _get_registries() -> dict:
+    from mmcv.transforms import TRANSFORMS as MMCV_TRANSFORMS
+    from mmdet.registry import (DATA_SAMPLERS, DATASETS, METRICS, MODELS,
+                                TRANSFORMS, VISUALIZERS)
+    from mmengine.dataset import COLLATE_FUNCTIONS
+
+    return dict(
+        MODELS=MODELS,
+        DATASETS=DATASETS,
+        TRANSFORMS=TRANSFORMS,
+        MMCV_TRANSFORMS=MMCV_TRANSFORMS,
+        METRICS=METRICS,
+        VISUALIZERS=VISUALIZERS,
+        DATA_SAMPLERS=DATA_SAMPLERS,
+        COLLATE_FUNCTIONS=COLLATE_FUNCTIONS,
+    )
+
+
+def _lazy_stub(registry, name: str, module: str):
+    """Build a registry entry which imports ``module`` when it is called,
+    then builds the object registered by that module in its place."""
+
+    def stub(*args, **kwargs):
+        from mmengine.utils import ManagerMixin
+
+        import_module(module)
+        obj_cls = registry.module_dict.get(name)
+        if obj_cls is None or obj_cls is stub:
+            raise KeyError(f"{module} does not register {name} in {registry.name}")
+        if inspect.isclass(obj_cls) and issubclass(obj_cls, ManagerMixin):
+            return obj_cls.get_instance(*args, **kwargs)
+        return obj_cls(*args, **kwargs)
+
+    stub.__name__ = stub.__qualname__ = name
+    stub.__module__ = module
+    return stub
+
+
+def register_lazy_modules() -> None:
+    """Register a stub for every MASA module which is not registered yet."""
+    registries = _get_registries()
+    for registry_name, modules in LAZY_MODULES.items():
+        registry = registries[registry_name]
+        for name, module in modules.items():
+            if name not in registry.module_dict:
+                registry.register_module(
+                    name=name, module=_lazy_stub(registry, name, module)
+                )
+
+
+def import_lazy_modules() -> None:
+    """Import every MASA module up front, as ``import masa`` used to do."""
+    for module in sorted(set(LAZY_ATTRS.values())):
+        import_module(module)
+
+
+def lazy_names(package: str) -> List[str]:
+    """Public names of the lazy ``package``."""
+    return [name for name, module in LAZY_ATTRS.items() if module.startswith(package + ".")]
+
+
+def lazy_getattr(package: str, name: str) -> Any:
+    """Module ``__getattr__`` of the lazy packages, which imports the
+    implementing module of ``name`` (or the subpackage ``name``) on access."""
+    if name.startswith("__"):
+        raise AttributeError(f"module {package!r} has no attribute {name!r}")
+    module = LAZY_ATTRS.get(name)
+    if module is not None and module.startswith(package + "."):
+        return getattr(import_module(module), name)
+    try:
+        return import_module(f"{package}.{name}")
+    except ModuleNotFoundError as e:
+        if e.name != f"{package}.{name}":
+            raise
+    raise AttributeError(f"module {package!r} has no attribute {name!r}")
@@ -1,3 +1,7 @@
-from .visualizer import MasaTrackLocalVisualizer
+from ..registry import lazy_getattr
 
 __all__ = ["MasaTrackLocalVisualizer"]
+
+
+def __getattr__(name):
+    return lazy_getattr(__name__, name)
@@ -31,7 +31,7 @@ def random_color(seed):
     return color
 
 
-@VISUALIZERS.register_module()
+@VISUALIZERS.register_module(force=True)
 class MasaTrackLocalVisualizer(Visualizer):
     """Tracking Local Visualizer for the MOT, VIS tasks.
 
@@ -0,0 +1,107 @@
+import os
+import sys
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import argparse
+import time
+
+import torch
+
+from benchmark_tracker import SyntheticModel, make_frames, report, synchronize
+from masa.models.tracker import MasaBDDTracker, MasaTaoTracker
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Memory and latency of the embedding storage dtypes of the tracker memory, '
+                    'on long synthetic sequences with many objects coming and going')
+    parser.add_argument('--num-dets', type=int, default=300, help='Detections per frame')
+    parser.add_argument('--num-objects', type=int, default=1000, help='Objects moving through the scene')
+    parser.add_argument('--low-ratio', type=float, default=0.3,
+                        help='Share of the detections which are low score clutter around the objects')
+    parser.add_argument('--num-frames', type=int, default=150)
+    parser.add_argument('--warmup', type=int, default=100,
+                        help='Frames not counted in the timings, while the memory fills up')
+    parser.add_argument('--embed-dim', type=int, default=256)
+    parser.add_argument('--image-size', type=int, default=1920)
+    parser.add_argument('--memo-frames', type=int, default=200, help='memo_tracklet_frames of the trackers')
+    parser.add_argument('--backdrop-frames', type=int, default=20, help='memo_backdrop_frames of MasaBDDTracker')
+    parser.add_argument('--dtypes', nargs='+', default=['float16', 'bfloat16', 'int8'],
+                        choices=['float16', 'bfloat16', 'int8'], help='Storage dtypes compared to float32')
+    parser.add_argument('--trackers', nargs='+', default=['tao', 'bdd'], choices=['tao', 'bdd'])
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def memory_bytes(tracker):
+    """Bytes of the embeddings (and their scales) held by the tracker."""
+    tensors = [tracker.tracks.view('embeds'), tracker.tracks.view('embed_scales')]
+    for backdrop in tracker.backdrops:
+        tensors += [backdrop['embeds'], backdrop.get('embed_scales')]
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+def run(args, tracker, frames):
+    model = SyntheticModel()
+    elapsed, results, peak = [], [], 0
+    for det_sample, embeds in frames:
+        model.track_head.embeds = embeds
+        synchronize(args.device)
+        start = time.perf_counter()
+        result = tracker.track(model, None, None, det_sample, rescale=False)
+        synchronize(args.device)
+        elapsed.append(time.perf_counter() - start)
+        results.append((result.bboxes.cpu(), result.instances_id.cpu()))
+        peak = max(peak, memory_bytes(tracker))
+    return elapsed[args.warmup:], results, peak
+
+
+def id_consistency(reference, results):
+    """Share of the boxes tracked by both runs whose id keeps following the
+    first reference id it was paired with, and the number of boxes tracked
+    by only one of them."""
+    id_map, consistent, num_paired, num_unpaired = {}, 0, 0, 0
+    for (ref_bboxes, ref_ids), (bboxes, ids) in zip(reference, results):
+        rows = {tuple(bbox): int(i) for bbox, i in zip(bboxes.tolist(), ids)}
+        for bbox, ref_id in zip(ref_bboxes.tolist(), ref_ids.tolist()):
+            track_id = rows.pop(tuple(bbox), None)
+            if track_id is None:
+                num_unpaired += 1
+                continue
+            num_paired += 1
+            consistent += id_map.setdefault(ref_id, track_id) == track_id
+        num_unpaired += len(rows)
+    return consistent / max(num_paired, 1), num_unpaired
+
+
+def main():
+    args = parse_args()
+    frames = make_frames(args)
+    print(f'{args.num_frames} frames of {args.num_dets} detections, {args.embed_dim}-d embeddings, '
+          f'memo_tracklet_frames={args.memo_frames}, timed after {args.warmup} frames on {args.device}')
+    builders = dict(
+        tao=lambda dtype: MasaTaoTracker(memo_tracklet_frames=args.memo_frames, embed_dtype=dtype),
+        bdd=lambda dtype: MasaBDDTracker(memo_tracklet_frames=args.memo_frames,
+                                         memo_backdrop_frames=args.backdrop_frames, embed_dtype=dtype))
+    names = dict(tao='MasaTaoTracker', bdd='MasaBDDTracker')
+    for name in args.trackers:
+        print(names[name])
+        # warm up the kernels
+        run(args, builders[name](None), frames[:3])
+        ref_elapsed, reference, ref_peak = run(args, builders[name](None), frames)
+        report('  float32', ref_elapsed)
+        print(f'{"":28s} memory {ref_peak / 2**20:7.2f} MB')
+        ref_mean = sum(ref_elapsed) / len(ref_elapsed)
+        for dtype in args.dtypes:
+            elapsed, results, peak = run(args, builders[name](dtype), frames)
+            consistency, unpaired = id_consistency(reference, results)
+            report(f'  {dtype}', elapsed)
+            print(f'{"":28s} memory {peak / 2**20:7.2f} MB ({peak / ref_peak:.2f}x)   '
+                  f'latency {sum(elapsed) / len(elapsed) / ref_mean:.2f}x   '
+                  f'id consistency {consistency:.4f}, {unpaired} boxes tracked by only one')
+
+
+if __name__ == '__main__':
+    main()
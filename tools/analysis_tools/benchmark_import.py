@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# Run in a fresh interpreter, so every run pays the full import cost.
+SNIPPET = '''
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import masa
+{imports}
+imported = time.perf_counter()
+build = None
+if {config!r}:
+    from mmengine.config import Config
+    from mmdet.registry import MODELS
+    from mmengine.registry import init_default_scope
+    cfg = Config.fromfile({config!r})
+    init_default_scope(cfg.get('default_scope', 'mmdet'))
+    MODELS.build(cfg.model)
+    build = time.perf_counter() - imported
+print(json.dumps(dict(imported=imported - start, build=build, modules=len(sys.modules))))
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measure the start-up time of `import masa`, lazy and eager')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters per mode')
+    parser.add_argument('--imports', nargs='*', default=['masa.apis'],
+                        help='Modules imported after masa, e.g. what a demo script imports')
+    parser.add_argument('--config', default='', help='Also time the first MODELS.build of this config')
+    parser.add_argument('--top', type=int, default=0,
+                        help='Print the N slowest modules of the lazy import (python -X importtime)')
+    return parser.parse_args()
+
+
+def run_once(args, lazy):
+    env = dict(os.environ, MASA_LAZY_IMPORT='1' if lazy else '0')
+    code = SNIPPET.format(root=project_root, config=args.config,
+                          imports='\n'.join(f'import {m}' for m in args.imports))
+    out = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def print_top_modules(args):
+    env = dict(os.environ, MASA_LAZY_IMPORT='1')
+    code = f'import sys; sys.path.insert(0, {project_root!r}); import masa'
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                         check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.strip()))
+    print(f'\nSlowest {args.top} modules of `import masa` (cumulative):')
+    for cumulative, name in sorted(rows, reverse=True)[:args.top]:
+        print(f'{cumulative / 1e3:10.1f} ms  {name}')
+
+
+def main():
+    args = parse_args()
+    for lazy in (False, True):
+        runs = [run_once(args, lazy) for _ in range(args.repeat)]
+        imported = statistics.median(r['imported'] for r in runs)
+        line = (f'{"lazy" if lazy else "eager":5s}: import {imported:.3f}s, '
+                f'{runs[-1]["modules"]} modules loaded')
+        if args.config:
+            build = statistics.median(r['build'] for r in runs)
+            line += f', first build {build:.3f}s, total {imported + build:.3f}s'
+        print(line)
+    if args.top > 0:
+        print_top_modules(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import os
+import sys
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import argparse
+import time
+import warnings
+
+import mmcv
+import torch
+from mmdet.structures.bbox import bbox_overlaps
+
+warnings.filterwarnings('ignore')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Throughput and accuracy of the keyframe stride mode, against detecting every frame')
+    parser.add_argument('video', help='Benchmark clip')
+    parser.add_argument('--masa_config', help='Masa Config file of a unified model')
+    parser.add_argument('--masa_checkpoint', help='Masa Checkpoint file')
+    parser.add_argument('--device', default='cuda:0', help='Device used for inference')
+    parser.add_argument('--texts', help='text prompt')
+    parser.add_argument('--detector_type', type=str, default='mmdet', help='Choose detector type')
+    parser.add_argument('--fp16', action='store_true', help='Activation fp16 mode')
+    parser.add_argument('--strides', type=int, nargs='+', default=[2, 4, 8], help='Fixed strides to compare')
+    parser.add_argument('--adaptive', type=int, nargs='*', default=[8],
+                        help='Maximum strides of the adaptive mode to compare')
+    parser.add_argument('--score-thr', type=float, default=0.2, help='Score threshold of the compared boxes')
+    parser.add_argument('--iou-thr', type=float, default=0.5, help='IoU of a box matching the reference')
+    parser.add_argument('--max_frames', type=int, default=-1, help='Only use the first frames of the clip')
+    return parser.parse_args()
+
+
+def run(args, model, pipeline, frames, scheduler):
+    from masa.apis import inference_masa
+
+    model.keyframe_scheduler = scheduler
+    results, num_keyframes = [], 0
+    synchronize(args.device)
+    start = time.perf_counter()
+    for frame_id, frame in enumerate(frames):
+        num_keyframes += model.is_keyframe(frame_id)
+        result = inference_masa(model, frame, frame_id=frame_id, video_len=len(frames),
+                                test_pipeline=pipeline, text_prompt=args.texts,
+                                fp16=args.fp16, detector_type=args.detector_type)
+        pred = result[0].pred_track_instances
+        keep = pred.scores > args.score_thr
+        results.append((pred.bboxes[keep].float().cpu(), pred.instances_id[keep].cpu()))
+    synchronize(args.device)
+    return results, time.perf_counter() - start, num_keyframes
+
+
+def synchronize(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+
+
+def compare(reference, results, iou_thr):
+    """Recall and precision of the boxes against the reference, mean IoU of
+    the matches, and share of the matches whose id follows the reference id
+    of the previous frame (id consistency)."""
+    num_ref = num_pred = num_matched = 0
+    ious, consistent, id_map = [], 0, {}
+    for (ref_bboxes, ref_ids), (bboxes, ids) in zip(reference, results):
+        num_ref += len(ref_bboxes)
+        num_pred += len(bboxes)
+        if len(ref_bboxes) == 0 or len(bboxes) == 0:
+            continue
+        overlaps = bbox_overlaps(ref_bboxes, bboxes)
+        # greedy matching, best pairs first
+        used_ref, used_pred = set(), set()
+        values, order = overlaps.flatten().sort(descending=True)
+        for value, index in zip(values.tolist(), order.tolist()):
+            if value < iou_thr:
+                break
+            i, j = divmod(index, overlaps.size(1))
+            if i in used_ref or j in used_pred:
+                continue
+            used_ref.add(i)
+            used_pred.add(j)
+            ious.append(value)
+            ref_id, pred_id = int(ref_ids[i]), int(ids[j])
+            consistent += id_map.get(ref_id, pred_id) == pred_id
+            id_map[ref_id] = pred_id
+        num_matched += len(used_ref)
+    return dict(
+        recall=num_matched / max(num_ref, 1),
+        precision=num_matched / max(num_pred, 1),
+        mean_iou=sum(ious) / max(len(ious), 1),
+        id_consistency=consistent / max(num_matched, 1),
+    )
+
+
+def main():
+    args = parse_args()
+    import masa  # noqa: F401
+    from masa.apis import build_test_pipeline, init_masa
+    from masa.models.tracker import KeyframeScheduler
+
+    model = init_masa(args.masa_config, args.masa_checkpoint, device=args.device)
+    pipeline = build_test_pipeline(model.cfg, with_text=args.texts is not None,
+                                   detector_type=args.detector_type)
+    frames = list(mmcv.VideoReader(args.video))
+    if args.max_frames > 0:
+        frames = frames[:args.max_frames]
+
+    # warm up, then the reference detects every frame
+    run(args, model, pipeline, frames[:5], None)
+    reference, ref_time, _ = run(args, model, pipeline, frames, None)
+    print(f'{len(frames)} frames, every frame detected: {len(frames) / ref_time:.1f} fps')
+
+    settings = [(f'stride {s}', KeyframeScheduler(stride=s)) for s in args.strides]
+    settings += [(f'adaptive <= {s}', KeyframeScheduler(stride=s, adaptive=True)) for s in args.adaptive]
+    print(f'{"mode":16s} {"fps":>8s} {"speedup":>8s} {"keyfr.":>7s} {"recall":>7s} '
+          f'{"prec.":>7s} {"mIoU":>7s} {"id cons.":>8s}')
+    for name, scheduler in settings:
+        results, elapsed, num_keyframes = run(args, model, pipeline, frames, scheduler)
+        metrics = compare(reference, results, args.iou_thr)
+        print(f'{name:16s} {len(frames) / elapsed:8.1f} {ref_time / elapsed:7.2f}x '
+              f'{num_keyframes / len(frames):7.1%} {metrics["recall"]:7.3f} {metrics["precision"]:7.3f} '
+              f'{metrics["mean_iou"]:7.3f} {metrics["id_consistency"]:8.3f}')
+    model.keyframe_scheduler = None
+
+
+if __name__ == '__main__':
+    main()
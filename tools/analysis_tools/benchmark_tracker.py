@@ -0,0 +1,152 @@
+import os
+import sys
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import argparse
+import time
+
+import torch
+from mmdet.structures import DetDataSample
+from mmdet.structures.bbox import bbox_overlaps
+from mmengine.structures import InstanceData
+
+from masa.models.tracker import MasaBDDTracker, MasaTaoTracker
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the MASA trackers on synthetic dense scenes')
+    parser.add_argument('--num-dets', type=int, default=1000, help='Detections per frame')
+    parser.add_argument('--num-objects', type=int, default=400, help='Objects moving through the scene')
+    parser.add_argument('--low-ratio', type=float, default=0.5,
+                        help='Share of the detections which are low score clutter around the objects')
+    parser.add_argument('--num-frames', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5, help='Frames not counted in the timings')
+    parser.add_argument('--embed-dim', type=int, default=256)
+    parser.add_argument('--image-size', type=int, default=1920)
+    parser.add_argument('--trackers', nargs='+', default=['tao', 'bdd'], choices=['tao', 'bdd'])
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--max-distance', type=float, default=-1,
+                        help='max_distance of MasaTaoTracker, -1 to match all the pairs')
+    parser.add_argument('--spatial-index', action='store_true',
+                        help='Gate the matching of MasaTaoTracker with its spatial index')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+class SyntheticTrackHead:
+    """Stands for the track head, returns the embeddings of the frame."""
+
+    embeds = None
+
+    def predict(self, feats, bboxes):
+        return self.embeds
+
+
+class SyntheticModel:
+
+    def __init__(self):
+        self.track_head = SyntheticTrackHead()
+
+
+def make_frames(args):
+    """Objects drifting across the image, with low score boxes scattered
+    around them like the clutter of a parts bin."""
+    g = torch.Generator().manual_seed(args.seed)
+    num_low = int(args.num_dets * args.low_ratio)
+    num_high = args.num_dets - num_low
+    size = args.image_size
+    centers = torch.rand(args.num_objects, 2, generator=g) * size
+    sizes = torch.rand(args.num_objects, 2, generator=g) * 60 + 20
+    velocities = torch.randn(args.num_objects, 2, generator=g) * 3
+    appearances = torch.randn(args.num_objects, args.embed_dim, generator=g)
+    classes = torch.randint(0, 10, (args.num_objects,), generator=g)
+
+    frames = []
+    for frame_id in range(args.num_frames):
+        objs = torch.randint(0, args.num_objects, (num_high,), generator=g)
+        clutter = torch.randint(0, args.num_objects, (num_low,), generator=g)
+        ctr = centers + velocities * frame_id
+        obj_ctr = ctr[objs] + torch.randn(num_high, 2, generator=g)
+        low_ctr = ctr[clutter] + torch.randn(num_low, 2, generator=g) * sizes[clutter] / 2
+        all_ctr = torch.cat([obj_ctr, low_ctr])
+        all_wh = torch.cat([sizes[objs], sizes[clutter]])
+        bboxes = torch.cat([all_ctr - all_wh / 2, all_ctr + all_wh / 2], dim=1)
+        scores = torch.cat([torch.rand(num_high, generator=g) * 0.5 + 0.5,
+                            torch.rand(num_low, generator=g) * 0.5])
+        labels = torch.cat([classes[objs], classes[clutter]])
+        embeds = torch.cat([appearances[objs], appearances[clutter]])
+        embeds = embeds + torch.randn(embeds.shape, generator=g) * 0.3
+
+        det_sample = DetDataSample(metainfo=dict(frame_id=frame_id, scale_factor=(1.0, 1.0)))
+        det_sample.pred_instances = InstanceData(
+            bboxes=bboxes.to(args.device), labels=labels.to(args.device), scores=scores.to(args.device))
+        frames.append((det_sample, embeds.to(args.device)))
+    return frames
+
+
+def synchronize(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+
+
+def time_tracker(args, tracker, frames):
+    model = SyntheticModel()
+    elapsed = []
+    num_tracked = 0
+    for det_sample, embeds in frames:
+        model.track_head.embeds = embeds
+        synchronize(args.device)
+        start = time.perf_counter()
+        result = tracker.track(model, None, None, det_sample, rescale=False)
+        synchronize(args.device)
+        elapsed.append(time.perf_counter() - start)
+        num_tracked += len(result)
+    return elapsed[args.warmup:], num_tracked
+
+
+def time_distractor_removal(args, frames):
+    """Time MasaTaoTracker.remove_distractor alone, on the sorted frames."""
+    tracker = MasaTaoTracker()
+    elapsed = []
+    for det_sample, embeds in frames:
+        pred = det_sample.pred_instances
+        _, inds = pred.scores.sort(descending=True)
+        synchronize(args.device)
+        start = time.perf_counter()
+        tracker.remove_distractor(pred.bboxes[inds], pred.labels[inds], pred.scores[inds],
+                                  track_feats=embeds[inds])
+        synchronize(args.device)
+        elapsed.append(time.perf_counter() - start)
+    return elapsed[args.warmup:]
+
+
+def report(name, elapsed):
+    elapsed = sorted(elapsed)
+    mean = sum(elapsed) / len(elapsed)
+    p90 = elapsed[int(0.9 * (len(elapsed) - 1))]
+    print(f'{name:28s} mean {mean * 1e3:8.2f} ms   p90 {p90 * 1e3:8.2f} ms')
+
+
+def main():
+    args = parse_args()
+    frames = make_frames(args)
+    pred = frames[0][0].pred_instances
+    overlaps = (bbox_overlaps(pred.bboxes, pred.bboxes) > 0.3).sum().item() - len(pred)
+    print(f'{args.num_dets} detections per frame, {overlaps // 2} overlapping pairs, '
+          f'{args.num_frames - args.warmup} timed frames on {args.device}')
+
+    report('remove_distractor', time_distractor_removal(args, frames))
+    builders = dict(
+        tao=lambda: MasaTaoTracker(max_distance=args.max_distance, use_spatial_index=args.spatial_index),
+        bdd=MasaBDDTracker)
+    names = dict(tao='MasaTaoTracker', bdd='MasaBDDTracker')
+    for name in args.trackers:
+        elapsed, num_tracked = time_tracker(args, builders[name](), frames)
+        report(f'{names[name]}.track', elapsed)
+        print(f'{"":28s} {num_tracked / len(frames):.0f} tracked boxes per frame')
+
+
+if __name__ == '__main__':
+    main()
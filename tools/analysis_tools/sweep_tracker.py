@@ -0,0 +1,289 @@
+import os
+import sys
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import argparse
+import ast
+import copy
+import csv
+import itertools
+import json
+import time
+
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+from torch.multiprocessing import get_context
+
+ALPHAS = np.arange(0.05, 0.99, 0.05)
+EPS = np.finfo('float').eps
+METRICS = ('HOTA', 'DetA', 'AssA', 'LocA', 'ClsA', 'TETA_style', 'IDF1', 'MOTA', 'IDSW', 'num_pred')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Sweep the tracker parameters over the detections and track embeddings saved by '
+                    'tools/batch_track.py --save_artifacts, on the CPU')
+    parser.add_argument('artifacts', help='Directory of the <name>.dets.pth artifacts, searched recursively')
+    parser.add_argument('gt', help='Directory of the <name>.json ground truth, in the JSON format of the demo')
+    parser.add_argument('--config', help='MASA config whose model.tracker is the base of the sweep')
+    parser.add_argument('--tracker', default='MasaTaoTracker', choices=['MasaTaoTracker', 'MasaBDDTracker'],
+                        help='Tracker with its default parameters as the base of the sweep, without --config')
+    parser.add_argument('--grid', nargs='+', default=[], metavar='KEY=VALUES',
+                        help='Values of a tracker parameter, e.g. init_score_thr=0.1,0.2,0.3, or a list '
+                             'literal for values with commas. All the combinations are run')
+    parser.add_argument('--score_thr', type=float, default=0.0, help='Score threshold of the evaluated tracks')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of processes')
+    parser.add_argument('--out', default='sweep_results.csv', help='Results of every combination, .csv or .json')
+    parser.add_argument('--sort_by', default='HOTA', choices=METRICS)
+    parser.add_argument('--top', type=int, default=10, help='Number of combinations printed')
+    return parser.parse_args()
+
+
+def parse_grid(grid):
+    """The tracker parameters of every combination of the ``--grid`` values."""
+    keys, values = [], []
+    for item in grid:
+        key, value = item.split('=', 1)
+        if value.startswith('['):
+            value = ast.literal_eval(value)
+        else:
+            value = [ast.literal_eval(v) for v in value.split(',')]
+        keys.append(key)
+        values.append(value)
+    return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+
+
+def xywh2xyxy(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+
+
+def load_gt(path):
+    """The ids, xyxy boxes and labels of the ground truth of every frame."""
+    with open(path) as f:
+        annotations = json.load(f)
+    if isinstance(annotations, dict):
+        annotations = annotations['annotations']
+    frames = {}
+    for ann in annotations:
+        frames.setdefault(ann['frame_id'], []).append(ann)
+    return {
+        frame_id: (np.array([ann['track_id'] for ann in anns]),
+                   xywh2xyxy([ann['bbox'] for ann in anns]),
+                   np.array([ann['label'] for ann in anns]))
+        for frame_id, anns in frames.items()
+    }
+
+
+def box_iou(boxes1, boxes2):
+    lt = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    rb = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    overlap = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area1 = np.prod(boxes1[:, 2:] - boxes1[:, :2], axis=1)
+    area2 = np.prod(boxes2[:, 2:] - boxes2[:, :2], axis=1)
+    return overlap / np.maximum(area1[:, None] + area2[None, :] - overlap, EPS)
+
+
+def eval_sequence(gt, pred):
+    """The counts of the HOTA, CLEAR and Identity metrics of a video, as
+    TrackEval computes them, with class agnostic matching. The classes are
+    scored apart by ClsA, the share of the matched tracks with the label of
+    the ground truth, like TETA."""
+    empty = (np.zeros(0, dtype=np.int64), np.zeros((0, 4)), np.zeros(0, dtype=np.int64))
+    frames = sorted(set(gt) | set(pred))
+    gt_ids = np.unique(np.concatenate([gt[f][0] for f in gt] + [empty[0]]))
+    pred_ids = np.unique(np.concatenate([pred[f][0] for f in pred] + [empty[0]]))
+    timesteps = []
+    for f in frames:
+        g_ids, g_boxes, g_labels = gt.get(f, empty)
+        p_ids, p_boxes, p_labels = pred.get(f, empty)
+        timesteps.append((np.searchsorted(gt_ids, g_ids), np.searchsorted(pred_ids, p_ids),
+                          box_iou(g_boxes, p_boxes), g_labels, p_labels))
+
+    num_gt, num_pred = len(gt_ids), len(pred_ids)
+    res = dict(HOTA_TP=np.zeros(len(ALPHAS)), HOTA_FN=np.zeros(len(ALPHAS)), HOTA_FP=np.zeros(len(ALPHAS)),
+               AssA_sum=np.zeros(len(ALPHAS)), LocA_sum=np.zeros(len(ALPHAS)),
+               cls_correct=0, cls_matched=0, CLR_TP=0, CLR_FN=0, CLR_FP=0, IDSW=0,
+               IDTP=0, IDFN=0, IDFP=0, num_pred=0)
+
+    # global alignment of the ids, to match the frames like the whole video
+    potential_matches = np.zeros((num_gt, num_pred))
+    gt_id_count = np.zeros((num_gt, 1))
+    pred_id_count = np.zeros((1, num_pred))
+    id_matches = np.zeros((num_gt, num_pred))
+    for g, p, sim, _, _ in timesteps:
+        denom = sim.sum(0)[None, :] + sim.sum(1)[:, None] - sim
+        potential_matches[g[:, None], p[None, :]] += np.divide(sim, denom, out=np.zeros_like(sim),
+                                                               where=denom > EPS)
+        gt_id_count[g] += 1
+        pred_id_count[0, p] += 1
+        id_matches[g[:, None], p[None, :]] += sim >= 0.5 - EPS
+    global_alignment = potential_matches / (gt_id_count + pred_id_count - potential_matches)
+
+    matches_counts = [np.zeros((num_gt, num_pred)) for _ in ALPHAS]
+    prev_pred = np.full(num_gt, -1)
+    prev_step_pred = np.full(num_gt, -1)
+    for g, p, sim, g_labels, p_labels in timesteps:
+        res['num_pred'] += len(p)
+        if len(g) == 0 or len(p) == 0:
+            res['HOTA_FN'] += len(g)
+            res['HOTA_FP'] += len(p)
+            res['CLR_FN'] += len(g)
+            res['CLR_FP'] += len(p)
+            prev_step_pred[:] = -1
+            continue
+
+        rows, cols = linear_sum_assignment(-(global_alignment[g[:, None], p[None, :]] * sim))
+        for a, alpha in enumerate(ALPHAS):
+            matched = sim[rows, cols] >= alpha - EPS
+            m_rows, m_cols = rows[matched], cols[matched]
+            res['HOTA_TP'][a] += len(m_rows)
+            res['HOTA_FN'][a] += len(g) - len(m_rows)
+            res['HOTA_FP'][a] += len(p) - len(m_rows)
+            res['LocA_sum'][a] += sim[m_rows, m_cols].sum()
+            matches_counts[a][g[m_rows], p[m_cols]] += 1
+            if abs(alpha - 0.5) < 1e-6:
+                res['cls_correct'] += int((g_labels[m_rows] == p_labels[m_cols]).sum())
+                res['cls_matched'] += len(m_rows)
+
+        # CLEAR, keeping the matches of the previous frame when possible
+        score = sim + 1000 * (p[None, :] == prev_step_pred[g][:, None])
+        score[sim < 0.5 - EPS] = 0
+        rows, cols = linear_sum_assignment(-score)
+        keep = score[rows, cols] > 0
+        m_gt, m_pred = g[rows[keep]], p[cols[keep]]
+        res['IDSW'] += int(np.sum((prev_pred[m_gt] >= 0) & (prev_pred[m_gt] != m_pred)))
+        prev_pred[m_gt] = m_pred
+        prev_step_pred[:] = -1
+        prev_step_pred[m_gt] = m_pred
+        res['CLR_TP'] += len(m_gt)
+        res['CLR_FN'] += len(g) - len(m_gt)
+        res['CLR_FP'] += len(p) - len(m_gt)
+
+    for a in range(len(ALPHAS)):
+        counts = matches_counts[a]
+        ass = counts / np.maximum(1, gt_id_count + pred_id_count - counts)
+        res['AssA_sum'][a] = np.sum(counts * ass)
+
+    total_gt, total_pred = gt_id_count.sum(), pred_id_count.sum()
+    if num_gt and num_pred:
+        rows, cols = linear_sum_assignment(-id_matches)
+        res['IDTP'] = id_matches[rows, cols].sum()
+    res['IDFN'] = total_gt - res['IDTP']
+    res['IDFP'] = total_pred - res['IDTP']
+    return res
+
+
+def combine(results):
+    """The metrics of the videos together, from the sums of their counts."""
+    res = {key: sum(r[key] for r in results) for key in results[0]}
+    tp = res['HOTA_TP']
+    det_a = tp / np.maximum(1, tp + res['HOTA_FN'] + res['HOTA_FP'])
+    ass_a = res['AssA_sum'] / np.maximum(1, tp)
+    loc_a = res['LocA_sum'] / np.maximum(EPS, tp)
+    cls_a = res['cls_correct'] / max(1, res['cls_matched'])
+    num_gt = res['CLR_TP'] + res['CLR_FN']
+    metrics = dict(
+        HOTA=float(np.mean(np.sqrt(det_a * ass_a))),
+        DetA=float(np.mean(det_a)),
+        AssA=float(np.mean(ass_a)),
+        LocA=float(np.mean(loc_a)),
+        ClsA=cls_a,
+        TETA_style=float((np.mean(det_a) + np.mean(ass_a) + cls_a) / 3),
+        IDF1=float(res['IDTP'] / max(1, res['IDTP'] + 0.5 * res['IDFP'] + 0.5 * res['IDFN'])),
+        MOTA=float((res['CLR_TP'] - res['CLR_FP'] - res['IDSW']) / max(1, num_gt)),
+        IDSW=int(res['IDSW']),
+        num_pred=int(res['num_pred']),
+    )
+    return metrics
+
+
+_videos = None
+
+
+def init_worker(videos):
+    global _videos
+    torch.set_num_threads(1)
+    import masa.models.tracker  # noqa: F401
+    from masa.models.tracker import load_det_artifacts
+    _videos = [(load_det_artifacts(path), gt) for path, gt in videos]
+
+
+def run(task):
+    """Replay the videos with the tracker of one combination."""
+    from mmdet.registry import MODELS
+
+    from masa.models.tracker import replay_det_artifacts
+
+    tracker_cfg, score_thr = task
+    tracker = MODELS.build(copy.deepcopy(tracker_cfg))
+    results = []
+    for artifacts, gt in _videos:
+        pred = {}
+        for frame_id, instances in replay_det_artifacts(tracker, artifacts):
+            keep = instances.scores >= score_thr
+            pred[frame_id] = (instances.instances_id[keep].numpy(),
+                              instances.bboxes[keep].double().numpy(),
+                              instances.labels[keep].numpy())
+        results.append(eval_sequence(gt, pred))
+    return combine(results)
+
+
+def main():
+    args = parse_args()
+    if args.config:
+        from mmengine.config import Config
+        base_cfg = Config.fromfile(args.config).model.tracker.to_dict()
+    else:
+        base_cfg = dict(type=args.tracker)
+    combos = parse_grid(args.grid)
+
+    videos = []
+    for root, _, files in sorted(os.walk(args.artifacts)):
+        for file in sorted(files):
+            if not file.endswith('.dets.pth'):
+                continue
+            # batch_track keeps the subdirectories of the videos
+            name = os.path.relpath(os.path.join(root, file), args.artifacts)
+            gt_path = os.path.join(args.gt, name[:-len('.dets.pth')] + '.json')
+            if not os.path.exists(gt_path):
+                print(f'{name}: no ground truth, skipped')
+                continue
+            videos.append((os.path.join(root, file), load_gt(gt_path)))
+    assert videos, f'no artifacts with ground truth in {args.artifacts}'
+    print(f'{len(combos)} combinations on {len(videos)} videos')
+
+    tasks = [(dict(base_cfg, **params), args.score_thr) for params in combos]
+    start = time.time()
+    num_workers = max(1, min(args.workers, len(tasks)))
+    with get_context('spawn').Pool(num_workers, initializer=init_worker, initargs=(videos,)) as pool:
+        rows = []
+        for params, metrics in zip(combos, pool.imap(run, tasks)):
+            rows.append(dict(params, **metrics))
+            print(f'[{len(rows)}/{len(combos)}] {params}: '
+                  f'HOTA {metrics["HOTA"]:.4f} IDF1 {metrics["IDF1"]:.4f} MOTA {metrics["MOTA"]:.4f}')
+    print(f'{len(combos)} combinations in {time.time() - start:.1f}s')
+
+    if args.out.endswith('.json'):
+        with open(args.out, 'w') as f:
+            json.dump(rows, f, indent=2)
+    else:
+        with open(args.out, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    print(f'\nTop {args.top} by {args.sort_by}:')
+    # the fewer identity switches the better
+    reverse = args.sort_by != 'IDSW'
+    for row in sorted(rows, key=lambda r: r[args.sort_by], reverse=reverse)[:args.top]:
+        params = {key: row[key] for key in combos[0]}
+        print(f'  {params}  ' + '  '.join(
+            f'{key} {row[key]:.4f}' if isinstance(row[key], float) else f'{key} {row[key]}'
+            for key in METRICS))
+
+
+if __name__ == '__main__':
+    main()
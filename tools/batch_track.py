@@ -0,0 +1,356 @@
+import os
+import sys
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'demo'))
+
+import argparse
+import json
+import queue
+import time
+import traceback
+
+import cv2
+import torch
+from torch.multiprocessing import get_context
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Track many videos with warm MASA model workers')
+    parser.add_argument('input', help='Video directory, or a manifest file (.txt with one path per line, or .json list)')
+    parser.add_argument('--out_dir', required=True, help='Directory for the per-video outputs, '
+                        'in the subdirectories of the videos relative to the input')
+    parser.add_argument('--det_config', help='Detector Config file')
+    parser.add_argument('--masa_config', help='Masa Config file')
+    parser.add_argument('--det_checkpoint', help='Detector Checkpoint file')
+    parser.add_argument('--masa_checkpoint', help='Masa Checkpoint file')
+    parser.add_argument('--devices', default='cuda:0', help='Comma separated devices, assigned to the workers round robin, e.g. "cuda:0,cuda:1" or "cpu"')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes, each loads the model once')
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads for each worker, 0 keeps the torch default')
+    parser.add_argument('--score-thr', type=float, default=0.2, help='Bbox score threshold')
+    parser.add_argument('--texts', help='text prompt')
+    parser.add_argument('--line_width', type=int, default=5, help='Line width')
+    parser.add_argument('--unified', action='store_true', help='Use unified model, which means the masa adapter is built upon the detector model.')
+    parser.add_argument('--detector_type', type=str, default='mmdet', help='Choose detector type')
+    parser.add_argument('--fp16', action='store_true', help='Activation fp16 mode')
+    parser.add_argument('--tensor_preprocess', action='store_true', help='Resize and normalize the uint8 frames on the device of the model instead of the mmcv test pipeline')
+    parser.add_argument('--video_backend', default='auto', choices=['auto', 'pyav', 'opencv'], help='Video decoding backend, auto uses PyAV when it is installed')
+    parser.add_argument('--decode_threads', type=int, default=0, help='Video decoding threads per worker, 0 lets the backend choose')
+    parser.add_argument('--decode_at_scale', action='store_true',
+                        help='Decode the frames directly at the input size of the model, with --unified only. '
+                             'Not used with --save_video, which renders at the size of the video')
+    parser.add_argument('--no-post', action='store_true', help='Do not post-process the results ')
+    parser.add_argument('--post_delay', type=int, default=30, help='Number of frames the online post-processing holds back')
+    parser.add_argument('--save_video', action='store_true', help='Also render an output video for each input')
+    parser.add_argument('--overwrite', action='store_true', help='Process the videos whose outputs already exist')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='Save the tracker state every N frames, so an interrupted video resumes from its last '
+                             'checkpoint instead of frame 0. 0 disables it, not used with --save_video')
+    parser.add_argument('--feature_store_dir', help='Keep the backbone features of every video (unified models) in a '
+                        'subdirectory of this one, reruns with other prompts or thresholds read them instead of running the backbone')
+    parser.add_argument('--feature_store_gb', type=float, default=20, help='Size limit of the feature store of each video in GB')
+    parser.add_argument('--save_artifacts', action='store_true',
+                        help='Also save the detections and track embeddings of every video (<name>.dets.pth), '
+                             'to sweep the tracker parameters offline with tools/analysis_tools/sweep_tracker.py')
+    args = parser.parse_args()
+    if args.decode_at_scale and not args.unified:
+        parser.error('--decode_at_scale needs --unified, the detector has its own input size')
+    if args.feature_store_dir and not args.unified:
+        parser.error('--feature_store_dir needs --unified')
+    # options read by the demo helpers
+    args.show_fps = False
+    args.sam_mask = False
+    return args
+
+
+def list_videos(input_path):
+    """Collect the video paths from a directory or a manifest file."""
+    if os.path.isdir(input_path):
+        videos = []
+        for root, _, files in os.walk(input_path):
+            for file in sorted(files):
+                if file.lower().endswith(VIDEO_EXTENSIONS):
+                    videos.append(os.path.join(root, file))
+        return sorted(videos)
+    if input_path.endswith('.json'):
+        with open(input_path) as f:
+            return list(json.load(f))
+    with open(input_path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def video_root(input_path, videos):
+    """The directory the output names are relative to, the input directory or
+    the deepest directory holding all the videos of a manifest."""
+    if os.path.isdir(input_path):
+        return os.path.abspath(input_path)
+    return os.path.commonpath([os.path.dirname(os.path.abspath(v)) for v in videos]) if videos else ''
+
+
+def video_name(args, video_path):
+    """The path of the video relative to ``args.video_root`` without the
+    extension, so videos of the same name in different subdirectories get
+    their own outputs."""
+    return os.path.splitext(os.path.relpath(os.path.abspath(video_path), args.video_root))[0]
+
+
+def output_paths(args, video_path):
+    name = video_name(args, video_path)
+    return (os.path.join(args.out_dir, name + '.json'),
+            os.path.join(args.out_dir, name + '.mp4'))
+
+
+def checkpoint_path(args, video_path):
+    return output_paths(args, video_path)[0] + '.ckpt.pth'
+
+
+def artifact_path(args, video_path):
+    return os.path.splitext(output_paths(args, video_path)[0])[0] + '.dets.pth'
+
+
+def can_resume(args, checkpoint, json_path):
+    """Whether the partial JSON and the artifact parts a checkpoint goes on
+    from are still on disk."""
+    partial_json = json_path + '.tmp.json'
+    if not os.path.exists(partial_json) or os.path.getsize(partial_json) < checkpoint['results']['offset']:
+        return False
+    if not args.save_artifacts:
+        return True
+    artifacts = checkpoint['artifacts']
+    return artifacts is not None and all(os.path.exists(part) for part in artifacts['parts'])
+
+
+def open_video(args, video_path, masa_model):
+    """The frames of a video, decoded at the input size of the model with
+    ``--decode_at_scale`` unless they are rendered."""
+    from masa.apis import VideoSource
+
+    kwargs = dict(backend=args.video_backend, threads=args.decode_threads)
+    if args.decode_at_scale and not args.save_video:
+        return VideoSource.from_config(video_path, masa_model.cfg, **kwargs)
+    return VideoSource(video_path, **kwargs)
+
+
+def count_frames(video_path):
+    cap = cv2.VideoCapture(video_path)
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return num_frames
+
+
+def build_models(args, device):
+    """Load the models once per worker."""
+    from mmcv.transforms import Compose
+    from mmdet.apis import init_detector
+    from mmdet.registry import VISUALIZERS
+
+    import masa  # noqa: F401
+    from masa.apis import build_test_pipeline, init_masa
+
+    det_model, test_pipeline = None, None
+    masa_model = init_masa(args.masa_config, args.masa_checkpoint, device=device)
+    if not args.unified:
+        det_model = init_detector(args.det_config, args.det_checkpoint, palette='random', device=device)
+        det_model.cfg.test_dataloader.dataset.pipeline[0].type = 'mmdet.LoadImageFromNDArray'
+        test_pipeline = Compose(det_model.cfg.test_dataloader.dataset.pipeline)
+
+    masa_test_pipeline = build_test_pipeline(masa_model.cfg, with_text=args.texts is not None,
+                                             detector_type=args.detector_type,
+                                             tensor_native=args.tensor_preprocess)
+
+    visualizer = None
+    if args.save_video:
+        if args.texts is not None:
+            masa_model.cfg.visualizer['texts'] = args.texts
+        else:
+            masa_model.cfg.visualizer['texts'] = det_model.dataset_meta['classes']
+        masa_model.cfg.visualizer['line_width'] = args.line_width
+        visualizer = VISUALIZERS.build(masa_model.cfg.visualizer)
+    return masa_model, det_model, test_pipeline, masa_test_pipeline, visualizer
+
+
+def process_video(args, video_path, models, device):
+    """Track one video and write its JSON (and video) outputs."""
+    from utils import OnlineTrackFilter
+    from video_demo_with_text import (JsonResultsWriter, convert_frame_to_json,
+                                      get_label_mapping, track_frame,
+                                      visualize_frame)
+
+    masa_model, det_model, test_pipeline, masa_test_pipeline, visualizer = models
+    json_path, video_out_path = output_paths(args, video_path)
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
+    args.device = device
+    if args.feature_store_dir:
+        from masa.models.mot import FeatureStore
+        masa_model.feature_store = FeatureStore(os.path.join(args.feature_store_dir, video_name(args, video_path)),
+                                                masa_model.feature_store_id,
+                                                FeatureStore.video_identity(video_path),
+                                                max_gb=args.feature_store_gb)
+    masa_model.artifact_writer = None
+    if args.save_artifacts:
+        from masa.models.tracker import DetArtifactWriter
+        masa_model.artifact_writer = DetArtifactWriter()
+
+    video_reader = open_video(args, video_path, masa_model)
+    video_len = len(video_reader)
+    video_writer = None
+    if args.save_video:
+        video_writer = cv2.VideoWriter(
+            video_out_path + '.tmp.mp4', cv2.VideoWriter_fourcc(*'mp4v'),
+            video_reader.fps, (video_reader.width, video_reader.height))
+
+    label_mapping = get_label_mapping(masa_model, args.texts)
+    json_writer = None
+    post_filter = None
+    start_frame = 0
+    use_checkpoints = args.checkpoint_every > 0 and video_writer is None
+    ckpt_path = checkpoint_path(args, video_path)
+    # the artifacts of the frames before a checkpoint are flushed to part files
+    artifact_parts = artifact_path(args, video_path) + '.parts'
+    if use_checkpoints and os.path.exists(ckpt_path) and not args.overwrite:
+        # where the partial JSON and artifacts end, the frames held by the
+        # post filter and the tracker state, everything needed to go on with
+        # the next frame
+        checkpoint = torch.load(ckpt_path, map_location='cpu', weights_only=False)
+        if can_resume(args, checkpoint, json_path):
+            start_frame = checkpoint['frame_idx']
+            json_writer = JsonResultsWriter(json_path, video_path, label_mapping, resume=checkpoint['results'])
+            post_filter = checkpoint['post_filter']
+            masa_model.load_tracking_state_dict(checkpoint['tracking'])
+            if args.save_artifacts:
+                masa_model.artifact_writer.load_state_dict(checkpoint['artifacts'])
+            print(f'{video_path}: resuming from frame {start_frame}')
+        else:
+            print(f'{video_path}: the partial outputs of the checkpoint are missing, starting over')
+    if json_writer is None:
+        json_writer = JsonResultsWriter(json_path, video_path, label_mapping)
+
+    def finish(track_result, payload):
+        frame_idx, frame = payload
+        json_writer.write(convert_frame_to_json(track_result, frame_idx, label_mapping))
+        if video_writer is not None:
+            vis_frame = visualize_frame(args, visualizer, frame, track_result, frame_idx)
+            video_writer.write(vis_frame[:, :, ::-1])
+
+    for frame_idx, frame in enumerate(video_reader.frames(start_frame), start_frame):
+        track_result, _ = track_frame(args, frame, frame_idx, video_len,
+                                      masa_model, masa_test_pipeline, args.texts,
+                                      det_model=det_model, test_pipeline=test_pipeline,
+                                      ori_shape=video_reader.ori_shape)
+        payload = (frame_idx, frame if video_writer is not None else None)
+        if args.no_post:
+            finish(track_result, payload)
+        else:
+            if post_filter is None:
+                post_filter = OnlineTrackFilter((video_reader.width, video_reader.height), delay=args.post_delay)
+            for ready in post_filter.push(track_result, payload):
+                finish(*ready)
+        if use_checkpoints and (frame_idx + 1) % args.checkpoint_every == 0:
+            # only the new records and artifacts are written, the checkpoint
+            # holds where they end
+            artifacts = None
+            if masa_model.artifact_writer is not None:
+                masa_model.artifact_writer.flush(artifact_parts)
+                artifacts = masa_model.artifact_writer.state_dict()
+            torch.save(dict(frame_idx=frame_idx + 1, results=json_writer.state_dict(), post_filter=post_filter,
+                            tracking=masa_model.tracking_state_dict(), artifacts=artifacts), ckpt_path + '.tmp')
+            os.replace(ckpt_path + '.tmp', ckpt_path)
+    if post_filter is not None:
+        for ready in post_filter.flush():
+            finish(*ready)
+
+    if video_writer is not None:
+        video_writer.release()
+        os.replace(video_out_path + '.tmp.mp4', video_out_path)
+    if masa_model.artifact_writer is not None:
+        masa_model.artifact_writer.save(artifact_path(args, video_path), video_name=os.path.basename(video_path),
+                                        label_mapping=label_mapping)
+    # the JSON is closed last and atomically, its presence marks the video as done
+    json_writer.close()
+    if os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
+    return video_len
+
+
+def worker(rank, args, device, task_queue, result_queue):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    import warnings
+    warnings.filterwarnings('ignore')
+
+    models = build_models(args, device)
+    result_queue.put(('ready', rank, None, None))
+    while True:
+        video_path = task_queue.get()
+        if video_path is None:
+            break
+        start = time.time()
+        try:
+            num_frames = process_video(args, video_path, models, device)
+            result_queue.put(('done', rank, video_path, (num_frames, time.time() - start)))
+        except Exception:
+            result_queue.put(('failed', rank, video_path, traceback.format_exc()))
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    videos = list_videos(args.input)
+    args.video_root = video_root(args.input, videos)
+    todo = [v for v in videos if args.overwrite or not os.path.exists(output_paths(args, v)[0])]
+    print(f'{len(videos)} videos, {len(videos) - len(todo)} already done, {len(todo)} to process')
+    if len(todo) == 0:
+        return
+
+    # longest first, so the long videos do not end up alone at the tail
+    todo.sort(key=count_frames, reverse=True)
+
+    devices = args.devices.split(',')
+    num_workers = max(1, min(args.workers, len(todo)))
+    ctx = get_context('spawn')
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for video_path in todo:
+        task_queue.put(video_path)
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+    processes = []
+    for rank in range(num_workers):
+        p = ctx.Process(target=worker,
+                        args=(rank, args, devices[rank % len(devices)], task_queue, result_queue))
+        p.start()
+        processes.append(p)
+
+    finished, failed = 0, []
+    while finished + len(failed) < len(todo):
+        if not any(p.is_alive() for p in processes) and result_queue.empty():
+            print('All workers exited before the end, rerun to resume.')
+            break
+        try:
+            status, rank, video_path, info = result_queue.get(timeout=5)
+        except queue.Empty:
+            continue
+        if status == 'ready':
+            print(f'worker {rank} ready')
+        elif status == 'done':
+            finished += 1
+            num_frames, elapsed = info
+            print(f'[{finished + len(failed)}/{len(todo)}] worker {rank}: {video_path} '
+                  f'({num_frames} frames, {num_frames / max(elapsed, 1e-6):.1f} fps)')
+        else:
+            failed.append(video_path)
+            print(f'[{finished + len(failed)}/{len(todo)}] worker {rank} failed on {video_path}:\n{info}')
+
+    for p in processes:
+        p.join()
+    print(f'Done: {finished} processed, {len(failed)} failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import os
+import sys
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'demo'))
+
+import argparse
+import queue
+import time
+import traceback
+
+import torch
+from torch.multiprocessing import get_context
+
+from batch_track import build_models, count_frames, open_video
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Track one long video in overlapping chunks on parallel workers, then stitch the track ids')
+    parser.add_argument('video', help='Video file')
+    parser.add_argument('--json_out', required=True, help='Output JSON file, in the format of the video demo')
+    parser.add_argument('--det_config', help='Detector Config file')
+    parser.add_argument('--masa_config', help='Masa Config file')
+    parser.add_argument('--det_checkpoint', help='Detector Checkpoint file')
+    parser.add_argument('--masa_checkpoint', help='Masa Checkpoint file')
+    parser.add_argument('--devices', default='cuda:0', help='Comma separated devices, assigned to the workers round robin, e.g. "cuda:0,cuda:1" or "cpu"')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes, each loads the model once')
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads for each worker, 0 keeps the torch default')
+    parser.add_argument('--chunk_size', type=int, default=1800, help='Frames per chunk, without the overlap')
+    parser.add_argument('--overlap', type=int, default=30, help='Frames shared by two consecutive chunks, where their tracks are matched')
+    parser.add_argument('--embed_weight', type=float, default=0.5, help='Weight of the embedding similarity against the box IoU when stitching')
+    parser.add_argument('--match_thr', type=float, default=0.5, help='Minimum stitching score of two tracks')
+    parser.add_argument('--chunk_dir', help='Directory of the per-chunk results, kept to resume. Defaults to <json_out>.chunks')
+    parser.add_argument('--texts', help='text prompt')
+    parser.add_argument('--unified', action='store_true', help='Use unified model, which means the masa adapter is built upon the detector model.')
+    parser.add_argument('--detector_type', type=str, default='mmdet', help='Choose detector type')
+    parser.add_argument('--fp16', action='store_true', help='Activation fp16 mode')
+    parser.add_argument('--tensor_preprocess', action='store_true', help='Resize and normalize the uint8 frames on the device of the model instead of the mmcv test pipeline')
+    parser.add_argument('--video_backend', default='auto', choices=['auto', 'pyav', 'opencv'], help='Video decoding backend, auto uses PyAV when it is installed')
+    parser.add_argument('--decode_threads', type=int, default=0, help='Video decoding threads per worker, 0 lets the backend choose')
+    parser.add_argument('--decode_at_scale', action='store_true',
+                        help='Decode the frames directly at the input size of the model, with --unified only')
+    args = parser.parse_args()
+    if args.decode_at_scale and not args.unified:
+        parser.error('--decode_at_scale needs --unified, the detector has its own input size')
+    # options read by the demo helpers
+    args.show_fps = False
+    args.sam_mask = False
+    args.save_video = False
+    args.line_width = 5
+    if args.chunk_dir is None:
+        args.chunk_dir = args.json_out + '.chunks'
+    return args
+
+
+def chunk_path(args, k):
+    return os.path.join(args.chunk_dir, f'chunk_{k:05d}.pth')
+
+
+def process_chunk(args, k, chunks, models):
+    """Track the frames of chunk ``k`` with a fresh tracker, and keep the
+    mean embeddings of its tracks in the overlaps with its neighbours."""
+    from video_demo_with_text import (convert_frame_to_json, get_label_mapping,
+                                      track_frame)
+
+    masa_model, det_model, test_pipeline, masa_test_pipeline, _ = models
+    start, end = chunks[k]
+    head_end = chunks[k - 1][1] if k > 0 else start
+    tail_start = chunks[k + 1][0] if k + 1 < len(chunks) else end
+    label_mapping = get_label_mapping(masa_model, args.texts)
+
+    video_reader = open_video(args, args.video, masa_model)
+    records, head_sums, tail_sums = [], {}, {}
+    for frame_idx, frame in enumerate(video_reader.frames(start, end), start):
+        # chunk relative frame ids, the tracker starts over at the chunk start
+        track_result, _ = track_frame(args, frame, frame_idx - start, end - start,
+                                      masa_model, masa_test_pipeline, args.texts,
+                                      det_model=det_model, test_pipeline=test_pipeline,
+                                      ori_shape=video_reader.ori_shape)
+        records.extend(convert_frame_to_json(track_result, frame_idx, label_mapping))
+
+        sums = head_sums if frame_idx < head_end else tail_sums if frame_idx >= tail_start else None
+        ids = track_result[0].pred_track_instances.instances_id
+        if sums is not None and len(ids) > 0:
+            tracks = masa_model.tracker.tracks
+            rows = tracks.find(ids.cpu())
+            found = rows >= 0
+            embeds = tracks.get_embeds(rows[found].to(tracks.device), torch.float32).cpu()
+            for track_id, embed in zip(ids[found].tolist(), embeds):
+                total, count = sums.get(track_id, (0, 0))
+                sums[track_id] = (total + embed, count + 1)
+
+    def means(sums):
+        return {track_id: total / count for track_id, (total, count) in sums.items()}
+
+    result = dict(records=records, head_embeds=means(head_sums), tail_embeds=means(tail_sums),
+                  label_mapping=label_mapping)
+    torch.save(result, chunk_path(args, k) + '.tmp')
+    os.replace(chunk_path(args, k) + '.tmp', chunk_path(args, k))
+    return end - start
+
+
+def worker(rank, args, device, chunks, task_queue, result_queue):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    import warnings
+    warnings.filterwarnings('ignore')
+
+    args.device = device
+    models = build_models(args, device)
+    result_queue.put(('ready', rank, None, None))
+    while True:
+        k = task_queue.get()
+        if k is None:
+            break
+        start = time.time()
+        try:
+            num_frames = process_chunk(args, k, chunks, models)
+            result_queue.put(('done', rank, k, (num_frames, time.time() - start)))
+        except Exception:
+            result_queue.put(('failed', rank, k, traceback.format_exc()))
+
+
+def main():
+    import mmengine
+    from video_demo_with_text import wrap_json_results
+
+    from masa.apis.chunk_stitching import split_chunks, stitch_chunks
+
+    args = parse_args()
+    os.makedirs(args.chunk_dir, exist_ok=True)
+    chunks = split_chunks(count_frames(args.video), args.chunk_size, args.overlap)
+    todo = [k for k in range(len(chunks)) if not os.path.exists(chunk_path(args, k))]
+    print(f'{len(chunks)} chunks, {len(chunks) - len(todo)} already done, {len(todo)} to process')
+
+    if len(todo) > 0:
+        devices = args.devices.split(',')
+        num_workers = max(1, min(args.workers, len(todo)))
+        ctx = get_context('spawn')
+        task_queue = ctx.Queue()
+        result_queue = ctx.Queue()
+        for k in todo:
+            task_queue.put(k)
+        for _ in range(num_workers):
+            task_queue.put(None)
+        processes = []
+        for rank in range(num_workers):
+            p = ctx.Process(target=worker,
+                            args=(rank, args, devices[rank % len(devices)], chunks, task_queue, result_queue))
+            p.start()
+            processes.append(p)
+
+        finished, failed = 0, []
+        start = time.time()
+        while finished + len(failed) < len(todo):
+            if not any(p.is_alive() for p in processes) and result_queue.empty():
+                break
+            try:
+                status, rank, k, info = result_queue.get(timeout=5)
+            except queue.Empty:
+                continue
+            if status == 'ready':
+                print(f'worker {rank} ready')
+            elif status == 'done':
+                finished += 1
+                num_frames, elapsed = info
+                print(f'[{finished + len(failed)}/{len(todo)}] worker {rank}: chunk {k} '
+                      f'({num_frames} frames, {num_frames / max(elapsed, 1e-6):.1f} fps)')
+            else:
+                failed.append(k)
+                print(f'[{finished + len(failed)}/{len(todo)}] worker {rank} failed on chunk {k}:\n{info}')
+        for p in processes:
+            p.join()
+        print(f'{finished} chunks processed in {time.time() - start:.1f}s')
+        if finished < len(todo):
+            print('Some chunks are missing, rerun to resume.')
+            return
+
+    chunk_results = [torch.load(chunk_path(args, k)) for k in range(len(chunks))]
+    records = stitch_chunks(chunk_results, chunks, embed_weight=args.embed_weight, match_thr=args.match_thr)
+    label_mapping = chunk_results[0]['label_mapping']
+    mmengine.dump(wrap_json_results(records, args.video, label_mapping), args.json_out)
+    print(f'{len({r["track_id"] for r in records})} tracks written to {args.json_out}')
+
+
+if __name__ == '__main__':
+    main()
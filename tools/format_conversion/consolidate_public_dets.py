@@ -0,0 +1,41 @@
+import os
+import sys
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, project_root)
+
+import argparse
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+from tqdm import tqdm
+
+from masa.models.mot.public_dets import PublicDets
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Gather the public detection pickles of every sequence into one file per sequence, '
+                    'read by MASA load_public_dets instead of the pickles')
+    parser.add_argument('det_root', help='public_det_path of the config')
+    parser.add_argument('--end_pkl_name', default='.pth', help='end_pkl_name of the config')
+    parser.add_argument('--with_masks', action='store_true', help='Also gather the det_masks (with_segm configs)')
+    parser.add_argument('--workers', type=int, default=cpu_count())
+    return parser.parse_args()
+
+
+def list_sequences(det_root, end_pkl_name):
+    """The directories holding frame pickles under ``det_root``."""
+    skip = (PublicDets.FILE_NAME, PublicDets.MASK_FILE_NAME)
+    return sorted(
+        root for root, _, files in os.walk(det_root)
+        if any(name.endswith(end_pkl_name) and name not in skip for name in files))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    seq_dirs = list_sequences(args.det_root, args.end_pkl_name)
+    print(f'{len(seq_dirs)} sequences in {args.det_root}')
+    consolidate = partial(PublicDets.consolidate, end_pkl_name=args.end_pkl_name, with_masks=args.with_masks)
+    with Pool(processes=max(1, args.workers)) as pool:
+        for _ in tqdm(pool.imap_unordered(consolidate, seq_dirs), total=len(seq_dirs)):
+            pass
@@ -0,0 +1,129 @@
+import os
+import sys
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'demo'))
+
+import argparse
+import threading
+import time
+import warnings
+
+import cv2
+import mmengine
+import torch
+
+warnings.filterwarnings('ignore')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Track several videos or camera streams with one MASA model')
+    parser.add_argument('sources', nargs='+', help='Video files, camera indices or stream URLs')
+    parser.add_argument('--out_dir', required=True, help='Directory for the per-stream JSON outputs')
+    parser.add_argument('--masa_config', help='Masa Config file')
+    parser.add_argument('--masa_checkpoint', help='Masa Checkpoint file')
+    parser.add_argument('--device', default='cuda:0', help='Device used for inference')
+    parser.add_argument('--threads', type=int, default=0, help='torch.set_num_threads, 0 keeps the torch default')
+    parser.add_argument('--texts', help='text prompt')
+    parser.add_argument('--detector_type', type=str, default='mmdet', help='Choose detector type')
+    parser.add_argument('--fp16', action='store_true', help='Activation fp16 mode')
+    parser.add_argument('--max_batch_size', type=int, default=16, help='Maximum number of frames per forward pass')
+    parser.add_argument('--realtime', action='store_true',
+                        help='Read the video files at their frame rate, like cameras, and drop the frames '
+                             'the model cannot keep up with. By default every frame is processed')
+    return parser.parse_args()
+
+
+def open_source(source):
+    return cv2.VideoCapture(int(source) if source.isdigit() else source)
+
+
+def read_stream(engine, stream_id, source, realtime, done):
+    """Feed the frames of one source to the engine."""
+    cap = open_source(source)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25
+    is_file = os.path.isfile(source)
+    next_time = time.time()
+    while True:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        if not realtime and is_file:
+            # wait for the engine, so no frame of a file is dropped
+            while engine.streams[stream_id].pending is not None:
+                time.sleep(0.001)
+        engine.submit(stream_id, frame)
+        if realtime and is_file:
+            next_time += 1 / fps
+            time.sleep(max(0.0, next_time - time.time()))
+    cap.release()
+    done.set()
+
+
+def main():
+    args = parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    import masa  # noqa: F401
+    from masa.apis import MultiStreamEngine, build_test_pipeline, init_masa
+    from video_demo_with_text import (convert_frame_to_json, get_label_mapping,
+                                      wrap_json_results)
+
+    masa_model = init_masa(args.masa_config, args.masa_checkpoint, device=args.device)
+    masa_test_pipeline = build_test_pipeline(masa_model.cfg, with_text=args.texts is not None,
+                                             detector_type=args.detector_type)
+    engine = MultiStreamEngine(masa_model, masa_test_pipeline, text_prompt=args.texts,
+                               fp16=args.fp16, detector_type=args.detector_type,
+                               max_batch_size=args.max_batch_size)
+    label_mapping = get_label_mapping(masa_model, args.texts)
+
+    json_results, readers = {}, {}
+    for stream_id, source in enumerate(args.sources):
+        video_len = -1
+        if os.path.isfile(source):
+            cap = open_source(source)
+            video_len = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            cap.release()
+        engine.add_stream(stream_id, video_len)
+        json_results[stream_id] = []
+        done = threading.Event()
+        thread = threading.Thread(target=read_stream, daemon=True,
+                                  args=(engine, stream_id, source, args.realtime, done))
+        readers[stream_id] = done
+        thread.start()
+
+    start = time.time()
+    num_frames = 0
+    while len(engine.streams) > 0:
+        results = engine.step()
+        if len(results) == 0:
+            # close the streams whose source is exhausted and fully processed
+            for stream_id, done in readers.items():
+                if done.is_set() and stream_id in engine.streams and engine.streams[stream_id].pending is None:
+                    stats = engine.stats(stream_id)
+                    print(f'{args.sources[stream_id]}: {stats["processed"]} frames processed, '
+                          f'{stats["dropped"]} dropped')
+                    engine.remove_stream(stream_id)
+            time.sleep(0.001)
+            continue
+        for stream_id, track_result in results.items():
+            track_result = track_result.to('cpu')
+            frame_idx = track_result[0].frame_id
+            json_results[stream_id].extend(convert_frame_to_json(track_result, frame_idx, label_mapping))
+        num_frames += len(results)
+
+    elapsed = time.time() - start
+    print(f'{len(args.sources)} streams, {num_frames} frames in {elapsed:.1f}s '
+          f'({num_frames / max(elapsed, 1e-6):.1f} fps in total)')
+    for stream_id, source in enumerate(args.sources):
+        name = os.path.splitext(os.path.basename(source))[0] if os.path.isfile(source) else f'stream_{stream_id}'
+        mmengine.dump(wrap_json_results(json_results[stream_id], source, label_mapping),
+                      os.path.join(args.out_dir, name + '.json'))
+
+
+if __name__ == '__main__':
+    main()